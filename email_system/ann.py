@@ -0,0 +1,343 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set
+
+import numpy as np
+
+BLOCK_ROWS = 4096
+
+
+@dataclass
+class Neighbor:
+    conversation_id: str
+    score: float
+    labels: Dict[str, Any]
+
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-8)
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return np.concatenate(
+        [
+            np.argmax(vectors[start : start + BLOCK_ROWS] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), BLOCK_ROWS)
+        ]
+        or [np.empty(0, dtype=np.int64)]
+    )
+
+
+def spherical_kmeans(
+    vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0
+) -> np.ndarray:
+    # Lloyd's algorithm on unit vectors with cosine similarity; empty
+    # clusters are re-seeded from random points.
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=k)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(len(vectors), size=len(empty), replace=False)]
+        centroids = _unit(sums)
+    return centroids
+
+
+@contextmanager
+def _file_lock(path: Path) -> Iterator[None]:
+    # Advisory lock on "<path>.lock" so processes sharing one index file
+    # take turns to merge and write it.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(path.name + ".lock"), "a+b") as handle:
+        if os.name == "nt":
+            import msvcrt
+
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+class LabelIndex:
+    # Inverted-file (IVF) index over unit-normalized conversation embeddings
+    # with the labels assigned to each conversation. Vectors are bucketed by
+    # their nearest k-means centroid and a query scans only the nprobe
+    # closest buckets. Below min_train_size vectors, search is exact.
+    # max_entries (0: unlimited) caps the rows held in memory; once full, new
+    # ids are skipped and known ids are still updated.
+    def __init__(
+        self,
+        path: Optional[str | Path] = None,
+        nprobe: int = 8,
+        min_train_size: int = 1024,
+        seed: int = 0,
+        max_entries: int = 0,
+    ) -> None:
+        self.path = Path(path) if path else None
+        self.nprobe = nprobe
+        self.max_entries = max_entries
+        self.min_train_size = min_train_size
+        self.seed = seed
+        self.ids: List[str] = []
+        self.labels: List[Dict[str, Any]] = []
+        self.centroids: Optional[np.ndarray] = None
+        self._rows: Dict[str, int] = {}
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._lists: List[np.ndarray] = []
+        self._trained_on = 0
+        self._lock = threading.RLock()
+        # Ids changed since the last save, and the index file's mtime as of
+        # that save (or load), used to detect writes by other processes.
+        self._pending: Set[str] = set()
+        self._synced_mtime: Optional[int] = None
+        self._saved_at: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[: len(self.ids)]
+
+    def _reserve(self, rows: int, dim: int) -> None:
+        if self._vectors.shape[1] != dim:
+            if len(self.ids):
+                raise ValueError(f"Index holds {self._vectors.shape[1]}-d vectors, got {dim}-d.")
+            self._vectors = np.zeros((0, dim), dtype=np.float32)
+        if rows <= len(self._vectors):
+            return
+        capacity = max(rows, 2 * len(self._vectors), 256)
+        grown = np.zeros((capacity, dim), dtype=np.float32)
+        grown[: len(self.ids)] = self.vectors
+        self._vectors = grown
+        assign = np.full(capacity, -1, dtype=np.int32)
+        assign[: len(self.ids)] = self._assign[: len(self.ids)]
+        self._assign = assign
+
+    def add(
+        self, ids: Sequence[str], vectors: np.ndarray, labels: Sequence[Dict[str, Any]]
+    ) -> None:
+        # Known ids are updated in place, so re-processed threads keep one entry.
+        vectors = _unit(vectors)
+        with self._lock:
+            self._reserve(len(self.ids) + len(ids), vectors.shape[1])
+            touched: List[int] = []
+            for conversation_id, vector, label in zip(ids, vectors, labels):
+                row = self._rows.get(conversation_id)
+                if row is None:
+                    if self.max_entries and len(self.ids) >= self.max_entries:
+                        continue
+                    row = len(self.ids)
+                    self._rows[conversation_id] = row
+                    self.ids.append(conversation_id)
+                    self.labels.append(dict(label))
+                else:
+                    self.labels[row] = dict(label)
+                self._vectors[row] = vector
+                self._pending.add(conversation_id)
+                touched.append(row)
+            if self._needs_training():
+                self.train()
+            elif self.centroids is not None and touched:
+                rows = np.unique(touched)
+                previous = self._assign[rows].copy()
+                self._assign[rows] = _nearest(self._vectors[rows], self.centroids)
+                self._move_rows(rows, previous)
+
+    def _needs_training(self) -> bool:
+        if len(self.ids) < self.min_train_size:
+            return False
+        return self.centroids is None or len(self.ids) >= 4 * self._trained_on
+
+    def train(self) -> None:
+        with self._lock:
+            vectors = self.vectors
+            n_lists = max(1, int(round(len(vectors) ** 0.5)))
+            rng = np.random.default_rng(self.seed)
+            sample_size = min(len(vectors), 64 * n_lists)
+            sample = vectors[np.sort(rng.choice(len(vectors), size=sample_size, replace=False))]
+            self.centroids = spherical_kmeans(sample, n_lists, seed=self.seed)
+            self._assign[: len(vectors)] = _nearest(vectors, self.centroids)
+            self._trained_on = len(vectors)
+            self._rebuild_lists()
+
+    def _rebuild_lists(self) -> None:
+        assign = self._assign[: len(self.ids)]
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        self._lists = [order[bounds[i] : bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def _move_rows(self, rows: np.ndarray, previous: np.ndarray) -> None:
+        # Moves only the given rows between buckets (previous is -1 for new
+        # rows), so an insert costs the size of the buckets it touches rather
+        # than a re-sort of every assignment.
+        current = self._assign[rows]
+        moved = previous != current
+        rows, previous, current = rows[moved], previous[moved], current[moved]
+        for list_id in np.unique(previous[previous >= 0]):
+            members = self._lists[list_id]
+            self._lists[list_id] = members[~np.isin(members, rows[previous == list_id])]
+        for list_id in np.unique(current):
+            self._lists[list_id] = np.concatenate([self._lists[list_id], rows[current == list_id]])
+
+    def search(self, vectors: np.ndarray, k: int = 5) -> List[List[Neighbor]]:
+        queries = _unit(vectors)
+        with self._lock:
+            if not self.ids:
+                return [[] for _ in queries]
+            data = self.vectors
+            if self.centroids is None:
+                results: List[List[Neighbor]] = []
+                for start in range(0, len(queries), BLOCK_ROWS):
+                    scores = queries[start : start + BLOCK_ROWS] @ data.T
+                    rows = np.broadcast_to(np.arange(len(data)), scores.shape)
+                    results.extend(self._neighbors(scores, rows, k))
+                return results
+            return self._search_lists(queries, data, k)
+
+    def _search_lists(self, queries: np.ndarray, data: np.ndarray, k: int) -> List[List[Neighbor]]:
+        # Buckets are scanned one at a time against every query that probes
+        # them, keeping each query's best k per probe slot.
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        best_scores = np.full((len(queries), nprobe * k), -np.inf, dtype=np.float32)
+        best_rows = np.full((len(queries), nprobe * k), -1, dtype=np.int64)
+        owners = np.repeat(np.arange(len(queries)), nprobe)
+        slots = np.tile(np.arange(nprobe), len(queries))
+        flat = probes.ravel()
+        order = np.argsort(flat, kind="stable")
+        bounds = np.searchsorted(flat[order], np.arange(len(self.centroids) + 1))
+        for list_id, members in enumerate(self._lists):
+            selected = order[bounds[list_id] : bounds[list_id + 1]]
+            if not len(selected) or not len(members):
+                continue
+            query_rows = owners[selected]
+            scores = queries[query_rows] @ data[members].T
+            keep = min(k, len(members))
+            if len(members) > keep:
+                top = np.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+            else:
+                top = np.broadcast_to(np.arange(keep), (len(query_rows), keep))
+            columns = slots[selected][:, None] * k + np.arange(keep)
+            best_scores[query_rows[:, None], columns] = np.take_along_axis(scores, top, axis=1)
+            best_rows[query_rows[:, None], columns] = members[top]
+        return self._neighbors(best_scores, best_rows, k)
+
+    def _neighbors(self, scores: np.ndarray, rows: np.ndarray, k: int) -> List[List[Neighbor]]:
+        keep = min(k, scores.shape[1])
+        top = np.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        top_rows = np.take_along_axis(rows, top, axis=1)
+        results: List[List[Neighbor]] = []
+        for row_scores, row_ids in zip(top_scores, top_rows):
+            order = np.argsort(-row_scores)
+            results.append(
+                [
+                    Neighbor(self.ids[row_ids[idx]], float(row_scores[idx]), self.labels[row_ids[idx]])
+                    for idx in order
+                    if row_ids[idx] >= 0
+                ]
+            )
+        return results
+
+    def _merge_from(self, path: Path) -> None:
+        # Takes entries written by other processes, except ids changed here
+        # since the last save, which keep their local labels.
+        other = LabelIndex.load(path)
+        rows = [row for row, key in enumerate(other.ids) if key not in self._pending]
+        for start in range(0, len(rows), BLOCK_ROWS):
+            block = rows[start : start + BLOCK_ROWS]
+            self.add(
+                [other.ids[row] for row in block],
+                other.vectors[block],
+                [other.labels[row] for row in block],
+            )
+
+    def save(self, path: Optional[str | Path] = None) -> None:
+        path = Path(path or self.path)
+        tmp = path.with_name(path.name + ".tmp")
+        with _file_lock(path), self._lock:
+            if path.exists() and path.stat().st_mtime_ns != self._synced_mtime:
+                self._merge_from(path)
+            with open(tmp, "wb") as handle:
+                np.savez(
+                    handle,
+                    vectors=self.vectors,
+                    assign=self._assign[: len(self.ids)],
+                    centroids=self.centroids if self.centroids is not None else np.zeros((0, 0)),
+                    ids=np.array(self.ids, dtype=str),
+                    labels=np.array(json.dumps(self.labels)),
+                    trained_on=np.array(self._trained_on),
+                )
+            tmp.replace(path)
+            self._synced_mtime = path.stat().st_mtime_ns
+            self._pending.clear()
+            self._saved_at = time.monotonic()
+
+    def maybe_save(self, interval: float) -> bool:
+        # Writes at most once per interval seconds; the first change in a
+        # process is written straight away so short runs persist.
+        if self.path is None or not self._pending:
+            return False
+        if self._saved_at is not None and time.monotonic() - self._saved_at < interval:
+            return False
+        self.save()
+        return True
+
+    def flush(self) -> None:
+        if self.path is not None and self._pending:
+            self.save()
+
+    @classmethod
+    def load(cls, path: str | Path, **kwargs: Any) -> "LabelIndex":
+        index = cls(path, **kwargs)
+        with np.load(path) as data:
+            ids = [str(value) for value in data["ids"]]
+            index._reserve(len(ids), data["vectors"].shape[1])
+            index._vectors[: len(ids)] = data["vectors"]
+            index._assign[: len(ids)] = data["assign"]
+            index.ids = ids
+            index.labels = json.loads(str(data["labels"]))
+            index._rows = {conversation_id: row for row, conversation_id in enumerate(ids)}
+            index._trained_on = int(data["trained_on"])
+            if data["centroids"].size:
+                index.centroids = data["centroids"].astype(np.float32)
+                index._rebuild_lists()
+        index._synced_mtime = Path(path).stat().st_mtime_ns
+        return index
+
+
+def label_index_from_env() -> Optional[LabelIndex]:
+    path = os.getenv("LABEL_INDEX_PATH", "").strip()
+    if not path:
+        return None
+    nprobe = int(os.getenv("LABEL_INDEX_NPROBE", "8"))
+    max_entries = int(os.getenv("LABEL_INDEX_MAX_ENTRIES", "0"))
+    if Path(path).exists():
+        return LabelIndex.load(path, nprobe=nprobe, max_entries=max_entries)
+    return LabelIndex(path, nprobe=nprobe, max_entries=max_entries)
@@ -0,0 +1,607 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from .checkpoint import CheckpointStore, content_key
+from .io import OUTPUT_CONTENT_TYPES, write_output
+from .metrics import (
+    FIRST_LABEL_SECONDS,
+    MESSAGE_SECONDS,
+    MESSAGES_FAILED,
+    MESSAGES_PROCESSED,
+    STAGE_SECONDS,
+    WORKER_QUEUE_DEPTH,
+    heartbeat,
+)
+from .pipeline import PipelineSession, release_checkpoint, run_pipeline
+from .sidecar import sidecar_base, sidecar_files
+from .worker import _env, _env_flag, _message_blob_name, _output_name, _output_settings
+
+
+@dataclass
+class QueueMessage:
+    content: str
+    handle: Any = None
+
+
+class StorageBackend:
+    # Queue and blob operations used by the pipelined worker. download()
+    # writes the blob into dest chunk by chunk and raises FileNotFoundError
+    # when the blob does not exist. Staged blocks only become visible once
+    # commit_blocks() lists them. Received messages stay hidden for
+    # visibility_timeout seconds unless renew() extends it.
+    visibility_timeout: float = 300
+
+    async def receive(self, max_messages: int) -> List[QueueMessage]:
+        raise NotImplementedError
+
+    async def renew(self, message: QueueMessage) -> None:
+        raise NotImplementedError
+
+    async def delete(self, message: QueueMessage) -> None:
+        raise NotImplementedError
+
+    async def download(self, container: str, name: str, dest: IO[bytes]) -> None:
+        raise NotImplementedError
+
+    async def upload(
+        self,
+        container: str,
+        name: str,
+        data: bytes | IO[bytes],
+        content_type: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+    ) -> None:
+        raise NotImplementedError
+
+    async def stage_block(self, container: str, name: str, block_id: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    async def commit_blocks(
+        self,
+        container: str,
+        name: str,
+        block_ids: List[str],
+        content_type: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+    ) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        return None
+
+
+class AzureStorageBackend(StorageBackend):
+    # Uses the asyncio Azure clients, so transfers never block the event loop.
+    def __init__(
+        self,
+        account_name: str,
+        queue_name: str,
+        chunk_size: int,
+        concurrency: int,
+        visibility_timeout: int = 300,
+    ) -> None:
+        from azure.identity.aio import DefaultAzureCredential
+        from azure.storage.blob.aio import BlobServiceClient
+        from azure.storage.queue.aio import QueueClient
+
+        self.concurrency = concurrency
+        self.visibility_timeout = visibility_timeout
+        self.credential = DefaultAzureCredential()
+        self.queue = QueueClient(
+            account_url=f"https://{account_name}.queue.core.windows.net",
+            queue_name=queue_name,
+            credential=self.credential,
+        )
+        self.blobs = BlobServiceClient(
+            account_url=f"https://{account_name}.blob.core.windows.net",
+            credential=self.credential,
+            max_single_get_size=chunk_size,
+            max_chunk_get_size=chunk_size,
+        )
+
+    async def receive(self, max_messages: int) -> List[QueueMessage]:
+        pages = self.queue.receive_messages(
+            messages_per_page=max_messages,
+            max_messages=max_messages,
+            visibility_timeout=self.visibility_timeout,
+        )
+        return [QueueMessage(msg.content, msg) async for msg in pages]
+
+    async def renew(self, message: QueueMessage) -> None:
+        # The update returns a new pop receipt, which later calls must use.
+        message.handle = await self.queue.update_message(
+            message.handle, visibility_timeout=self.visibility_timeout
+        )
+
+    async def delete(self, message: QueueMessage) -> None:
+        await self.queue.delete_message(message.handle)
+
+    async def download(self, container: str, name: str, dest: IO[bytes]) -> None:
+        from azure.core.exceptions import ResourceNotFoundError
+
+        blob = self.blobs.get_blob_client(container=container, blob=name)
+        for attempt in range(3):
+            try:
+                stream = await blob.download_blob(max_concurrency=self.concurrency)
+                break
+            except ResourceNotFoundError as exc:
+                if attempt == 2:
+                    raise FileNotFoundError(name) from exc
+                await asyncio.sleep(2)
+        async for chunk in stream.chunks():
+            dest.write(chunk)
+
+    async def upload(
+        self,
+        container: str,
+        name: str,
+        data: bytes | IO[bytes],
+        content_type: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+    ) -> None:
+        from azure.storage.blob import ContentSettings
+
+        blob = self.blobs.get_blob_client(container=container, blob=name)
+        await blob.upload_blob(
+            data,
+            overwrite=True,
+            max_concurrency=self.concurrency,
+            content_settings=ContentSettings(
+                content_type=content_type, content_encoding=content_encoding
+            ),
+        )
+
+    async def stage_block(self, container: str, name: str, block_id: str, data: bytes) -> None:
+        blob = self.blobs.get_blob_client(container=container, blob=name)
+        await blob.stage_block(block_id=block_id, data=data)
+
+    async def commit_blocks(
+        self,
+        container: str,
+        name: str,
+        block_ids: List[str],
+        content_type: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+    ) -> None:
+        from azure.storage.blob import BlobBlock, ContentSettings
+
+        blob = self.blobs.get_blob_client(container=container, blob=name)
+        await blob.commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in block_ids],
+            content_settings=ContentSettings(
+                content_type=content_type, content_encoding=content_encoding
+            ),
+        )
+
+    async def close(self) -> None:
+        await self.queue.close()
+        await self.blobs.close()
+        await self.credential.close()
+
+
+class LocalStorageBackend(StorageBackend):
+    # Containers are directories under root and the queue lives in memory.
+    # latency adds a fixed delay to every call to mimic network round trips
+    # in throughput tests. As with a real queue, a received message that is
+    # neither renewed nor deleted within visibility_timeout is delivered again.
+    def __init__(
+        self, root: str | Path, latency: float = 0.0, visibility_timeout: float = 300
+    ) -> None:
+        self.root = Path(root)
+        self.latency = latency
+        self.visibility_timeout = visibility_timeout
+        self.messages: Deque[QueueMessage] = deque()
+        self.deleted: List[QueueMessage] = []
+        self.renewed = 0
+        self._hidden: List[QueueMessage] = []
+        self.staged: Dict[str, bytes] = {}
+
+    def send(self, content: str) -> None:
+        self.messages.append(QueueMessage(content))
+
+    def _path(self, container: str, name: str) -> Path:
+        path = self.root / container / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def put_blob(self, container: str, name: str, data: bytes) -> None:
+        self._path(container, name).write_bytes(data)
+
+    async def _wait(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def receive(self, max_messages: int) -> List[QueueMessage]:
+        await self._wait()
+        now = time.monotonic()
+        for message in [m for m in self._hidden if m.handle <= now]:
+            self._hidden.remove(message)
+            self.messages.append(QueueMessage(message.content))
+        count = min(max_messages, len(self.messages))
+        received = [self.messages.popleft() for _ in range(count)]
+        for message in received:
+            message.handle = now + self.visibility_timeout
+            self._hidden.append(message)
+        return received
+
+    async def renew(self, message: QueueMessage) -> None:
+        await self._wait()
+        self.renewed += 1
+        message.handle = time.monotonic() + self.visibility_timeout
+
+    async def delete(self, message: QueueMessage) -> None:
+        await self._wait()
+        if message in self._hidden:
+            self._hidden.remove(message)
+        self.deleted.append(message)
+
+    async def download(self, container: str, name: str, dest: IO[bytes]) -> None:
+        await self._wait()
+        path = self.root / container / name
+        if not path.exists():
+            raise FileNotFoundError(name)
+        with open(path, "rb") as handle:
+            shutil.copyfileobj(handle, dest)
+
+    async def upload(
+        self,
+        container: str,
+        name: str,
+        data: bytes | IO[bytes],
+        content_type: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+    ) -> None:
+        await self._wait()
+        if isinstance(data, (bytes, bytearray)):
+            self.put_blob(container, name, data)
+            return
+        with open(self._path(container, name), "wb") as handle:
+            shutil.copyfileobj(data, handle)
+
+    async def stage_block(self, container: str, name: str, block_id: str, data: bytes) -> None:
+        await self._wait()
+        self.staged[block_id] = data
+
+    async def commit_blocks(
+        self,
+        container: str,
+        name: str,
+        block_ids: List[str],
+        content_type: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+    ) -> None:
+        await self._wait()
+        with open(self._path(container, name), "wb") as handle:
+            for block_id in block_ids:
+                handle.write(self.staged.pop(block_id))
+
+
+@dataclass
+class PipelinedSettings:
+    prefetch: int = 4
+    compute: int = 4
+    uploads: int = 4
+    spool_size: int = 4 * 1024 * 1024
+    block_size: int = 4 * 1024 * 1024
+
+    @classmethod
+    def from_env(cls) -> "PipelinedSettings":
+        return cls(
+            prefetch=max(1, int(_env("WORKER_PREFETCH", "4"))),
+            compute=max(1, int(_env("WORKER_CONCURRENCY", "4"))),
+            uploads=max(1, int(_env("WORKER_UPLOADS", "4"))),
+            spool_size=int(_env("WORKER_SPOOL_SIZE", str(4 * 1024 * 1024))),
+            block_size=max(1, int(_env("OUTPUT_BLOCK_SIZE", str(4 * 1024 * 1024)))),
+        )
+
+
+@dataclass
+class _Job:
+    message: QueueMessage
+    received_at: float
+    blob_name: Optional[str] = None
+    output_name: Optional[str] = None
+    data: Optional[IO[bytes]] = None
+    output: Optional[_AsyncBlockWriter] = None
+    content_type: str = ""
+    encoding: Optional[str] = None
+    sidecar_dir: Optional[str] = None
+    checkpoint_key: str = ""
+    note: str = ""
+    # Serializes visibility renewals with the final delete, since each
+    # renewal replaces the message's pop receipt.
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+class _AsyncBlockWriter(io.RawIOBase):
+    # Asyncio counterpart of worker._BlockBlobWriter, written to from the
+    # compute threads: full blocks are staged through the event loop as they
+    # fill, and commit() stages the tail and commits from the loop.
+    def __init__(
+        self,
+        backend: StorageBackend,
+        container: str,
+        name: str,
+        block_size: int,
+        loop: asyncio.AbstractEventLoop,
+    ) -> None:
+        self.backend = backend
+        self.container = container
+        self.name = name
+        self.block_size = block_size
+        self.loop = loop
+        self.block_ids: List[str] = []
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_size:
+            chunk = bytes(self._buffer[: self.block_size])
+            del self._buffer[: self.block_size]
+            asyncio.run_coroutine_threadsafe(self._stage(chunk), self.loop).result()
+        return len(data)
+
+    async def _stage(self, chunk: bytes) -> None:
+        block_id = base64.b64encode(uuid.uuid4().hex.encode("ascii")).decode("ascii")
+        await self.backend.stage_block(self.container, self.name, block_id, chunk)
+        self.block_ids.append(block_id)
+
+    async def commit(self, content_type: str, content_encoding: Optional[str]) -> None:
+        if self._buffer or not self.block_ids:
+            await self._stage(bytes(self._buffer))
+            self._buffer.clear()
+        await self.backend.commit_blocks(
+            self.container, self.name, self.block_ids, content_type, content_encoding
+        )
+
+
+def _write_payload(writer: _AsyncBlockWriter, payload: Dict[str, Any]) -> tuple[str, Optional[str]]:
+    fmt, compress = _output_settings()
+    if compress:
+        with gzip.GzipFile(fileobj=writer, mode="wb") as handle:
+            write_output(handle, payload, fmt)
+    else:
+        write_output(writer, payload, fmt)
+    return OUTPUT_CONTENT_TYPES[fmt], "gzip" if compress else None
+
+
+async def _run_stage(
+    name: str,
+    inbox: asyncio.Queue,
+    outbox: Optional[asyncio.Queue],
+    workers: int,
+    downstream: int,
+    handle: Callable[[_Job], Awaitable[Optional[_Job]]],
+) -> None:
+    # Each stage drains its inbox until it sees one None per worker, then
+    # passes one None per downstream worker on, so shutdown flows in order.
+    async def _worker() -> None:
+        while True:
+            job = await inbox.get()
+            WORKER_QUEUE_DEPTH.set(inbox.qsize(), stage=name)
+            if job is None:
+                return
+            result = await handle(job)
+            if result is not None and outbox is not None:
+                await outbox.put(result)
+
+    await asyncio.gather(*(_worker() for _ in range(workers)))
+    if outbox is not None:
+        for _ in range(downstream):
+            await outbox.put(None)
+
+
+async def run_pipelined(
+    backend: StorageBackend,
+    session: PipelineSession,
+    input_container: str,
+    output_container: str,
+    settings: Optional[PipelinedSettings] = None,
+    checkpoint: Optional[CheckpointStore] = None,
+    fast_lane: bool = False,
+    stop_when_idle: bool = False,
+    poll_interval: float = 2.0,
+    heartbeat_interval: float = 10.0,
+) -> None:
+    # receive -> download (asyncio) -> run_pipeline (executor) -> upload and
+    # delete (asyncio). Bounded queues between the stages keep at most
+    # `prefetch` spooled blobs ahead of compute and `uploads` results behind it.
+    settings = settings or PipelinedSettings.from_env()
+    loop = asyncio.get_running_loop()
+    received: asyncio.Queue = asyncio.Queue(maxsize=settings.prefetch)
+    downloaded: asyncio.Queue = asyncio.Queue(maxsize=settings.prefetch)
+    computed: asyncio.Queue = asyncio.Queue(maxsize=settings.uploads)
+
+    # Jobs from receive until delete or failure, keyed by id(job).
+    in_flight: Dict[int, _Job] = {}
+
+    def _finish(job: _Job, ok: bool) -> None:
+        in_flight.pop(id(job), None)
+        if ok:
+            MESSAGES_PROCESSED.inc()
+            print(job.note or f"Processed -> {job.output_name}")
+        else:
+            MESSAGES_FAILED.inc()
+            print(f"Worker error: {job.note}")
+        MESSAGE_SECONDS.observe(time.monotonic() - job.received_at)
+
+    async def _heartbeat() -> None:
+        # Ticks on its own task, since a stage can wait on backpressure for
+        # longer than the health check allows.
+        while True:
+            heartbeat()
+            await asyncio.sleep(heartbeat_interval)
+
+    async def _renew() -> None:
+        # Every queue stage and compute can hold messages for longer than the
+        # visibility timeout; renewing at half of it keeps them from being
+        # delivered to another worker while this one still has them.
+        while True:
+            await asyncio.sleep(backend.visibility_timeout / 2)
+            for key, job in list(in_flight.items()):
+                async with job.lock:
+                    if key not in in_flight:
+                        continue
+                    try:
+                        await backend.renew(job.message)
+                    except Exception as exc:
+                        print(f"Visibility renewal failed: {exc}")
+
+    async def _receive() -> None:
+        while True:
+            messages = await backend.receive(settings.prefetch)
+            if not messages:
+                # In-flight messages can still come back if they fail or expire.
+                if stop_when_idle and not in_flight:
+                    break
+                await asyncio.sleep(poll_interval)
+                continue
+            received_at = time.monotonic()
+            for message in messages:
+                job = _Job(message, received_at)
+                in_flight[id(job)] = job
+                await received.put(job)
+        for _ in range(settings.prefetch):
+            await received.put(None)
+
+    async def _download(job: _Job) -> Optional[_Job]:
+        job.blob_name = _message_blob_name(job.message.content, input_container)
+        if not job.blob_name:
+            job.note = "Processed message with no blob."
+            return job
+        job.output_name = _output_name(job.blob_name)
+        # Blobs past spool_size roll over to disk while they wait for compute.
+        spool = tempfile.SpooledTemporaryFile(max_size=settings.spool_size)
+        try:
+            with STAGE_SECONDS.time(stage="download"):
+                await backend.download(input_container, job.blob_name, spool)
+        except FileNotFoundError:
+            spool.close()
+            job.note = "Blob not found; skipping message."
+            return job
+        except Exception as exc:
+            spool.close()
+            job.note = str(exc)
+            _finish(job, ok=False)
+            return None
+        spool.seek(0)
+        job.data = spool
+        return job
+
+    def _classify(job: _Job) -> None:
+        on_provisional = None
+        if fast_lane:
+            # The provisional upload is awaited so it can never land after
+            # the final output for the same blob.
+            def on_provisional(provisional: Dict[str, Any]) -> None:
+                writer = _AsyncBlockWriter(
+                    backend, output_container, job.output_name, settings.block_size, loop
+                )
+                try:
+                    content_type, encoding = _write_payload(writer, provisional)
+                    asyncio.run_coroutine_threadsafe(
+                        writer.commit(content_type, encoding), loop
+                    ).result()
+                except Exception as exc:
+                    print(f"Provisional upload failed for {job.output_name}: {exc}")
+                    return
+                FIRST_LABEL_SECONDS.observe(time.monotonic() - job.received_at)
+
+        if _env_flag("OUTPUT_EMBEDDINGS"):
+            job.sidecar_dir = tempfile.mkdtemp(prefix="email-sidecar-")
+        source: Any = job.data
+        try:
+            if checkpoint is not None:
+                job.checkpoint_key, source = content_key(source)
+            payload = run_pipeline(
+                source,
+                session=session,
+                checkpoint=checkpoint,
+                on_provisional=on_provisional,
+                sidecar=os.path.join(job.sidecar_dir, "output") if job.sidecar_dir else None,
+                clear_checkpoint=False,
+                checkpoint_key=job.checkpoint_key,
+            )
+        finally:
+            job.data.close()
+            job.data = None
+        # Full blocks are staged while the output is written; the upload
+        # stage commits them.
+        job.output = _AsyncBlockWriter(
+            backend, output_container, job.output_name, settings.block_size, loop
+        )
+        job.content_type, job.encoding = _write_payload(job.output, payload)
+
+    async def _compute(job: _Job) -> Optional[_Job]:
+        if job.data is None:
+            return job
+        try:
+            await loop.run_in_executor(pool, _classify, job)
+        except Exception as exc:
+            if job.sidecar_dir:
+                shutil.rmtree(job.sidecar_dir, ignore_errors=True)
+            job.note = str(exc)
+            _finish(job, ok=False)
+            return None
+        return job
+
+    async def _upload(job: _Job) -> Optional[_Job]:
+        try:
+            if job.output is not None:
+                with STAGE_SECONDS.time(stage="upload"):
+                    await job.output.commit(job.content_type, job.encoding)
+                    if job.sidecar_dir:
+                        local_base = os.path.join(job.sidecar_dir, "output")
+                        blob_base = sidecar_base(job.output_name)
+                        for path in sidecar_files(local_base):
+                            name = blob_base + str(path)[len(local_base) :]
+                            with open(path, "rb") as handle:
+                                await backend.upload(output_container, name, handle)
+            if checkpoint is not None and job.checkpoint_key:
+                await loop.run_in_executor(
+                    pool, release_checkpoint, checkpoint, job.checkpoint_key, session
+                )
+            async with job.lock:
+                in_flight.pop(id(job), None)
+                await backend.delete(job.message)
+        except Exception as exc:
+            job.note = str(exc)
+            _finish(job, ok=False)
+            return None
+        finally:
+            if job.sidecar_dir:
+                shutil.rmtree(job.sidecar_dir, ignore_errors=True)
+        _finish(job, ok=True)
+        return None
+
+    pool = ThreadPoolExecutor(max_workers=settings.compute, thread_name_prefix="classify")
+    ticker = asyncio.create_task(_heartbeat())
+    renewer = asyncio.create_task(_renew())
+    try:
+        await asyncio.gather(
+            _receive(),
+            _run_stage("download", received, downloaded, settings.prefetch, settings.compute, _download),
+            _run_stage("compute", downloaded, computed, settings.compute, settings.uploads, _compute),
+            _run_stage("upload", computed, None, settings.uploads, 0, _upload),
+        )
+    finally:
+        ticker.cancel()
+        renewer.cancel()
+        pool.shutdown(wait=True)
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import json
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Generic, Iterable, List, Optional, Sequence, TypeVar
+
+import numpy as np
+
+from .embedding import Embedder
+from .intent import VALID_LEVEL3, IntentClassifier, IntentResult
+from .metrics import EXTERNAL_TOKENS, external_call
+from .tokens import estimate_tokens, truncate_to_tokens
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclass
+class _Pending(Generic[T, R]):
+    items: List[T]
+    done: threading.Event = field(default_factory=threading.Event)
+    results: List[R] = field(default_factory=list)
+    error: Optional[BaseException] = None
+
+
+class MicroBatcher(Generic[T, R]):
+    # Coalesces concurrent submit() calls into combined fn() calls. A request
+    # arriving while traffic is light goes out immediately; once requests
+    # overlap, dispatchers linger up to max_wait (or max_items) to fill a batch.
+
+    def __init__(
+        self,
+        fn: Callable[[List[T]], Sequence[R]],
+        max_items: int = 64,
+        max_wait: float = 0.05,
+        dispatchers: int = 2,
+    ) -> None:
+        self.fn = fn
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._queue: "queue.Queue[Optional[_Pending[T, R]]]" = queue.Queue()
+        self._busy = False
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True) for _ in range(max(1, dispatchers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, items: Iterable[T]) -> List[R]:
+        pending: _Pending[T, R] = _Pending(items=list(items))
+        if not pending.items:
+            return []
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.results
+
+    def close(self) -> None:
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def _collect(self, first: _Pending[T, R]) -> tuple[List[_Pending[T, R]], bool]:
+        batch = [first]
+        count = len(first.items)
+        linger = self._busy and self.max_wait > 0
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_items:
+            try:
+                if linger:
+                    nxt = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                else:
+                    nxt = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is None:
+                return batch, True
+            batch.append(nxt)
+            count += len(nxt.items)
+        return batch, False
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch, stop = self._collect(first)
+            self._busy = len(batch) > 1 or not self._queue.empty()
+            self._dispatch(batch)
+            if stop:
+                return
+
+    def _dispatch(self, batch: List[_Pending[T, R]]) -> None:
+        items: List[T] = [item for pending in batch for item in pending.items]
+        try:
+            results = list(self.fn(items))
+        except BaseException as exc:  # noqa: BLE001 - handed back to every caller
+            for pending in batch:
+                pending.error = exc
+                pending.done.set()
+            return
+        self.batches += 1
+        self.items += len(items)
+        offset = 0
+        for pending in batch:
+            pending.results = results[offset : offset + len(pending.items)]
+            offset += len(pending.items)
+            pending.done.set()
+
+
+class BatchingEmbedder(Embedder):
+    def __init__(self, inner: Embedder, max_items: int = 64, max_wait: float = 0.05) -> None:
+        self.inner = inner
+        self._batcher: MicroBatcher[str, Any] = MicroBatcher(
+            lambda texts: list(self.inner.embed(texts)), max_items=max_items, max_wait=max_wait
+        )
+
+    def embed(self, texts: Iterable[str]) -> np.ndarray:
+        return np.array(self._batcher.submit(texts), dtype=np.float32)
+
+
+class BatchingIntentClassifier(IntentClassifier):
+    def __init__(
+        self, embedder: Optional[Embedder] = None, max_items: int = 16, max_wait: float = 0.05
+    ) -> None:
+        super().__init__(embedder=embedder)
+        # Threads coalesced from concurrent messages are packed this many to a
+        # chat prompt. Each keeps the full INTENT_MAX_TOKENS budget, so a prompt
+        # is up to llm_batch_size times longer than a single-thread call.
+        self.llm_batch_size = max(1, int(os.getenv("AZURE_OPENAI_INTENT_BATCH_SIZE", "8")))
+        self._batcher: MicroBatcher[str, Optional[IntentResult]] = MicroBatcher(
+            self._llm_packed, max_items=max_items, max_wait=max_wait
+        )
+
+    def _llm_batch(self, texts: Sequence[str]) -> List[IntentResult | None]:
+        if len(texts) == 1:
+            return [self._llm(texts[0])]
+        client = self._client()
+        prompt = (
+            "Classify the intent of each numbered email thread. "
+            'Return JSON only: {"results": [{"index": <number>, "level3": ..., '
+            '"confidence": ...}]} with one entry per thread. '
+            f"Valid level3 values: {VALID_LEVEL3}."
+        )
+        user = "\n\n".join(
+            f"### {idx}\n{truncate_to_tokens(text, self.max_tokens)}"
+            for idx, text in enumerate(texts)
+        )
+        EXTERNAL_TOKENS.inc(estimate_tokens(user), api="chat")
+        with external_call("chat"):
+            response = client.chat.completions.create(
+                model=self.deployment,
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": user},
+                ],
+                temperature=0,
+                response_format={"type": "json_object"},
+            )
+        content = response.choices[0].message.content or "{}"
+        results: List[IntentResult | None] = [None] * len(texts)
+        for item in json.loads(content).get("results", []):
+            # Models sometimes return the index as a string ("3").
+            try:
+                idx = int(item.get("index"))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= idx < len(texts):
+                results[idx] = IntentResult(
+                    level3=item.get("level3", "requires_review"),
+                    confidence=float(item.get("confidence", 0.5)),
+                )
+        # Anything the model skipped is retried on its own.
+        return [res if res is not None else self._llm(text) for res, text in zip(results, texts)]
+
+    def _llm_packed(self, texts: List[str]) -> List[IntentResult | None]:
+        results: List[IntentResult | None] = []
+        for start in range(0, len(texts), self.llm_batch_size):
+            results.extend(self._llm_batch(texts[start : start + self.llm_batch_size]))
+        return results
+
+    def _llm_many(self, texts: Sequence[str]) -> List[IntentResult | None]:
+        if not self._llm_enabled():
+            return [None] * len(texts)
+        return self._batcher.submit(texts)
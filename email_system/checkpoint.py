@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+import pickle
+import shutil
+from pathlib import Path
+from typing import Any, Callable, Optional, Tuple
+
+from .io import EmailSource
+
+STAGES = ("cleaned", "conversations", "embeddings", "clusters", "intents")
+
+
+class CheckpointStore:
+    # With a secret, stage pickles are prefixed with an HMAC-SHA256 of their
+    # bytes and anything that fails verification is ignored, so whoever can
+    # write to the store cannot make load() unpickle arbitrary data.
+    secret: Optional[bytes] = None
+
+    def _dumps(self, value: Any) -> bytes:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.secret is None:
+            return data
+        return hmac.new(self.secret, data, hashlib.sha256).digest() + data
+
+    def _loads(self, blob: bytes, name: str) -> Optional[Any]:
+        if self.secret is not None:
+            digest, blob = blob[:32], blob[32:]
+            if not hmac.compare_digest(digest, hmac.new(self.secret, blob, hashlib.sha256).digest()):
+                print(f"Ignoring checkpoint with a bad signature: {name}")
+                return None
+        return pickle.loads(blob)
+
+    def load(self, key: str, stage: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def save(self, key: str, stage: str, value: Any) -> None:
+        raise NotImplementedError
+
+    def clear(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class LocalCheckpointStore(CheckpointStore):
+    def __init__(self, directory: str | Path, secret: Optional[bytes] = None) -> None:
+        self.directory = Path(directory)
+        self.secret = secret or None
+
+    def _path(self, key: str, stage: str) -> Path:
+        return self.directory / key / f"{stage}.pkl"
+
+    def load(self, key: str, stage: str) -> Optional[Any]:
+        path = self._path(key, stage)
+        if not path.exists():
+            return None
+        return self._loads(path.read_bytes(), str(path))
+
+    def save(self, key: str, stage: str, value: Any) -> None:
+        path = self._path(key, stage)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(self._dumps(value))
+        tmp.replace(path)
+
+    def clear(self, key: str) -> None:
+        shutil.rmtree(self.directory / key, ignore_errors=True)
+
+
+class BlobCheckpointStore(CheckpointStore):
+    # Stores artifacts as "<prefix>/<key>/<stage>.pkl" in a blob container
+    # (any azure.storage.blob ContainerClient). The container is shared, so
+    # a signing secret is required.
+    def __init__(self, container: Any, secret: bytes, prefix: str = "checkpoints") -> None:
+        if not secret:
+            raise ValueError("BlobCheckpointStore requires a signing secret.")
+        self.container = container
+        self.secret = secret
+        self.prefix = prefix.strip("/")
+
+    def _name(self, key: str, stage: str) -> str:
+        return f"{self.prefix}/{key}/{stage}.pkl"
+
+    def load(self, key: str, stage: str) -> Optional[Any]:
+        from azure.core.exceptions import ResourceNotFoundError
+
+        name = self._name(key, stage)
+        try:
+            data = self.container.download_blob(name).readall()
+        except ResourceNotFoundError:
+            return None
+        return self._loads(data, name)
+
+    def save(self, key: str, stage: str, value: Any) -> None:
+        self.container.upload_blob(self._name(key, stage), self._dumps(value), overwrite=True)
+
+    def clear(self, key: str) -> None:
+        for stage in STAGES:
+            self.container.delete_blobs(self._name(key, stage), raise_on_any_failure=False)
+
+
+def content_key(source: EmailSource) -> Tuple[str, EmailSource]:
+    # Hashes the input content and returns a source that can still be read,
+    # since streams are consumed by hashing.
+    digest = hashlib.sha256()
+    if isinstance(source, (str, Path)):
+        path = Path(source)
+        files = sorted(path.glob("*.json")) if path.is_dir() else [path]
+        for file in files:
+            digest.update(file.name.encode("utf-8"))
+            digest.update(file.read_bytes())
+        return digest.hexdigest(), source
+    if hasattr(source, "read") and hasattr(source, "seek"):
+        # Seekable streams, e.g. spooled downloads, are hashed in chunks and
+        # rewound rather than read into memory.
+        while True:
+            chunk = source.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+        source.seek(0)
+        return digest.hexdigest(), source
+    if hasattr(source, "read"):
+        source = source.read()
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    if isinstance(source, (bytes, bytearray)):
+        digest.update(source)
+        return digest.hexdigest(), source
+    source = list(source)
+    digest.update(pickle.dumps(source, protocol=pickle.HIGHEST_PROTOCOL))
+    return digest.hexdigest(), source
+
+
+def run_stage(
+    store: Optional[CheckpointStore], key: str, stage: str, compute: Callable[[], Any]
+) -> Any:
+    if store is not None:
+        cached = store.load(key, stage)
+        if cached is not None:
+            return cached
+    value = compute()
+    if store is not None:
+        store.save(key, stage, value)
+    return value
@@ -3,14 +3,9 @@ from __future__ import annotations
 import re
 from typing import Iterable, List, Tuple
 
-from langdetect import detect, DetectorFactory
-from langdetect.lang_detect_exception import LangDetectException
-
 from .models import EmailRecord
 from .utils import normalize_text
 
-DetectorFactory.seed = 0
-
 SPAM_KEYWORDS_EN = {
     "casino",
     "betting",
@@ -49,6 +44,11 @@ QUOTE_PATTERNS = [
 def detect_language(text: str) -> str | None:
     if not text.strip():
         return None
+    # langdetect loads its language profiles on import; defer it to first use.
+    from langdetect import DetectorFactory, detect
+    from langdetect.lang_detect_exception import LangDetectException
+
+    DetectorFactory.seed = 0
     try:
         lang = detect(text)
     except LangDetectException:
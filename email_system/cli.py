@@ -1,21 +1,190 @@
 from __future__ import annotations
 
+import json
 from pathlib import Path
+from typing import List
 
 import typer
 
-from .io import save_output
-from .pipeline import run_pipeline
+from .checkpoint import LocalCheckpointStore, content_key
+from .io import OUTPUT_FORMATS, output_suffix, save_output
+from .pipeline import PipelineSession, release_checkpoint, run_pipeline
+from .sidecar import sidecar_base
 
 app = typer.Typer(add_completion=False, help="Automatic email categorization pipeline.")
 
 
+def _check_format(output_format: str) -> None:
+    if output_format not in OUTPUT_FORMATS:
+        raise typer.BadParameter(f"must be one of {', '.join(OUTPUT_FORMATS)}", param_hint="--format")
+
+
 @app.command()
 def run(
     input_path: str = typer.Argument(..., help="Path to JSON file or directory of JSON files."),
     output_path: str = typer.Argument(..., help="Path to write the output JSON."),
+    output_format: str = typer.Option(
+        "json", "--format", help="Output format: json (indented), compact or ndjson."
+    ),
+    compress: bool = typer.Option(False, "--gzip", help="Gzip-compress the output."),
+    cluster_model: str = typer.Option(
+        "", "--cluster-model", help="Save the fitted cluster model here (used by /classify)."
+    ),
+    checkpoint_dir: str = typer.Option(
+        "", "--checkpoint-dir", help="Checkpoint each stage here and resume interrupted runs."
+    ),
+    embeddings_sidecar: bool = typer.Option(
+        False,
+        "--embeddings-sidecar",
+        help="Also write embeddings, ids and cluster labels next to the output.",
+    ),
 ) -> None:
-    payload = run_pipeline(input_path)
-    save_output(output_path, payload)
+    _check_format(output_format)
+    checkpoint = LocalCheckpointStore(checkpoint_dir) if checkpoint_dir else None
+    key = content_key(input_path)[0] if checkpoint is not None else ""
+    session = PipelineSession.create()
+    payload = run_pipeline(
+        input_path,
+        session=session,
+        cluster_model_path=cluster_model or None,
+        checkpoint=checkpoint,
+        sidecar=sidecar_base(output_path) if embeddings_sidecar else None,
+        clear_checkpoint=False,
+        checkpoint_key=key,
+    )
+    save_output(output_path, payload, fmt=output_format, compress=compress)
+    if checkpoint is not None:
+        # Cleared only once the output is on disk, so a failed write can resume.
+        release_checkpoint(checkpoint, key, session)
     typer.echo(f"Wrote results to {Path(output_path).resolve()}")
 
+
+@app.command()
+def recluster(
+    sidecar_path: str = typer.Argument(..., help="Embeddings sidecar (or the run's output path)."),
+    output_path: str = typer.Argument(..., help="Path to write cluster assignments as JSON."),
+    min_cluster_size: int = typer.Option(5, "--min-cluster-size", help="HDBSCAN min_cluster_size."),
+    min_samples: int = typer.Option(0, "--min-samples", help="HDBSCAN min_samples (0: default)."),
+    sample_size: int = typer.Option(
+        0, "--sample-size", help="Fit on a sample of this size and assign the rest (0: fit all)."
+    ),
+    cluster_model: str = typer.Option(
+        "", "--cluster-model", help="Save the fitted cluster model here (used by /classify)."
+    ),
+) -> None:
+    # Re-runs clustering on stored embeddings; no embedding API calls are made.
+    from .cluster import cluster_embeddings, cluster_out_of_core, save_cluster_model
+    from .eval import evaluate_clusters
+    from .pipeline import EVAL_SAMPLE_SIZE
+    from .sidecar import open_sidecar
+
+    sidecar = open_sidecar(sidecar_path)
+    settings = {"min_cluster_size": min_cluster_size, "min_samples": min_samples or None}
+    sampled = 0 < sample_size < len(sidecar.texts)
+    if sampled:
+        result = cluster_out_of_core(
+            sidecar.texts, sidecar.embeddings, sample_size=sample_size, **settings
+        )
+    else:
+        result = cluster_embeddings(sidecar.texts, sidecar.embeddings[:], **settings)
+    if cluster_model:
+        save_cluster_model(cluster_model, result)
+
+    labels = [int(label) for label in result.labels]
+    payload = {
+        "summary": {
+            "conversations": len(labels),
+            "clusters": len(result.level2_map),
+            "outliers": labels.count(-1),
+            **settings,
+            **evaluate_clusters(sidecar.embeddings, labels, EVAL_SAMPLE_SIZE if sampled else None),
+        },
+        "conversations": [
+            {
+                "conversation_id": conversation_id,
+                "cluster": label,
+                "level1": result.level1_map.get(label, result.outlier_label),
+                "level2": result.level2_map.get(label, result.outlier_label),
+            }
+            for conversation_id, label in zip(sidecar.conversation_ids, labels)
+        ],
+    }
+    save_output(output_path, payload)
+    typer.echo(json.dumps(payload["summary"]))
+
+
+@app.command()
+def evaluate(
+    sidecar_path: str = typer.Argument(..., help="Embeddings sidecar (or the run's output path)."),
+    labels_path: str = typer.Option(
+        "", "--labels", help="Score labels from a recluster output instead of the stored ones."
+    ),
+    sample_size: int = typer.Option(0, "--sample-size", help="Score a sample (0: all rows)."),
+) -> None:
+    from .eval import evaluate_clusters
+    from .sidecar import open_sidecar
+
+    sidecar = open_sidecar(sidecar_path)
+    labels = sidecar.clusters
+    if labels_path:
+        assigned = {
+            row["conversation_id"]: row["cluster"]
+            for row in json.loads(Path(labels_path).read_text(encoding="utf-8"))["conversations"]
+        }
+        labels = [assigned.get(conversation_id, -1) for conversation_id in sidecar.conversation_ids]
+    metrics = evaluate_clusters(sidecar.embeddings, labels, sample_size or None)
+    typer.echo(json.dumps({"conversations": len(labels), **metrics}))
+
+
+@app.command("run-many")
+def run_many(
+    inputs: List[str] = typer.Argument(None, help="Input files or glob patterns."),
+    manifest: str = typer.Option(
+        "", "--manifest", help="Manifest file: JSON list or one 'input [output]' per line."
+    ),
+    output_dir: str = typer.Option("outputs", "--output-dir", help="Directory for outputs."),
+    workers: int = typer.Option(0, "--workers", help="Worker processes (default: CPU count)."),
+    cache_dir: str = typer.Option(
+        ".embedding-cache", "--cache-dir", help="Embedding cache shared by all workers."
+    ),
+    output_format: str = typer.Option(
+        "json", "--format", help="Output format: json (indented), compact or ndjson."
+    ),
+    compress: bool = typer.Option(False, "--gzip", help="Gzip-compress the outputs."),
+) -> None:
+    from tqdm import tqdm
+
+    from .runner import check_unique_outputs, expand_inputs, load_manifest, run_jobs
+
+    _check_format(output_format)
+    suffix = output_suffix(output_format, compress)
+    jobs = expand_inputs(inputs or [], Path(output_dir), suffix)
+    if manifest:
+        jobs.extend(load_manifest(manifest, Path(output_dir), suffix))
+    if not jobs:
+        raise typer.BadParameter("no inputs given", param_hint="INPUTS / --manifest")
+    try:
+        check_unique_outputs(jobs)
+    except ValueError as exc:
+        raise typer.BadParameter(str(exc), param_hint="INPUTS / --manifest") from exc
+
+    with tqdm(total=len(jobs), unit="input") as progress:
+
+        def _on_result(result) -> None:
+            progress.update(1)
+            if result.error:
+                progress.write(f"FAILED {result.job.input_path}: {result.error}")
+
+        report = run_jobs(
+            jobs,
+            workers=workers or None,
+            cache_dir=cache_dir or None,
+            fmt=output_format,
+            compress=compress,
+            on_result=_on_result,
+        )
+
+    for key, value in report.summary().items():
+        typer.echo(f"{key}: {value}")
+    if report.failed:
+        raise typer.Exit(code=1)
@@ -1,12 +1,25 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Dict, List, Tuple
+import multiprocessing
+import os
+import pickle
+import random
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
 
-import hdbscan
 import numpy as np
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.feature_extraction.text import TfidfVectorizer
+from numpy.lib.format import open_memmap
+
+from .models import Conversation
+
+# hdbscan and scikit-learn are imported where they are used so that importing
+# the pipeline (CLI, webapp health checks) stays fast.
+
+T = TypeVar("T")
 
 
 @dataclass
@@ -15,9 +28,88 @@ class ClusterResult:
     level1_map: Dict[int, str]
     level2_map: Dict[int, str]
     outlier_label: str = "needs_review"
+    clusterer: Optional[Any] = field(default=None, repr=False)
+    # Unit centroids in sorted(level2_map) order; used to assign new
+    # embeddings when there is no single fitted clusterer (sharded runs).
+    centroids: Optional[np.ndarray] = field(default=None, repr=False)
+    # Per centroid, the lowest cosine similarity any fitted member had to it;
+    # rows scoring below their nearest centroid's floor are outliers.
+    centroid_floors: Optional[np.ndarray] = field(default=None, repr=False)
+
+
+# How out-of-core runs label rows outside the fit sample: "approximate"
+# runs HDBSCAN's approximate_predict per chunk, "centroid" takes the nearest
+# cluster centroid, which is much cheaper per row.
+ASSIGN_METHODS = ("approximate", "centroid")
+
+
+@dataclass
+class OutOfCoreSettings:
+    mode: str = "auto"
+    threshold: int = 100000
+    sample_size: int = 20000
+    chunk_size: int = 10000
+    store_dir: Optional[str] = None
+    assign_method: str = "approximate"
+
+    @classmethod
+    def from_env(cls) -> "OutOfCoreSettings":
+        assign_method = os.getenv("CLUSTER_ASSIGN_METHOD", "approximate")
+        if assign_method not in ASSIGN_METHODS:
+            raise ValueError(f"CLUSTER_ASSIGN_METHOD must be one of {', '.join(ASSIGN_METHODS)}")
+        return cls(
+            mode=os.getenv("CLUSTER_MODE", "auto"),
+            threshold=int(os.getenv("CLUSTER_OUT_OF_CORE_THRESHOLD", "100000")),
+            sample_size=int(os.getenv("CLUSTER_SAMPLE_SIZE", "20000")),
+            chunk_size=int(os.getenv("CLUSTER_CHUNK_SIZE", "10000")),
+            store_dir=os.getenv("CLUSTER_STORE_DIR") or None,
+            assign_method=assign_method,
+        )
+
+    def enabled_for(self, count: int) -> bool:
+        if self.mode == "out_of_core":
+            return True
+        return self.mode == "auto" and count > self.threshold
+
+
+SHARD_KEYS = ("language", "sender_domain")
+
+
+@dataclass
+class ShardSettings:
+    keys: Tuple[str, ...] = ()
+    min_shard_size: int = 50
+    workers: int = 0
+
+    @classmethod
+    def from_env(cls) -> "ShardSettings":
+        raw = os.getenv("CLUSTER_SHARD_BY", "")
+        keys = tuple(key.strip() for key in raw.split(",") if key.strip())
+        unknown = [key for key in keys if key not in SHARD_KEYS]
+        if unknown:
+            raise ValueError(f"CLUSTER_SHARD_BY keys must be in {', '.join(SHARD_KEYS)}")
+        return cls(
+            keys=keys,
+            min_shard_size=int(os.getenv("CLUSTER_MIN_SHARD_SIZE", "50")),
+            workers=int(os.getenv("CLUSTER_SHARD_WORKERS", "0")),
+        )
+
+
+def shard_key(convo: Conversation, keys: Sequence[str]) -> str:
+    parts = []
+    for key in keys:
+        if key == "language":
+            languages = (email.raw.get("language") for email in convo.emails)
+            value = next((language for language in languages if language), None)
+        else:
+            value = convo.metadata.get(key)
+        parts.append(str(value or "unknown"))
+    return "|".join(parts)
 
 
 def _extract_keywords(texts: List[str], top_k: int = 4) -> List[str]:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
     vectorizer = TfidfVectorizer(stop_words="english", max_features=1000)
     tfidf = vectorizer.fit_transform(texts)
     scores = tfidf.mean(axis=0).A1
@@ -29,38 +121,309 @@ def _extract_keywords(texts: List[str], top_k: int = 4) -> List[str]:
 def _cluster_level1(centroids: np.ndarray) -> List[int]:
     if len(centroids) <= 2:
         return [0 for _ in range(len(centroids))]
+    from sklearn.cluster import AgglomerativeClustering
+
     n_level1 = max(2, int(round(len(centroids) ** 0.5)))
     model = AgglomerativeClustering(n_clusters=n_level1)
     return model.fit_predict(centroids).tolist()
 
 
-def cluster_embeddings(texts: List[str], embeddings: np.ndarray) -> ClusterResult:
+def _name_clusters(
+    texts: Sequence[str], labels: List[int]
+) -> Tuple[Dict[int, str], Dict[int, str]]:
+    # Returns level-2 names and the keyword text used for level-1 names.
+    level2_map: Dict[int, str] = {}
+    keyword_texts: Dict[int, str] = {}
+    for cluster_id in sorted(set(label for label in labels if label != -1)):
+        members = [texts[i] for i, label in enumerate(labels) if label == cluster_id]
+        keywords = _extract_keywords(members)
+        level2_map[cluster_id] = "-".join(keywords) if keywords else f"cluster-{cluster_id}"
+        keyword_texts[cluster_id] = " ".join(keywords) if keywords else "general"
+    return level2_map, keyword_texts
+
+
+def _centroids(embeddings: np.ndarray, labels: Sequence[int], clusters: List[int]) -> np.ndarray:
+    label_arr = np.asarray(labels)
+    return np.vstack([embeddings[label_arr == cluster_id].mean(axis=0) for cluster_id in clusters])
+
+
+def _unit_centroids(
+    embeddings: np.ndarray, labels: Sequence[int], clusters: List[int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    centroids = _centroids(embeddings, labels, clusters)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-8
+    label_arr = np.asarray(labels)
+    floors = []
+    for row, cluster_id in enumerate(clusters):
+        members = embeddings[label_arr == cluster_id]
+        members = members / (np.linalg.norm(members, axis=1, keepdims=True) + 1e-8)
+        floors.append(float((members @ centroids[row]).min()))
+    return centroids, np.array(floors, dtype=np.float32)
+
+
+def _level1_map(
+    embeddings: np.ndarray, labels: List[int], keyword_texts: Dict[int, str]
+) -> Dict[int, str]:
+    clusters = sorted(keyword_texts)
+    if not clusters:
+        return {}
+    level1_ids = _cluster_level1(_centroids(embeddings, labels, clusters))
+    return {
+        cluster_id: f"process-{level1_id}:{keyword_texts[cluster_id]}"
+        for cluster_id, level1_id in zip(clusters, level1_ids)
+    }
+
+
+def _fit_hdbscan(
+    embeddings: np.ndarray, min_cluster_size: int = 5, min_samples: Optional[int] = None
+) -> Tuple[List[int], Any]:
+    import hdbscan
+
+    clusterer = hdbscan.HDBSCAN(
+        min_cluster_size=min_cluster_size, min_samples=min_samples, prediction_data=True
+    )
+    return clusterer.fit_predict(embeddings).tolist(), clusterer
+
+
+def cluster_embeddings(
+    texts: List[str],
+    embeddings: np.ndarray,
+    min_cluster_size: int = 5,
+    min_samples: Optional[int] = None,
+) -> ClusterResult:
     if len(embeddings) < 5:
         labels = [0 for _ in range(len(embeddings))]
         level2_map = {0: "small-batch"}
         level1_map = {0: "process-0:small-batch"}
         return ClusterResult(labels=labels, level1_map=level1_map, level2_map=level2_map)
 
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=5, prediction_data=True)
-    labels = clusterer.fit_predict(embeddings).tolist()
+    labels, clusterer = _fit_hdbscan(embeddings, min_cluster_size, min_samples)
+    level2_map, keyword_texts = _name_clusters(texts, labels)
+    level1_map = _level1_map(embeddings, labels, keyword_texts)
+    return ClusterResult(
+        labels=labels, level1_map=level1_map, level2_map=level2_map, clusterer=clusterer
+    )
+
+
+def _cluster_shard(
+    texts: List[str], embeddings: np.ndarray
+) -> Tuple[List[int], Dict[int, str], Dict[int, str]]:
+    if len(embeddings) < 5:
+        labels = [0 for _ in range(len(embeddings))]
+        return labels, {0: "small-batch"}, {0: "small-batch"}
+    labels, _ = _fit_hdbscan(embeddings)
+    level2_map, keyword_texts = _name_clusters(texts, labels)
+    return labels, level2_map, keyword_texts
+
+
+_SHARD_POOL: Optional[ProcessPoolExecutor] = None
+_SHARD_POOL_LOCK = threading.Lock()
 
+
+def _shard_pool(workers: int) -> ProcessPoolExecutor:
+    # One spawn-context pool per process, created on first use and shared by
+    # every caller. Forking from the multi-threaded worker is unsafe, and a
+    # pool per message would multiply processes by WORKER_CONCURRENCY.
+    global _SHARD_POOL
+    with _SHARD_POOL_LOCK:
+        if _SHARD_POOL is None:
+            _SHARD_POOL = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _SHARD_POOL
+
+
+def cluster_sharded(
+    texts: List[str],
+    embeddings: np.ndarray,
+    shard_keys: Sequence[str],
+    min_shard_size: int = 50,
+    workers: int = 0,
+) -> ClusterResult:
+    # Clusters each shard (e.g. one language or sender domain) on its own,
+    # in parallel processes, then renumbers shard clusters into one id space.
+    # Level-1 groups are computed over all shard centroids, so they can
+    # still span shards. Shards below min_shard_size are pooled together.
+    groups: Dict[str, List[int]] = defaultdict(list)
+    for idx, key in enumerate(shard_keys):
+        groups[key].append(idx)
+    shards: List[List[int]] = []
+    pooled: List[int] = []
+    for key in sorted(groups):
+        if len(groups[key]) < min_shard_size:
+            pooled.extend(groups[key])
+        else:
+            shards.append(groups[key])
+    if pooled:
+        shards.append(sorted(pooled))
+    if len(shards) <= 1:
+        return cluster_embeddings(texts, embeddings)
+
+    shard_texts = [[texts[i] for i in members] for members in shards]
+    shard_embeddings = [embeddings[members] for members in shards]
+    workers = workers or os.cpu_count() or 1
+    if workers > 1:
+        pool = _shard_pool(workers)
+        fitted = list(pool.map(_cluster_shard, shard_texts, shard_embeddings))
+    else:
+        fitted = [_cluster_shard(*args) for args in zip(shard_texts, shard_embeddings)]
+
+    labels = [-1 for _ in range(len(texts))]
     level2_map: Dict[int, str] = {}
-    level1_map: Dict[int, str] = {}
-
-    clusters = sorted(set(label for label in labels if label != -1))
-    if clusters:
-        centroid_texts: List[str] = []
-        centroids: List[np.ndarray] = []
-        for cluster_id in clusters:
-            members = [texts[i] for i, label in enumerate(labels) if label == cluster_id]
-            keywords = _extract_keywords(members)
-            level2_map[cluster_id] = "-".join(keywords) if keywords else f"cluster-{cluster_id}"
-            centroid = embeddings[[i for i, label in enumerate(labels) if label == cluster_id]].mean(axis=0)
-            centroids.append(centroid)
-            centroid_texts.append(" ".join(keywords) if keywords else "general")
-
-        level1_ids = _cluster_level1(np.vstack(centroids))
-        for cluster_id, level1_id, keywords in zip(clusters, level1_ids, centroid_texts):
-            level1_map[cluster_id] = f"process-{level1_id}:{keywords}"
-
-    return ClusterResult(labels=labels, level1_map=level1_map, level2_map=level2_map)
+    keyword_texts: Dict[int, str] = {}
+    offset = 0
+    for members, (shard_labels, shard_level2, shard_keywords) in zip(shards, fitted):
+        for idx, label in zip(members, shard_labels):
+            if label != -1:
+                labels[idx] = label + offset
+        for cluster_id, name in shard_level2.items():
+            level2_map[cluster_id + offset] = name
+            keyword_texts[cluster_id + offset] = shard_keywords[cluster_id]
+        offset += max(shard_level2, default=-1) + 1
+
+    centroids = floors = None
+    if level2_map:
+        centroids, floors = _unit_centroids(embeddings, labels, sorted(level2_map))
+    return ClusterResult(
+        labels=labels,
+        level1_map=_level1_map(embeddings, labels, keyword_texts),
+        level2_map=level2_map,
+        centroids=centroids,
+        centroid_floors=floors,
+    )
+
+
+def save_cluster_model(path: str | Path, result: ClusterResult) -> None:
+    state = {
+        "clusterer": result.clusterer,
+        "centroids": result.centroids,
+        "centroid_floors": result.centroid_floors,
+        "level1_map": result.level1_map,
+        "level2_map": result.level2_map,
+        "outlier_label": result.outlier_label,
+    }
+    with open(path, "wb") as handle:
+        pickle.dump(state, handle)
+
+
+def load_cluster_model(path: str | Path) -> ClusterResult:
+    with open(path, "rb") as handle:
+        state = pickle.load(handle)
+    return ClusterResult(
+        labels=[],
+        level1_map=state["level1_map"],
+        level2_map=state["level2_map"],
+        outlier_label=state["outlier_label"],
+        clusterer=state["clusterer"],
+        centroids=state.get("centroids"),
+        centroid_floors=state.get("centroid_floors"),
+    )
+
+
+def assign_clusters(model: ClusterResult, embeddings: np.ndarray) -> ClusterResult:
+    if len(embeddings) == 0:
+        labels: List[int] = []
+    elif model.clusterer is None and model.centroids is not None:
+        labels = _nearest_centroid(
+            model, model.centroids, np.asarray(embeddings, dtype=np.float32), model.centroid_floors
+        )
+    elif model.clusterer is None:
+        # Small-batch models have no HDBSCAN fit; everything maps to their single cluster.
+        default = 0 if 0 in model.level2_map else -1
+        labels = [default for _ in range(len(embeddings))]
+    else:
+        import hdbscan
+
+        predicted, _ = hdbscan.approximate_predict(model.clusterer, embeddings)
+        labels = [int(label) for label in predicted]
+    return ClusterResult(
+        labels=labels,
+        level1_map=model.level1_map,
+        level2_map=model.level2_map,
+        outlier_label=model.outlier_label,
+        clusterer=model.clusterer,
+        centroids=model.centroids,
+        centroid_floors=model.centroid_floors,
+    )
+
+
+def reservoir_sample(items: Iterable[T], k: int, seed: int = 0) -> List[T]:
+    rng = random.Random(seed)
+    sample: List[T] = []
+    for idx, item in enumerate(items):
+        if idx < k:
+            sample.append(item)
+            continue
+        slot = rng.randint(0, idx)
+        if slot < k:
+            sample[slot] = item
+    return sample
+
+
+def _nearest_centroid(
+    model: ClusterResult,
+    centroids: np.ndarray,
+    block: np.ndarray,
+    floors: Optional[np.ndarray] = None,
+) -> List[int]:
+    clusters = np.array(sorted(model.level2_map))
+    norms = np.linalg.norm(block, axis=1, keepdims=True) + 1e-8
+    sims = (block / norms) @ centroids.T
+    best = np.argmax(sims, axis=1)
+    labels = clusters[best]
+    if floors is not None:
+        labels = np.where(sims[np.arange(len(block)), best] < floors[best], -1, labels)
+    return [int(label) for label in labels]
+
+
+def cluster_out_of_core(
+    texts: Sequence[str],
+    embeddings: np.ndarray,
+    sample_size: int = 20000,
+    chunk_size: int = 10000,
+    labels_path: Optional[str | Path] = None,
+    method: str = "approximate",
+    seed: int = 0,
+    min_cluster_size: int = 5,
+    min_samples: Optional[int] = None,
+) -> ClusterResult:
+    # Fits HDBSCAN and keyword naming on a reservoir sample, then assigns the
+    # full (typically memory-mapped) matrix chunk by chunk. Working memory for
+    # the embeddings is bounded by sample_size and chunk_size; texts and the
+    # int32 labels still scale with the corpus.
+    if method not in ASSIGN_METHODS:
+        raise ValueError(f"method must be one of {', '.join(ASSIGN_METHODS)}")
+    total = len(embeddings)
+    sample_idx = sorted(reservoir_sample(range(total), sample_size, seed))
+    sample = np.asarray(embeddings[sample_idx], dtype=np.float32)
+    fitted = cluster_embeddings(
+        [texts[i] for i in sample_idx],
+        sample,
+        min_cluster_size=min_cluster_size,
+        min_samples=min_samples,
+    )
+
+    centroids = floors = None
+    if method == "centroid" and fitted.level2_map:
+        centroids, floors = _unit_centroids(sample, fitted.labels, sorted(fitted.level2_map))
+
+    if labels_path is not None:
+        labels = open_memmap(labels_path, mode="w+", dtype=np.int32, shape=(total,))
+    else:
+        labels = np.empty(total, dtype=np.int32)
+    for start in range(0, total, chunk_size):
+        block = np.asarray(embeddings[start : start + chunk_size], dtype=np.float32)
+        if centroids is not None:
+            labels[start : start + len(block)] = _nearest_centroid(fitted, centroids, block, floors)
+        else:
+            labels[start : start + len(block)] = assign_clusters(fitted, block).labels
+    if labels_path is not None:
+        labels.flush()
+
+    return ClusterResult(
+        labels=labels,
+        level1_map=fitted.level1_map,
+        level2_map=fitted.level2_map,
+        outlier_label=fitted.outlier_label,
+        clusterer=fitted.clusterer,
+    )
@@ -1,11 +1,22 @@
 from __future__ import annotations
 
+import hashlib
 import os
-from dataclasses import dataclass
-from typing import Iterable, List
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
-import requests
+
+from .metrics import CACHE_HITS, CACHE_MISSES, EXTERNAL_TOKENS, external_call
+from .quantize import quantize_rows
+from .tokens import estimate_tokens, token_windows
+
+if TYPE_CHECKING:
+    import requests
 
 
 class Embedder:
@@ -19,23 +30,38 @@ class AzureOpenAIEmbedder(Embedder):
     api_key: str
     deployment: str
     api_version: str = "2024-02-15-preview"
+    batch_size: int = 16
+    _http: Optional[requests.Session] = field(default=None, init=False, repr=False)
+
+    def _session(self) -> requests.Session:
+        # One pooled session per embedder keeps TLS connections alive across calls.
+        if self._http is None:
+            import requests
+
+            self._http = requests.Session()
+            self._http.headers.update({"api-key": self.api_key})
+        return self._http
 
     def embed(self, texts: Iterable[str]) -> np.ndarray:
         url = (
             f"{self.endpoint.rstrip('/')}/openai/deployments/"
             f"{self.deployment}/embeddings?api-version={self.api_version}"
         )
+        texts = list(texts)
         vectors: List[List[float]] = []
-        for text in texts:
-            response = requests.post(
-                url,
-                headers={"api-key": self.api_key},
-                json={"input": text},
-                timeout=30,
-            )
-            response.raise_for_status()
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start : start + self.batch_size]
+            EXTERNAL_TOKENS.inc(sum(estimate_tokens(text) for text in batch), api="embeddings")
+            with external_call("embeddings"):
+                response = self._session().post(
+                    url,
+                    json={"input": batch},
+                    timeout=30,
+                )
+                response.raise_for_status()
             payload = response.json()
-            vectors.append(payload["data"][0]["embedding"])
+            rows = sorted(payload["data"], key=lambda row: row.get("index", 0))
+            vectors.extend(row["embedding"] for row in rows)
         return np.array(vectors, dtype=np.float32)
 
 
@@ -53,6 +79,154 @@ class MockEmbedder(Embedder):
         return np.array(rows, dtype=np.float32)
 
 
+class DiskEmbeddingCache:
+    # SQLite-backed cache that several processes can share; vectors are
+    # keyed by a hash of the embedder namespace and the text. Quantized
+    # dtypes get their own keys; int8 blobs carry a float32 scale prefix.
+    def __init__(self, directory: str | Path, namespace: str, dtype: str = "float32") -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / "embeddings.sqlite"
+        self.namespace = namespace if dtype == "float32" else f"{namespace}:{dtype}"
+        self.dtype = dtype
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        keyed = {self._key(text): text for text in texts}
+        keys = list(keyed)
+        found: Dict[str, np.ndarray] = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = self._conn().execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for key, blob in rows:
+                found[keyed[key]] = self._decode(blob)
+        return found
+
+    def _decode(self, blob: bytes) -> np.ndarray:
+        if self.dtype == "int8":
+            scale = np.frombuffer(blob[:4], dtype=np.float32)[0]
+            return np.frombuffer(blob[4:], dtype=np.int8).astype(np.float32) * scale
+        return np.frombuffer(blob, dtype=self.dtype).astype(np.float32)
+
+    def put_many(self, texts: List[str], vectors: np.ndarray) -> None:
+        data, scales = quantize_rows(vectors, self.dtype)
+        blobs = [row.tobytes() for row in data]
+        if scales is not None:
+            blobs = [scale.tobytes() + blob for scale, blob in zip(scales, blobs)]
+        rows = [(self._key(text), blob) for text, blob in zip(texts, blobs)]
+        with self._conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+
+
+def cache_namespace(embedder: Embedder) -> str:
+    detail = getattr(embedder, "deployment", None) or getattr(embedder, "dim", "")
+    return f"{type(embedder).__name__}:{detail}"
+
+
+class CachedEmbedder(Embedder):
+    # With a float16 or int8 dtype, cached rows are held quantized (an int8
+    # row keeps its scale alongside) and dequantized on lookup.
+    def __init__(
+        self,
+        inner: Embedder,
+        max_entries: int = 10000,
+        disk: Optional[DiskEmbeddingCache] = None,
+        dtype: str = "float32",
+    ) -> None:
+        self.inner = inner
+        self.max_entries = max_entries
+        self.disk = disk
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[str, Tuple[np.ndarray, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        entries: Dict[str, Tuple[np.ndarray, float]] = {}
+        with self._lock:
+            for text in texts:
+                entry = self._cache.get(text)
+                if entry is not None:
+                    self._cache.move_to_end(text)
+                    entries[text] = entry
+        return {
+            text: row if row.dtype == np.float32 else row.astype(np.float32) * scale
+            for text, (row, scale) in entries.items()
+        }
+
+    def _store(self, texts: List[str], vectors: np.ndarray) -> None:
+        data, scales = quantize_rows(vectors, self.dtype)
+        if self.dtype != "float32":
+            # Copy rows out so evicting one entry does not pin the whole batch.
+            data = [row.copy() for row in data]
+        with self._lock:
+            for idx, text in enumerate(texts):
+                self._cache[text] = (data[idx], float(scales[idx]) if scales is not None else 1.0)
+                self._cache.move_to_end(text)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def embed(self, texts: Iterable[str]) -> np.ndarray:
+        texts = list(texts)
+        found = self._lookup(texts)
+        missing = list(dict.fromkeys(text for text in texts if text not in found))
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        CACHE_HITS.inc(len(texts) - len(missing), cache="embedding")
+        CACHE_MISSES.inc(len(missing), cache="embedding")
+        if missing and self.disk is not None:
+            on_disk = self.disk.get_many(missing)
+            CACHE_HITS.inc(len(on_disk), cache="embedding_disk")
+            CACHE_MISSES.inc(len(missing) - len(on_disk), cache="embedding_disk")
+            if on_disk:
+                self._store(list(on_disk), np.array(list(on_disk.values())))
+                found.update(on_disk)
+                missing = [text for text in missing if text not in on_disk]
+        if missing:
+            vectors = self.inner.embed(missing)
+            self._store(missing, vectors)
+            if self.disk is not None:
+                self.disk.put_many(missing, vectors)
+            found.update(zip(missing, vectors))
+        return np.array([found[text] for text in texts], dtype=np.float32)
+
+
+def embed_pooled(embedder: Embedder, texts: List[str], window_tokens: int) -> np.ndarray:
+    # Texts over the window are split into windows that are embedded in one
+    # batch with everything else and mean-pooled back to a single vector.
+    windows: List[str] = []
+    owners: List[int] = []
+    for idx, text in enumerate(texts):
+        parts = token_windows(text, window_tokens) if estimate_tokens(text) > window_tokens else [text]
+        windows.extend(parts)
+        owners.extend([idx] * len(parts))
+    vectors = embedder.embed(windows)
+    if len(windows) == len(texts):
+        return vectors
+    pooled = np.zeros((len(texts), vectors.shape[1]), dtype=np.float32)
+    np.add.at(pooled, np.array(owners), vectors)
+    norms = np.linalg.norm(pooled, axis=1, keepdims=True) + 1e-8
+    return (pooled / norms).astype(np.float32)
+
+
 def build_embedder() -> Embedder:
     endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
     api_key = os.getenv("AZURE_OPENAI_API_KEY")
@@ -62,5 +236,6 @@ def build_embedder() -> Embedder:
             endpoint=endpoint,
             api_key=api_key,
             deployment=deployment,
+            batch_size=int(os.getenv("AZURE_OPENAI_EMBEDDINGS_BATCH_SIZE", "16")),
         )
     return MockEmbedder()
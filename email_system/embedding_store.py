@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .quantize import QuantizedEmbeddings, quantize_rows
+
+
+def _scales_path(path: Path) -> Path:
+    return path.with_name(f"{path.stem}.scales.npy")
+
+
+class EmbeddingStore:
+    # Append-only embedding matrix backed by a memory-mapped .npy file, so
+    # embeddings can be written chunk by chunk and read back without
+    # loading the whole corpus. int8 stores keep per-row scales in a
+    # "<stem>.scales.npy" file next to the data.
+    def __init__(self, path: str | Path, rows: int, dim: int, dtype: str = "float32") -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.dtype = dtype
+        self._data = open_memmap(self.path, mode="w+", dtype=np.dtype(dtype), shape=(rows, dim))
+        self._scales = None
+        if dtype == "int8":
+            self._scales = open_memmap(
+                _scales_path(self.path), mode="w+", dtype=np.float32, shape=(rows,)
+            )
+        self.size = 0
+
+    def append(self, block: np.ndarray) -> None:
+        data, scales = quantize_rows(block, self.dtype)
+        end = self.size + len(block)
+        self._data[self.size : end] = data
+        if self._scales is not None:
+            self._scales[self.size : end] = scales
+        self.size = end
+
+    def close(self) -> None:
+        self._data.flush()
+        del self._data
+        if self._scales is not None:
+            self._scales.flush()
+            self._scales = None
+
+
+def open_embeddings(path: str | Path) -> QuantizedEmbeddings:
+    path = Path(path)
+    scales_path = _scales_path(path)
+    scales = np.load(scales_path, mmap_mode="r") if scales_path.exists() else None
+    return QuantizedEmbeddings(np.load(path, mmap_mode="r"), scales)
+
+
+def store_nbytes(path: str | Path) -> int:
+    path = Path(path)
+    scales_path = _scales_path(path)
+    return path.stat().st_size + (scales_path.stat().st_size if scales_path.exists() else 0)
@@ -1,44 +1,93 @@
 from __future__ import annotations
 
 import math
-from typing import List
+from typing import Dict, List, Optional, Sequence
 
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
+from .quantize import BLOCK_ROWS, EmbeddingMatrix, iter_blocks
 
-def average_intra_cluster_similarity(embeddings: np.ndarray, labels: List[int]) -> float:
+
+def _unit(block: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    return block / np.where(norms > 0, norms, 1.0)
+
+
+def average_intra_cluster_similarity(
+    embeddings: EmbeddingMatrix, labels: List[int], block_rows: int = BLOCK_ROWS
+) -> float:
+    # The sum of pairwise cosine similarities in a cluster equals the squared
+    # norm of its summed unit vectors, so one pass over row blocks is enough.
+    label_arr = np.asarray(labels, dtype=np.int64)
+    clusters = sorted(label for label in set(label_arr.tolist()) if label != -1)
+    if not clusters:
+        return 0.0
+    slot = {label: idx for idx, label in enumerate(clusters)}
+    sums = None
+    for start, block in iter_blocks(embeddings, block_rows):
+        block_labels = label_arr[start : start + len(block)]
+        keep = block_labels != -1
+        if sums is None:
+            sums = np.zeros((len(clusters), block.shape[1]), dtype=np.float64)
+        slots = np.array([slot[label] for label in block_labels[keep].tolist()], dtype=np.int64)
+        if len(slots):
+            np.add.at(sums, slots, _unit(block[keep]))
+    sizes = np.array([(label_arr == label).sum() for label in clusters])
     total = 0.0
     count = 0
-    for label in set(labels):
-        if label == -1:
-            continue
-        idx = [i for i, l in enumerate(labels) if l == label]
-        if len(idx) < 2:
+    for idx, size in enumerate(sizes):
+        if size < 2:
             continue
-        sims = cosine_similarity(embeddings[idx])
-        total += (sims.sum() - len(idx)) / (len(idx) * (len(idx) - 1))
+        total += (float(sums[idx] @ sums[idx]) - size) / (size * (size - 1))
         count += 1
     return total / count if count else 0.0
 
 
-def dunn_index(embeddings: np.ndarray, labels: List[int]) -> float:
-    clusters = [label for label in set(labels) if label != -1]
-    if len(clusters) < 2:
+def dunn_index(
+    embeddings: EmbeddingMatrix, labels: List[int], block_rows: int = BLOCK_ROWS
+) -> float:
+    # Largest intra-cluster over smallest inter-cluster cosine distance,
+    # computed over pairs of row blocks instead of the full distance matrix.
+    label_arr = np.asarray(labels, dtype=np.int64)
+    if len(set(label_arr.tolist()) - {-1}) < 2:
         return 0.0
-    dist_matrix = 1 - cosine_similarity(embeddings)
     intra_max = 0.0
-    for label in clusters:
-        idx = [i for i, l in enumerate(labels) if l == label]
-        if len(idx) < 2:
-            continue
-        intra_max = max(intra_max, dist_matrix[np.ix_(idx, idx)].max())
     inter_min = math.inf
-    for i, label_a in enumerate(clusters):
-        idx_a = [i for i, l in enumerate(labels) if l == label_a]
-        for label_b in clusters[i + 1 :]:
-            idx_b = [i for i, l in enumerate(labels) if l == label_b]
-            inter_min = min(inter_min, dist_matrix[np.ix_(idx_a, idx_b)].min())
+    for row_start, rows in iter_blocks(embeddings, block_rows):
+        rows = _unit(rows)
+        row_labels = label_arr[row_start : row_start + len(rows)]
+        for col_start, cols in iter_blocks(embeddings, block_rows):
+            if col_start < row_start:
+                continue
+            dist = 1 - rows @ _unit(cols).T
+            col_labels = label_arr[col_start : col_start + len(cols)]
+            valid = (row_labels[:, None] != -1) & (col_labels[None, :] != -1)
+            same = row_labels[:, None] == col_labels[None, :]
+            if col_start == row_start:
+                same &= ~np.eye(len(rows), len(cols), dtype=bool)
+            intra = dist[valid & same]
+            if intra.size:
+                intra_max = max(intra_max, float(intra.max()))
+            inter = dist[valid & (row_labels[:, None] != col_labels[None, :])]
+            if inter.size:
+                inter_min = min(inter_min, float(inter.min()))
     if inter_min == math.inf or intra_max == 0.0:
         return 0.0
     return float(inter_min / intra_max)
+
+
+def evaluate_clusters(
+    embeddings: EmbeddingMatrix, labels: Sequence[int], sample_size: Optional[int] = None
+) -> Dict[str, float]:
+    # The Dunn index is quadratic, so large corpora can be scored on a sample.
+    labels = [int(label) for label in labels]
+    if sample_size is not None and len(labels) > sample_size:
+        from .cluster import reservoir_sample
+
+        sample = sorted(reservoir_sample(range(len(labels)), sample_size, seed=1))
+        embeddings = np.asarray(embeddings[sample])
+        labels = [labels[i] for i in sample]
+    return {
+        "avg_intra_cluster_similarity": round(average_intra_cluster_similarity(embeddings, labels), 3),
+        "dunn_index": round(dunn_index(embeddings, labels), 3),
+    }
@@ -2,14 +2,19 @@ from __future__ import annotations
 
 import json
 import os
+import re
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
 
 import numpy as np
 
-from openai import AzureOpenAI
-
 from .embedding import Embedder, build_embedder
+from .metrics import EXTERNAL_TOKENS, external_call
+from .quantize import EmbeddingMatrix, iter_blocks
+from .tokens import estimate_tokens, truncate_to_tokens
+
+if TYPE_CHECKING:
+    from openai import AzureOpenAI
 
 
 INTENT_KEYWORDS = {
@@ -29,6 +34,16 @@ INTENT_DESCRIPTIONS = {
     "requires_review": "Unclear intent; requires human review.",
 }
 
+VALID_LEVEL3 = (
+    "service_request, urgent_escalation, status_inquiry, "
+    "complaint, additional_info, requires_review"
+)
+
+KEYWORD_PATTERNS = {
+    label: re.compile("|".join(re.escape(word) for word in keywords))
+    for label, keywords in INTENT_KEYWORDS.items()
+}
+
 
 @dataclass
 class IntentResult:
@@ -42,21 +57,35 @@ class IntentClassifier:
         self.api_key = os.getenv("AZURE_OPENAI_API_KEY")
         self.deployment = os.getenv("AZURE_OPENAI_INTENT_DEPLOYMENT")
         self.api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
+        self.max_tokens = int(os.getenv("INTENT_MAX_TOKENS", "1500"))
         self.embedder = embedder or build_embedder()
         self._intent_embeddings = None
+        self._openai_client: AzureOpenAI | None = None
 
     def _client(self) -> AzureOpenAI:
-        return AzureOpenAI(
-            api_key=self.api_key,
-            azure_endpoint=self.endpoint,
-            api_version=self.api_version,
-        )
+        if self._openai_client is None:
+            from openai import AzureOpenAI
+
+            self._openai_client = AzureOpenAI(
+                api_key=self.api_key,
+                azure_endpoint=self.endpoint,
+                api_version=self.api_version,
+            )
+        return self._openai_client
+
+    def _llm_enabled(self) -> bool:
+        return bool(self.endpoint and self.api_key and self.deployment)
+
+    def warm(self) -> None:
+        self._ensure_intent_embeddings()
+        if self._llm_enabled():
+            self._client()
 
     def _rule_based(self, text: str) -> IntentResult:
         lowered = text.lower()
         matched: List[str] = []
-        for label, keywords in INTENT_KEYWORDS.items():
-            if any(word in lowered for word in keywords):
+        for label, pattern in KEYWORD_PATTERNS.items():
+            if pattern.search(lowered):
                 matched.append(label)
         if not matched:
             return IntentResult(level3="requires_review", confidence=0.4)
@@ -73,30 +102,37 @@ class IntentClassifier:
         return IntentResult(level3=matched[0], confidence=0.6)
 
     def _llm(self, text: str) -> IntentResult | None:
-        if not (self.endpoint and self.api_key and self.deployment):
+        if not self._llm_enabled():
             return None
         client = self._client()
         prompt = (
             "Classify the intent of this email thread. "
             "Return JSON only with keys: level3, confidence. "
-            "Valid level3 values: service_request, urgent_escalation, "
-            "status_inquiry, complaint, additional_info, requires_review."
-        )
-        response = client.chat.completions.create(
-            model=self.deployment,
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": text[:6000]},
-            ],
-            temperature=0,
-            response_format={"type": "json_object"},
+            f"Valid level3 values: {VALID_LEVEL3}."
         )
+        user = truncate_to_tokens(text, self.max_tokens)
+        EXTERNAL_TOKENS.inc(estimate_tokens(user), api="chat")
+        with external_call("chat"):
+            response = client.chat.completions.create(
+                model=self.deployment,
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": user},
+                ],
+                temperature=0,
+                response_format={"type": "json_object"},
+            )
         content = response.choices[0].message.content or "{}"
         data = json.loads(content)
         level3 = data.get("level3", "requires_review")
         confidence = float(data.get("confidence", 0.5))
         return IntentResult(level3=level3, confidence=confidence)
 
+    def _llm_many(self, texts: Sequence[str]) -> List[IntentResult | None]:
+        if not self._llm_enabled():
+            return [None] * len(texts)
+        return [self._llm(text) for text in texts]
+
     def _ensure_intent_embeddings(self) -> None:
         if self._intent_embeddings is not None:
             return
@@ -105,26 +141,53 @@ class IntentClassifier:
         norms = np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-8
         self._intent_embeddings = vectors / norms
 
-    def _embedding_based(self, text: str) -> IntentResult:
+    def _embedding_many(
+        self, texts: Sequence[str], embeddings: Optional[EmbeddingMatrix] = None
+    ) -> List[IntentResult]:
         self._ensure_intent_embeddings()
-        vector = self.embedder.embed([text])[0]
-        vector = vector / (np.linalg.norm(vector) + 1e-8)
-        sims = self._intent_embeddings @ vector
-        best_idx = int(np.argmax(sims))
-        best_label = list(INTENT_DESCRIPTIONS.keys())[best_idx]
-        confidence = float(max(0.5, sims[best_idx]))
-        if best_label == "requires_review":
-            confidence = min(confidence, 0.6)
-        return IntentResult(level3=best_label, confidence=confidence)
+        vectors = embeddings if embeddings is not None else self.embedder.embed(texts)
+        # Quantized matrices are dequantized one block at a time.
+        sims = np.vstack(
+            [
+                (block / (np.linalg.norm(block, axis=1, keepdims=True) + 1e-8))
+                @ self._intent_embeddings.T
+                for _, block in iter_blocks(vectors)
+            ]
+        )
+        labels = list(INTENT_DESCRIPTIONS.keys())
+        results: List[IntentResult] = []
+        for row in sims:
+            best_idx = int(np.argmax(row))
+            best_label = labels[best_idx]
+            confidence = float(max(0.5, row[best_idx]))
+            if best_label == "requires_review":
+                confidence = min(confidence, 0.6)
+            results.append(IntentResult(level3=best_label, confidence=confidence))
+        return results
+
+    def _embedding_based(self, text: str) -> IntentResult:
+        return self._embedding_many([text])[0]
+
+    def classify_many(
+        self, texts: Sequence[str], embeddings: Optional[EmbeddingMatrix] = None
+    ) -> List[IntentResult]:
+        if not texts:
+            return []
+        rule_results = [self._rule_based(text) for text in texts]
+        llm_results = self._llm_many(texts)
+        pending = [idx for idx, res in enumerate(llm_results) if res is None]
+        fallback: Dict[int, IntentResult] = {}
+        if pending:
+            subset = embeddings
+            if embeddings is not None and len(pending) < len(texts):
+                subset = embeddings[pending]
+            scored = self._embedding_many([texts[idx] for idx in pending], subset)
+            fallback = dict(zip(pending, scored))
+        results: List[IntentResult] = []
+        for idx, rule_result in enumerate(rule_results):
+            candidate = llm_results[idx] or fallback[idx]
+            results.append(candidate if candidate.confidence >= rule_result.confidence else rule_result)
+        return results
 
     def classify(self, text: str) -> IntentResult:
-        rule_result = self._rule_based(text)
-        llm_result = self._llm(text)
-        if llm_result is None:
-            embedding_result = self._embedding_based(text)
-            if embedding_result.confidence >= rule_result.confidence:
-                return embedding_result
-            return rule_result
-        if llm_result.confidence >= rule_result.confidence:
-            return llm_result
-        return rule_result
+        return self.classify_many([text])[0]
@@ -1,12 +1,26 @@
 from __future__ import annotations
 
+import gzip
 import json
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Iterable, List
+from typing import IO, Any, Dict, Iterable, Iterator, List, Union
 
 from .models import EmailRecord
 
+EmailSource = Union[str, Path, bytes, bytearray, IO, Iterable[Any]]
+
+# Only these input fields are kept on EmailRecord.raw; everything downstream
+# reads the normalized fields, so the rest of the source dict is dropped.
+RETAINED_RAW_KEYS = ("language",)
+
+OUTPUT_FORMATS = ("json", "compact", "ndjson")
+OUTPUT_CONTENT_TYPES = {
+    "json": "application/json",
+    "compact": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
 
 def _parse_date(value: Any) -> datetime | None:
     if value is None:
@@ -84,7 +98,7 @@ def _record_from_json(obj: Dict[str, Any]) -> EmailRecord:
     attachments = _normalize_attachments(_get(obj, ["attachments", "attachmentNames"], []))
     date_val = _get(obj, ["date", "sentDateTime", "receivedDateTime"], None)
     date = _parse_date(date_val)
-    raw = obj
+    raw = {key: obj[key] for key in RETAINED_RAW_KEYS if key in obj}
     if not conversation_id:
         conversation_id = message_id or subject.lower().strip()
     if not message_id:
@@ -103,8 +117,14 @@ def _record_from_json(obj: Dict[str, Any]) -> EmailRecord:
     )
 
 
-def _load_json_file(path: Path) -> List[Dict[str, Any]]:
-    data = json.loads(path.read_text(encoding="utf-8"))
+def _decode(data: bytes) -> str:
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("utf-8", errors="replace")
+
+
+def _unwrap_items(data: Any) -> List[Dict[str, Any]]:
     if isinstance(data, list):
         return data
     if isinstance(data, dict) and "items" in data and isinstance(data["items"], list):
@@ -112,20 +132,118 @@ def _load_json_file(path: Path) -> List[Dict[str, Any]]:
     return [data]
 
 
+def _convert_all(items: List[Dict[str, Any]]) -> List[EmailRecord]:
+    # Drops each parsed dict as soon as it is converted so the raw JSON and
+    # the records are never fully resident at the same time.
+    records: List[EmailRecord] = []
+    for idx, obj in enumerate(items):
+        records.append(_record_from_json(obj))
+        items[idx] = None  # type: ignore[call-overload]
+    return records
+
+
+def _load_json_file(path: Path) -> List[Dict[str, Any]]:
+    return _unwrap_items(json.loads(_decode(path.read_bytes())))
+
+
 def load_emails(path: str | Path) -> List[EmailRecord]:
     path = Path(path)
     records: List[EmailRecord] = []
     if path.is_dir():
         for file in sorted(path.glob("*.json")):
-            for obj in _load_json_file(file):
-                records.append(_record_from_json(obj))
+            records.extend(_convert_all(_load_json_file(file)))
         return records
-    for obj in _load_json_file(path):
-        records.append(_record_from_json(obj))
+    return _convert_all(_load_json_file(path))
+
+
+def load_emails_from_bytes(data: bytes | bytearray | str) -> List[EmailRecord]:
+    text = data if isinstance(data, str) else _decode(bytes(data))
+    return _convert_all(_unwrap_items(json.loads(text)))
+
+
+def load_emails_from_stream(stream: IO) -> List[EmailRecord]:
+    # Any object with read() works, including a blob StorageStreamDownloader,
+    # so the payload is parsed straight from the download without a temp file.
+    return load_emails_from_bytes(stream.read())
+
+
+def load_emails_from_records(items: Iterable[Any]) -> List[EmailRecord]:
+    records: List[EmailRecord] = []
+    for item in items:
+        if isinstance(item, EmailRecord):
+            records.append(item)
+        elif isinstance(item, dict):
+            records.append(_record_from_json(item))
     return records
 
 
-def save_output(path: str | Path, payload: Dict[str, Any]) -> None:
+def read_emails(source: EmailSource) -> List[EmailRecord]:
+    if isinstance(source, (str, Path)):
+        return load_emails(source)
+    if isinstance(source, (bytes, bytearray)):
+        return load_emails_from_bytes(source)
+    if hasattr(source, "read"):
+        return load_emails_from_stream(source)
+    if isinstance(source, dict):
+        return load_emails_from_records(_unwrap_items(source))
+    return load_emails_from_records(source)
+
+
+def output_suffix(fmt: str = "json", compress: bool = False) -> str:
+    suffix = ".ndjson" if fmt == "ndjson" else ".json"
+    return suffix + ".gz" if compress else suffix
+
+
+def _dumps(value: Any, indent: int | None) -> str:
+    if indent is None:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    return json.dumps(value, indent=indent, ensure_ascii=False)
+
+
+def _iter_json(payload: Dict[str, Any], indent: int | None) -> Iterator[str]:
+    # Produces exactly json.dumps(payload, indent=indent) one list item at a time.
+    if not payload:
+        yield "{}"
+        return
+    pad = "\n" + " " * indent if indent is not None else ""
+    item_pad = pad + " " * indent if indent is not None else ""
+    colon = ": " if indent is not None else ":"
+    yield "{"
+    for idx, (key, value) in enumerate(payload.items()):
+        yield ("," if idx else "") + pad + json.dumps(key, ensure_ascii=False) + colon
+        if isinstance(value, list) and value:
+            yield "["
+            for pos, item in enumerate(value):
+                yield ("," if pos else "") + item_pad + _dumps(item, indent).replace("\n", item_pad)
+            yield pad + "]"
+        else:
+            yield _dumps(value, indent).replace("\n", pad)
+    yield ("\n" if indent is not None else "") + "}"
+
+
+def _iter_ndjson(payload: Dict[str, Any]) -> Iterator[str]:
+    header = {key: value for key, value in payload.items() if key != "conversations"}
+    yield _dumps(header, None) + "\n"
+    for item in payload.get("conversations", []):
+        yield _dumps(item, None) + "\n"
+
+
+def write_output(stream: IO[bytes], payload: Dict[str, Any], fmt: str = "json") -> None:
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {fmt}")
+    if fmt == "ndjson":
+        chunks = _iter_ndjson(payload)
+    else:
+        chunks = _iter_json(payload, 2 if fmt == "json" else None)
+    for chunk in chunks:
+        stream.write(chunk.encode("utf-8"))
+
+
+def save_output(
+    path: str | Path, payload: Dict[str, Any], fmt: str = "json", compress: bool = False
+) -> None:
     path = Path(path)
-    path.write_text(json.dumps(payload, indent=2, ensure_ascii=False), encoding="utf-8")
+    opener = gzip.open if compress else open
+    with opener(path, "wb") as handle:
+        write_output(handle, payload, fmt)
 
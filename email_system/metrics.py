@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_key(labels), 0.0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[_key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[LabelKey, List[int]] = {}
+        self._sums: Dict[LabelKey, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            counts[-1] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def count(self, **labels: str) -> int:
+        counts = self._counts.get(_key(labels))
+        return counts[-1] if counts else 0
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines: List[str] = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, ('le', str(bound)))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {counts[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {self._sums[key]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self.register(Counter(name, help_text))  # type: ignore[return-value]
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self.register(Gauge(name, help_text))  # type: ignore[return-value]
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets))  # type: ignore[return-value]
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+MESSAGES_PROCESSED = REGISTRY.counter(
+    "email_worker_messages_processed_total", "Queue messages processed successfully."
+)
+MESSAGES_FAILED = REGISTRY.counter(
+    "email_worker_messages_failed_total", "Queue messages that raised an error."
+)
+MESSAGE_SECONDS = REGISTRY.histogram(
+    "email_worker_message_seconds", "Queue message receive-to-complete latency."
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "email_pipeline_stage_seconds", "Pipeline stage duration by stage."
+)
+EXTERNAL_REQUESTS = REGISTRY.counter(
+    "email_external_requests_total", "External API calls by api and outcome."
+)
+EXTERNAL_SECONDS = REGISTRY.histogram(
+    "email_external_request_seconds", "External API call latency by api."
+)
+EXTERNAL_THROTTLED = REGISTRY.counter(
+    "email_external_throttled_total", "External API calls rejected with HTTP 429."
+)
+EXTERNAL_TOKENS = REGISTRY.counter(
+    "email_external_tokens_total", "Estimated input tokens sent to external APIs by api."
+)
+CACHE_HITS = REGISTRY.counter("email_cache_hits_total", "Cache hits by cache.")
+CACHE_MISSES = REGISTRY.counter("email_cache_misses_total", "Cache misses by cache.")
+FIRST_LABEL_SECONDS = REGISTRY.histogram(
+    "email_worker_first_label_seconds", "Queue message receive-to-provisional-output latency."
+)
+WORKER_QUEUE_DEPTH = REGISTRY.gauge(
+    "email_worker_queue_depth", "Jobs waiting in front of a pipelined worker stage by stage."
+)
+WORKER_UP = REGISTRY.gauge("email_worker_up", "1 while the queue worker loop is running.")
+WORKER_HEARTBEAT = REGISTRY.gauge(
+    "email_worker_last_heartbeat_seconds", "Unix time of the last worker loop iteration."
+)
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    code = getattr(exc, "status_code", None)
+    if code is None:
+        code = getattr(getattr(exc, "response", None), "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+@contextmanager
+def external_call(api: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as exc:
+        if _status_code(exc) == 429:
+            EXTERNAL_THROTTLED.inc(api=api)
+            EXTERNAL_REQUESTS.inc(api=api, outcome="throttled")
+        else:
+            EXTERNAL_REQUESTS.inc(api=api, outcome="error")
+        raise
+    else:
+        EXTERNAL_REQUESTS.inc(api=api, outcome="ok")
+    finally:
+        EXTERNAL_SECONDS.observe(time.perf_counter() - start, api=api)
+
+
+def heartbeat() -> None:
+    WORKER_HEARTBEAT.set(time.time())
@@ -4,8 +4,10 @@ from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
+from .tokens import estimate_tokens, truncate_to_tokens
 
-@dataclass
+
+@dataclass(slots=True)
 class EmailRecord:
     message_id: str
     conversation_id: str
@@ -32,7 +34,7 @@ class EmailRecord:
         return lowered
 
 
-@dataclass
+@dataclass(slots=True)
 class Conversation:
     conversation_id: str
     emails: List[EmailRecord]
@@ -40,8 +42,65 @@ class Conversation:
     merged_body: str
     attachment_names: List[str]
     metadata: Dict[str, Any]
+    # Index of each message's first paragraph in merged_body. Without it,
+    # every paragraph counts as its own message.
+    message_starts: List[int] = field(default_factory=list)
+
+    def _messages(self) -> List[str]:
+        paragraphs = self.merged_body.split("\n\n")
+        bounds = sorted(set(self.message_starts) | {0}) if self.message_starts else range(len(paragraphs))
+        ends = list(bounds[1:]) + [len(paragraphs)]
+        messages = ["\n\n".join(paragraphs[start:end]) for start, end in zip(bounds, ends)]
+        return [message for message in messages if message.strip()]
+
+    def _budgeted_body(self, max_tokens: int) -> str:
+        # The newest message is budgeted first, then the oldest, so the opening
+        # request and the latest reply both survive; the middle is filled from
+        # both ends until neither side fits.
+        messages = self._messages()
+        if len(messages) <= 1:
+            return truncate_to_tokens(messages[0] if messages else "", max_tokens)
+        last = len(messages) - 1
+        oldest_cost = estimate_tokens(messages[0])
+        chosen: Dict[int, str] = {}
+        chosen[last] = truncate_to_tokens(messages[last], max(max_tokens // 2, max_tokens - oldest_cost))
+        remaining = max_tokens - estimate_tokens(chosen[last])
+        chosen[0] = truncate_to_tokens(messages[0], remaining)
+        remaining -= estimate_tokens(chosen[0])
+        left, right = 1, last - 1
+        take_left = True
+        open_left = open_right = True
+        while left <= right and (open_left or open_right) and remaining > 0:
+            if not (open_left if take_left else open_right):
+                take_left = not take_left
+                continue
+            idx = left if take_left else right
+            cost = estimate_tokens(messages[idx])
+            if cost > remaining:
+                if take_left:
+                    open_left = False
+                else:
+                    open_right = False
+            else:
+                chosen[idx] = messages[idx]
+                remaining -= cost
+                if take_left:
+                    left += 1
+                else:
+                    right -= 1
+            take_left = not take_left
+        parts: List[str] = []
+        prev_idx = 0
+        for idx in sorted(chosen):
+            if not chosen[idx]:
+                continue
+            if parts and idx - prev_idx > 1:
+                parts.append("[...]")
+            parts.append(chosen[idx])
+            prev_idx = idx
+        return "\n\n".join(parts)
 
-    def embedding_text(self) -> str:
+    def embedding_text(self, max_tokens: Optional[int] = None) -> str:
         attachment_part = ""
         if self.attachment_names:
             attachment_part = "\nAttachments: " + ", ".join(self.attachment_names)
@@ -53,10 +112,15 @@ class Conversation:
         meta_part = ""
         if meta_tokens:
             meta_part = "\nMetadata: " + " ".join(meta_tokens)
-        return f"{self.merged_subject}\n{self.merged_body}{attachment_part}{meta_part}".strip()
+        body = self.merged_body
+        if max_tokens is not None:
+            fixed = estimate_tokens(f"{self.merged_subject}{attachment_part}{meta_part}")
+            if fixed + estimate_tokens(body) > max_tokens:
+                body = self._budgeted_body(max(0, max_tokens - fixed))
+        return f"{self.merged_subject}\n{body}{attachment_part}{meta_part}".strip()
 
 
-@dataclass
+@dataclass(slots=True)
 class TaxonomyLabel:
     level1: str
     level2: str
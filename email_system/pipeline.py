@@ -1,20 +1,280 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List
+import os
+import shutil
+import tempfile
+import uuid
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 
+from .ann import LabelIndex, label_index_from_env
+from .checkpoint import CheckpointStore, content_key, run_stage
 from .cleaning import deduplicate, filter_emails
-from .cluster import cluster_embeddings
-from .embedding import build_embedder
-from .eval import average_intra_cluster_similarity, dunn_index
+from .cluster import (
+    ClusterResult,
+    OutOfCoreSettings,
+    ShardSettings,
+    assign_clusters,
+    cluster_embeddings,
+    cluster_out_of_core,
+    cluster_sharded,
+    save_cluster_model,
+    shard_key,
+)
+from .embedding import (
+    CachedEmbedder,
+    DiskEmbeddingCache,
+    Embedder,
+    build_embedder,
+    cache_namespace,
+    embed_pooled,
+)
+from .embedding_store import EmbeddingStore, open_embeddings, store_nbytes
+from .eval import evaluate_clusters
 from .intent import IntentClassifier
-from .io import load_emails
-from .models import Conversation, TaxonomyLabel
+from .io import EmailSource, read_emails
+from .metrics import CACHE_HITS, CACHE_MISSES, STAGE_SECONDS
+from .models import Conversation, EmailRecord, TaxonomyLabel
+from .quantize import BLOCK_ROWS, dequantize, embedding_dtype_from_env, quantize
+from .sidecar import write_sidecar
 from .taxonomy import assign_taxonomy
 from .threading import build_conversations
 
 
+EVAL_SAMPLE_SIZE = 2000
+FAST_LANE_INTENTS = ("urgent_escalation", "complaint")
+PROVISIONAL_LABEL = "pending"
+
+
+def _env_max_tokens() -> Optional[int]:
+    value = int(os.getenv("EMBEDDING_MAX_TOKENS", "6000"))
+    return value if value > 0 else None
+
+
+@dataclass
+class PipelineSession:
+    embedder: Embedder
+    intent_classifier: IntentClassifier
+    max_tokens: Optional[int] = field(default_factory=_env_max_tokens)
+    pool_long_texts: bool = field(
+        default_factory=lambda: os.getenv("EMBEDDING_LONG_TEXT_MODE", "truncate") == "pool"
+    )
+    release_bodies: bool = field(
+        default_factory=lambda: os.getenv("PIPELINE_RELEASE_BODIES", "").lower() in ("1", "true", "yes")
+    )
+    out_of_core: OutOfCoreSettings = field(default_factory=OutOfCoreSettings.from_env)
+    sharding: ShardSettings = field(default_factory=ShardSettings.from_env)
+    label_index: Optional[LabelIndex] = field(default_factory=label_index_from_env)
+    reuse_threshold: float = field(
+        default_factory=lambda: float(os.getenv("LABEL_REUSE_THRESHOLD", "0.97"))
+    )
+    review_neighbors: int = field(
+        default_factory=lambda: int(os.getenv("LABEL_INDEX_REVIEW_K", "3"))
+    )
+    index_save_seconds: float = field(
+        default_factory=lambda: float(os.getenv("LABEL_INDEX_SAVE_SECONDS", "60"))
+    )
+    embedding_dtype: str = field(default_factory=embedding_dtype_from_env)
+
+    @classmethod
+    def create(
+        cls,
+        embedder: Optional[Embedder] = None,
+        batching: bool = False,
+        cache_dir: Optional[str] = None,
+    ) -> "PipelineSession":
+        cache_size = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+        dtype = embedding_dtype_from_env()
+        inner = embedder or build_embedder()
+        cache_dir = cache_dir or os.getenv("EMBEDDING_CACHE_DIR") or None
+        disk = DiskEmbeddingCache(cache_dir, cache_namespace(inner), dtype) if cache_dir else None
+        if not batching:
+            cached = CachedEmbedder(inner, max_entries=cache_size, disk=disk, dtype=dtype)
+            return cls(
+                embedder=cached,
+                intent_classifier=IntentClassifier(embedder=cached),
+                embedding_dtype=dtype,
+            )
+
+        from .batching import BatchingEmbedder, BatchingIntentClassifier
+
+        max_items = int(os.getenv("BATCH_MAX_ITEMS", "64"))
+        max_wait = float(os.getenv("BATCH_MAX_WAIT_MS", "50")) / 1000
+        cached = CachedEmbedder(
+            BatchingEmbedder(inner, max_items=max_items, max_wait=max_wait),
+            max_entries=cache_size,
+            disk=disk,
+            dtype=dtype,
+        )
+        classifier = BatchingIntentClassifier(
+            embedder=cached, max_items=max_items, max_wait=max_wait
+        )
+        return cls(embedder=cached, intent_classifier=classifier, embedding_dtype=dtype)
+
+    def warm(self) -> "PipelineSession":
+        self.intent_classifier.warm()
+        return self
+
+    def embed_conversations(
+        self, conversations: Sequence[Conversation]
+    ) -> Tuple[List[str], np.ndarray]:
+        texts = [convo.embedding_text(self.max_tokens) for convo in conversations]
+        if self.pool_long_texts and self.max_tokens:
+            full_texts = [convo.embedding_text() for convo in conversations]
+            embeddings = embed_pooled(self.embedder, full_texts, self.max_tokens)
+        else:
+            embeddings = self.embedder.embed(texts)
+        if embeddings.ndim == 1:
+            embeddings = np.expand_dims(embeddings, axis=0)
+        return texts, embeddings
+
+    def embed_to_store(
+        self, conversations: Sequence[Conversation], path: Path, chunk_size: int
+    ) -> List[str]:
+        texts: List[str] = []
+        store: Optional[EmbeddingStore] = None
+        for start in range(0, len(conversations), chunk_size):
+            chunk_texts, block = self.embed_conversations(conversations[start : start + chunk_size])
+            if store is None:
+                store = EmbeddingStore(
+                    path, len(conversations), block.shape[1], self.embedding_dtype
+                )
+            store.append(block)
+            texts.extend(chunk_texts)
+        if store is not None:
+            store.close()
+        return texts
+
+    def classify_intents(self, texts: Sequence[str], embeddings: Any) -> List[Tuple[str, float]]:
+        # Conversations nearly identical to an indexed one reuse its intent
+        # instead of going through the classifier.
+        intents: Dict[int, Tuple[str, float]] = {}
+        index = self.label_index
+        if index is not None and len(index):
+            for idx, neighbors in enumerate(index.search(np.asarray(embeddings), k=1)):
+                best = neighbors[0] if neighbors else None
+                if best is not None and best.score >= self.reuse_threshold:
+                    intents[idx] = (best.labels["level3"], best.labels["confidence"])
+            CACHE_HITS.inc(len(intents), cache="label_index")
+            CACHE_MISSES.inc(len(texts) - len(intents), cache="label_index")
+        pending = [idx for idx in range(len(texts)) if idx not in intents]
+        if pending:
+            subset = embeddings if len(pending) == len(texts) else embeddings[pending]
+            results = self.intent_classifier.classify_many([texts[idx] for idx in pending], subset)
+            intents.update(zip(pending, ((result.level3, result.confidence) for result in results)))
+        return [intents[idx] for idx in range(len(texts))]
+
+    def similar_for_review(
+        self, embeddings: Any, labels: Sequence[TaxonomyLabel]
+    ) -> Dict[int, List[Dict[str, Any]]]:
+        index = self.label_index
+        if index is None or not len(index) or self.review_neighbors <= 0:
+            return {}
+        review = [idx for idx, label in enumerate(labels) if label.needs_review]
+        similar: Dict[int, List[Dict[str, Any]]] = {}
+        for start in range(0, len(review), BLOCK_ROWS):
+            rows = review[start : start + BLOCK_ROWS]
+            found = index.search(np.asarray(embeddings[rows]), k=self.review_neighbors)
+            for idx, neighbors in zip(rows, found):
+                similar[idx] = [
+                    {
+                        "conversation_id": neighbor.conversation_id,
+                        "score": round(neighbor.score, 3),
+                        "level3": neighbor.labels["level3"],
+                    }
+                    for neighbor in neighbors
+                ]
+        return similar
+
+    def remember(
+        self,
+        conversations: Sequence[Conversation],
+        embeddings: Any,
+        labels: Sequence[TaxonomyLabel],
+    ) -> None:
+        index = self.label_index
+        if index is None:
+            return
+        for start in range(0, len(conversations), BLOCK_ROWS):
+            end = start + BLOCK_ROWS
+            index.add(
+                [convo.conversation_id for convo in conversations[start:end]],
+                np.asarray(embeddings[start:end]),
+                [asdict(label) for label in labels[start:end]],
+            )
+        index.maybe_save(self.index_save_seconds)
+
+    def close(self) -> None:
+        # Writes label index changes still waiting for the next periodic save.
+        if self.label_index is not None:
+            self.label_index.flush()
+
+    def triage(self, conversations: Sequence[Conversation]) -> List[Dict[str, Any]]:
+        # Keyword rules only: provisional labels for urgent and complaint
+        # threads, available before any embedding or clustering work.
+        payloads: List[Dict[str, Any]] = []
+        for convo in conversations:
+            intent = self.intent_classifier._rule_based(convo.embedding_text(self.max_tokens))
+            if intent.level3 not in FAST_LANE_INTENTS:
+                continue
+            label = TaxonomyLabel(
+                level1=PROVISIONAL_LABEL,
+                level2=PROVISIONAL_LABEL,
+                level3=intent.level3,
+                confidence=intent.confidence,
+                needs_review=False,
+            )
+            payloads.append(_conversation_payload(convo, label))
+        return payloads
+
+    def classify_threads(
+        self,
+        threads: Sequence[List[EmailRecord]],
+        cluster_model: Optional[ClusterResult] = None,
+    ) -> List[Dict[str, Any]]:
+        # Classifies several independent requests with one embedding and one
+        # intent call; clusters come from a previously fitted model.
+        grouped: List[List[Conversation]] = []
+        filtered_out: List[int] = []
+        for emails in threads:
+            kept, removed = filter_emails(emails)
+            grouped.append(build_conversations(deduplicate(kept), self.release_bodies))
+            filtered_out.append(len(removed))
+        conversations = [convo for convos in grouped for convo in convos]
+
+        payloads: List[Dict[str, Any]] = []
+        if conversations:
+            texts, embeddings = self.embed_conversations(conversations)
+            intents = self.classify_intents(texts, embeddings)
+            if cluster_model is not None:
+                cluster_result = assign_clusters(cluster_model, embeddings)
+            else:
+                cluster_result = ClusterResult(
+                    labels=[-1 for _ in conversations], level1_map={}, level2_map={}
+                )
+            labels = assign_taxonomy(cluster_result, intents)
+            payloads = [
+                _conversation_payload(convo, label) for convo, label in zip(conversations, labels)
+            ]
+            for idx, neighbors in self.similar_for_review(embeddings, labels).items():
+                payloads[idx]["similar"] = neighbors
+
+        results: List[Dict[str, Any]] = []
+        offset = 0
+        for convos, removed_count in zip(grouped, filtered_out):
+            results.append(
+                {
+                    "filtered_out": removed_count,
+                    "conversations": payloads[offset : offset + len(convos)],
+                }
+            )
+            offset += len(convos)
+        return results
+
+
 def _conversation_payload(convo: Conversation, label: TaxonomyLabel) -> Dict[str, Any]:
     return {
         "conversation_id": convo.conversation_id,
@@ -30,40 +290,196 @@ def _conversation_payload(convo: Conversation, label: TaxonomyLabel) -> Dict[str
     }
 
 
-def run_pipeline(input_path: str) -> Dict[str, Any]:
-    emails = load_emails(input_path)
-    filtered, removed = filter_emails(emails)
-    deduped = deduplicate(filtered)
-    conversations = build_conversations(deduped)
+def _store_files(store_dir: str | Path, stem: str) -> List[Path]:
+    return [Path(store_dir) / f"{stem}-embeddings.npy", Path(store_dir) / f"{stem}-labels.npy"]
 
-    texts = [convo.embedding_text() for convo in conversations]
-    embedder = build_embedder()
-    embeddings = embedder.embed(texts)
-    if embeddings.ndim == 1:
-        embeddings = np.expand_dims(embeddings, axis=0)
 
-    cluster_result = cluster_embeddings(texts, embeddings)
-    intent_classifier = IntentClassifier(embedder=embedder)
-    intents = []
-    for text in texts:
-        intent = intent_classifier.classify(text)
-        intents.append((intent.level3, intent.confidence))
-    labels = assign_taxonomy(cluster_result, intents)
+def release_checkpoint(
+    checkpoint: CheckpointStore, key: str, session: Optional[PipelineSession] = None
+) -> None:
+    # For callers that ran with clear_checkpoint=False: clears the checkpoint
+    # and the out-of-core store files it still referred to.
+    checkpoint.clear(key)
+    store_dir = (session.out_of_core if session else OutOfCoreSettings.from_env()).store_dir
+    if store_dir and key:
+        for path in _store_files(store_dir, key):
+            path.unlink(missing_ok=True)
 
-    avg_sim = average_intra_cluster_similarity(embeddings, cluster_result.labels)
-    dunn = dunn_index(embeddings, cluster_result.labels)
 
-    return {
-        "summary": {
+def run_pipeline(
+    source: EmailSource,
+    session: Optional[PipelineSession] = None,
+    cluster_model_path: Optional[str] = None,
+    checkpoint: Optional[CheckpointStore] = None,
+    on_provisional: Optional[Callable[[Dict[str, Any]], None]] = None,
+    sidecar: Optional[str | Path] = None,
+    clear_checkpoint: bool = True,
+    checkpoint_key: Optional[str] = None,
+) -> Dict[str, Any]:
+    # Callers that still have to persist the payload pass
+    # clear_checkpoint=False and call release_checkpoint() once it is safely
+    # written. Callers that already hashed the input with content_key() pass
+    # checkpoint_key so it is not hashed again.
+    session = session or PipelineSession.create()
+    key = checkpoint_key or ""
+    if checkpoint is not None and not key:
+        key, source = content_key(source)
+
+    def _clean() -> Dict[str, Any]:
+        with STAGE_SECONDS.time(stage="load"):
+            emails = read_emails(source)
+        with STAGE_SECONDS.time(stage="clean"):
+            filtered, removed = filter_emails(emails)
+            deduped = deduplicate(filtered)
+        counts = {
             "input_emails": len(emails),
             "filtered_out": len(removed),
             "deduped": len(deduped),
-            "conversations": len(conversations),
-            "avg_intra_cluster_similarity": round(avg_sim, 3),
-            "dunn_index": round(dunn, 3),
-        },
-        "conversations": [
-            _conversation_payload(convo, label)
-            for convo, label in zip(conversations, labels)
-        ],
-    }
+        }
+        return {"counts": counts, "records": deduped}
+
+    def _thread() -> Dict[str, Any]:
+        # Only reached when no conversations checkpoint exists, so a resumed
+        # run skips loading the cleaned records entirely.
+        cleaned = run_stage(checkpoint, key, "cleaned", _clean)
+        with STAGE_SECONDS.time(stage="thread"):
+            conversations = build_conversations(
+                cleaned["records"], release_bodies=session.release_bodies
+            )
+        return {"counts": cleaned["counts"], "conversations": conversations}
+
+    threaded = run_stage(checkpoint, key, "conversations", _thread)
+    counts, conversations = threaded["counts"], threaded["conversations"]
+
+    if on_provisional is not None:
+        with STAGE_SECONDS.time(stage="triage"):
+            urgent = session.triage(conversations)
+        if urgent:
+            on_provisional(
+                {
+                    "summary": {
+                        **counts,
+                        "conversations": len(conversations),
+                        "provisional": True,
+                    },
+                    "conversations": urgent,
+                }
+            )
+
+    settings = session.out_of_core
+    out_of_core = settings.enabled_for(len(conversations))
+    store_dir: Optional[Path] = None
+    if out_of_core:
+        store_dir = Path(settings.store_dir or tempfile.mkdtemp(prefix="email-embeddings-"))
+        stem = key or uuid.uuid4().hex
+    keep_store = False
+
+    # Stores can be several GB. A temporary store always goes; this run's files
+    # in CLUSTER_STORE_DIR stay only while a checkpoint still refers to them.
+    try:
+        def _embed() -> Tuple[List[str], Any]:
+            with STAGE_SECONDS.time(stage="embed"):
+                if out_of_core:
+                    # Embeddings go to a memory-mapped store; the stage result
+                    # (and its checkpoint) carries the file path, not the matrix.
+                    path = store_dir / f"{stem}-embeddings.npy"
+                    return session.embed_to_store(conversations, path, settings.chunk_size), str(path)
+                texts, vectors = session.embed_conversations(conversations)
+                if session.embedding_dtype != "float32":
+                    return texts, quantize(vectors, session.embedding_dtype)
+                return texts, vectors
+
+        texts, embeddings = run_stage(checkpoint, key, "embeddings", _embed)
+        if out_of_core:
+            if not Path(embeddings).exists():
+                texts, embeddings = _embed()
+            embedding_bytes = store_nbytes(embeddings)
+            embeddings = open_embeddings(embeddings)
+        else:
+            embedding_bytes = int(embeddings.nbytes)
+
+        def _cluster() -> ClusterResult:
+            with STAGE_SECONDS.time(stage="cluster"):
+                if out_of_core:
+                    return cluster_out_of_core(
+                        texts,
+                        embeddings,
+                        sample_size=settings.sample_size,
+                        chunk_size=settings.chunk_size,
+                        labels_path=store_dir / f"{stem}-labels.npy",
+                        method=settings.assign_method,
+                    )
+                if session.sharding.keys:
+                    return cluster_sharded(
+                        texts,
+                        dequantize(embeddings),
+                        [shard_key(convo, session.sharding.keys) for convo in conversations],
+                        min_shard_size=session.sharding.min_shard_size,
+                        workers=session.sharding.workers,
+                    )
+                return cluster_embeddings(texts, dequantize(embeddings))
+
+        cluster_result = run_stage(checkpoint, key, "clusters", _cluster)
+        if cluster_model_path:
+            save_cluster_model(cluster_model_path, cluster_result)
+
+        def _intent() -> List[Tuple[str, float]]:
+            intents: List[Tuple[str, float]] = []
+            chunk = settings.chunk_size
+            with STAGE_SECONDS.time(stage="intent"):
+                for start in range(0, len(texts), chunk):
+                    block = np.asarray(embeddings[start : start + chunk])
+                    intents.extend(session.classify_intents(texts[start : start + chunk], block))
+            return intents
+
+        intents = run_stage(checkpoint, key, "intents", _intent)
+        labels = assign_taxonomy(cluster_result, intents)
+        similar = session.similar_for_review(embeddings, labels)
+
+        with STAGE_SECONDS.time(stage="evaluate"):
+            metrics = evaluate_clusters(
+                embeddings, cluster_result.labels, EVAL_SAMPLE_SIZE if out_of_core else None
+            )
+
+        if sidecar is not None:
+            write_sidecar(
+                sidecar,
+                [convo.conversation_id for convo in conversations],
+                cluster_result.labels,
+                texts,
+                embeddings,
+                session.embedding_dtype,
+            )
+
+        payload = {
+            "summary": {
+                **counts,
+                "conversations": len(conversations),
+                **metrics,
+            },
+            "conversations": [
+                _conversation_payload(convo, label)
+                for convo, label in zip(conversations, labels)
+            ],
+        }
+        for idx, neighbors in similar.items():
+            payload["conversations"][idx]["similar"] = neighbors
+        session.remember(conversations, embeddings, labels)
+        if session.embedding_dtype != "float32":
+            payload["summary"]["embedding_dtype"] = session.embedding_dtype
+            payload["summary"]["embedding_bytes"] = embedding_bytes
+        if out_of_core:
+            payload["summary"]["cluster_mode"] = "out_of_core"
+        if checkpoint is not None and clear_checkpoint:
+            checkpoint.clear(key)
+        keep_store = checkpoint is not None and not clear_checkpoint
+        return payload
+    except BaseException:
+        keep_store = checkpoint is not None
+        raise
+    finally:
+        if store_dir is not None and settings.store_dir is None:
+            shutil.rmtree(store_dir, ignore_errors=True)
+        elif store_dir is not None and not keep_store:
+            for path in _store_files(store_dir, stem):
+                path.unlink(missing_ok=True)
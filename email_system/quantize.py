@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+EMBEDDING_DTYPES = ("float32", "float16", "int8")
+BLOCK_ROWS = 4096
+
+
+def embedding_dtype_from_env() -> str:
+    dtype = os.getenv("EMBEDDING_DTYPE", "float32").strip().lower()
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"EMBEDDING_DTYPE must be one of {', '.join(EMBEDDING_DTYPES)}")
+    return dtype
+
+
+@dataclass
+class QuantizedEmbeddings:
+    # Row-major embeddings stored as float32, float16 or int8 with one
+    # symmetric scale per row. Indexing dequantizes only the selected rows,
+    # so callers can read large (possibly memory-mapped) matrices in blocks.
+    data: np.ndarray
+    scales: Optional[np.ndarray] = None
+
+    @property
+    def dtype(self) -> str:
+        return self.data.dtype.name
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.data.shape
+
+    @property
+    def ndim(self) -> int:
+        return self.data.ndim
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0))
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index) -> np.ndarray:
+        block = np.asarray(self.data[index], dtype=np.float32)
+        if self.scales is None:
+            return block
+        scales = np.asarray(self.scales[index], dtype=np.float32)
+        return block * (scales[..., None] if block.ndim > 1 else scales)
+
+
+EmbeddingMatrix = Union[np.ndarray, QuantizedEmbeddings]
+
+
+def quantize_rows(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float32":
+        return vectors, None
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype != "int8":
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    scales = np.abs(vectors).max(axis=-1) / 127.0
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    data = np.clip(np.rint(vectors / scales[..., None]), -127, 127).astype(np.int8)
+    return data, scales
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> QuantizedEmbeddings:
+    data, scales = quantize_rows(vectors, dtype)
+    return QuantizedEmbeddings(data, scales)
+
+
+def dequantize(embeddings: EmbeddingMatrix) -> np.ndarray:
+    if isinstance(embeddings, QuantizedEmbeddings):
+        return embeddings[:]
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def iter_blocks(
+    embeddings: EmbeddingMatrix, block_rows: int = BLOCK_ROWS
+) -> Iterator[Tuple[int, np.ndarray]]:
+    for start in range(0, len(embeddings), block_rows):
+        yield start, np.asarray(embeddings[start : start + block_rows], dtype=np.float32)
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from .io import save_output
+from .pipeline import PipelineSession, run_pipeline
+
+
+@dataclass
+class Job:
+    input_path: str
+    output_path: str
+
+
+@dataclass
+class JobResult:
+    job: Job
+    input_emails: int = 0
+    conversations: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+@dataclass
+class RunReport:
+    results: List[JobResult] = field(default_factory=list)
+    wall_seconds: float = 0.0
+
+    @property
+    def failed(self) -> List[JobResult]:
+        return [result for result in self.results if result.error]
+
+    def summary(self) -> Dict[str, float]:
+        emails = sum(result.input_emails for result in self.results)
+        conversations = sum(result.conversations for result in self.results)
+        wall = max(self.wall_seconds, 1e-9)
+        return {
+            "inputs": len(self.results),
+            "succeeded": len(self.results) - len(self.failed),
+            "failed": len(self.failed),
+            "input_emails": emails,
+            "conversations": conversations,
+            "wall_seconds": round(self.wall_seconds, 2),
+            "emails_per_second": round(emails / wall, 1),
+            "conversations_per_second": round(conversations / wall, 1),
+        }
+
+
+def _default_outputs(inputs: List[str], output_dir: Path, suffix: str) -> List[str]:
+    # Outputs mirror each input's directory relative to the inputs' common
+    # parent, so "/data/a/x.json" and "/data/b/x.json" don't collide.
+    parents = [os.path.dirname(os.path.abspath(path)) for path in inputs]
+    root = os.path.commonpath(parents) if parents else ""
+    outputs: List[str] = []
+    for path, parent in zip(inputs, parents):
+        stem = Path(path).name
+        if stem.endswith(".json"):
+            stem = stem[: -len(".json")]
+        output = output_dir / os.path.relpath(parent, root) / f"{stem}.classified{suffix}"
+        outputs.append(os.path.normpath(output))
+    return outputs
+
+
+def load_manifest(path: str | Path, output_dir: Path, suffix: str) -> List[Job]:
+    # JSON manifests are a list of paths or {"input": ..., "output": ...} objects;
+    # anything else is read as one "input [output]" pair per line.
+    path = Path(path)
+    text = path.read_text(encoding="utf-8-sig")
+    entries: List[tuple[str, Optional[str]]] = []
+    if path.suffix == ".json":
+        for entry in json.loads(text):
+            if isinstance(entry, str):
+                entries.append((entry, None))
+            else:
+                entries.append((entry["input"], entry.get("output") or None))
+    else:
+        for line in text.splitlines():
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            entries.append((parts[0], parts[1] if len(parts) > 1 else None))
+    defaults = _default_outputs([entry[0] for entry in entries], output_dir, suffix)
+    return [
+        Job(input_path, output or default)
+        for (input_path, output), default in zip(entries, defaults)
+    ]
+
+
+def expand_inputs(patterns: List[str], output_dir: Path, suffix: str) -> List[Job]:
+    inputs: List[str] = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for match in matches:
+            if match in seen:
+                continue
+            seen.add(match)
+            inputs.append(match)
+    return [Job(path, output) for path, output in zip(inputs, _default_outputs(inputs, output_dir, suffix))]
+
+
+def check_unique_outputs(jobs: List[Job]) -> None:
+    owners: Dict[str, str] = {}
+    for job in jobs:
+        key = os.path.normcase(os.path.abspath(job.output_path))
+        if key in owners:
+            raise ValueError(f"{job.input_path} and {owners[key]} both write {job.output_path}")
+        owners[key] = job.input_path
+
+
+_SESSION: Optional[PipelineSession] = None
+
+
+def _init_process(cache_dir: Optional[str]) -> None:
+    global _SESSION
+    _SESSION = PipelineSession.create(cache_dir=cache_dir).warm()
+    # Pool processes exit without running atexit hooks; multiprocessing
+    # finalizers still run, so pending label index changes are written.
+    Finalize(_SESSION, _SESSION.close, exitpriority=10)
+
+
+def _run_job(job: Job, fmt: str, compress: bool) -> JobResult:
+    start = time.perf_counter()
+    try:
+        payload = run_pipeline(job.input_path, session=_SESSION)
+        Path(job.output_path).parent.mkdir(parents=True, exist_ok=True)
+        save_output(job.output_path, payload, fmt=fmt, compress=compress)
+    except Exception as exc:
+        return JobResult(job=job, seconds=time.perf_counter() - start, error=str(exc))
+    summary = payload["summary"]
+    return JobResult(
+        job=job,
+        input_emails=summary["input_emails"],
+        conversations=summary["conversations"],
+        seconds=time.perf_counter() - start,
+    )
+
+
+def run_jobs(
+    jobs: List[Job],
+    workers: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    fmt: str = "json",
+    compress: bool = False,
+    on_result: Optional[Callable[[JobResult], None]] = None,
+) -> RunReport:
+    check_unique_outputs(jobs)
+    report = RunReport()
+    start = time.perf_counter()
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs) or 1))
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_process, initargs=(cache_dir,)
+    ) as pool:
+        futures = [pool.submit(_run_job, job, fmt, compress) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            report.results.append(result)
+            if on_result:
+                on_result(result)
+    report.wall_seconds = time.perf_counter() - start
+    return report
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import gzip
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Sequence
+
+from .embedding_store import EmbeddingStore, open_embeddings
+from .quantize import BLOCK_ROWS, EmbeddingMatrix, QuantizedEmbeddings
+
+# A sidecar is "<base>.embeddings.npy" (plus "<base>.embeddings.scales.npy"
+# for int8) with one row per conversation, and "<base>.conversations.jsonl.gz"
+# holding the matching conversation id, cluster label and embedding text.
+EMBEDDINGS_SUFFIX = ".embeddings.npy"
+CONVERSATIONS_SUFFIX = ".conversations.jsonl.gz"
+OUTPUT_SUFFIXES = (".ndjson.gz", ".json.gz", ".ndjson", ".json")
+
+
+@dataclass
+class Sidecar:
+    conversation_ids: List[str]
+    clusters: List[int]
+    texts: List[str]
+    embeddings: QuantizedEmbeddings
+
+
+def sidecar_base(path: str | Path) -> str:
+    # Accepts the pipeline output path, a sidecar file or the base itself.
+    name = str(path)
+    for suffix in (EMBEDDINGS_SUFFIX, CONVERSATIONS_SUFFIX) + OUTPUT_SUFFIXES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def sidecar_files(base: str | Path) -> List[Path]:
+    base = str(base)
+    files = [Path(base + EMBEDDINGS_SUFFIX), Path(base + CONVERSATIONS_SUFFIX)]
+    scales = Path(base + ".embeddings.scales.npy")
+    return files + [scales] if scales.exists() else files
+
+
+def write_sidecar(
+    base: str | Path,
+    conversation_ids: Sequence[str],
+    clusters: Sequence[int],
+    texts: Sequence[str],
+    embeddings: EmbeddingMatrix,
+    dtype: str = "float32",
+) -> List[Path]:
+    base = str(base)
+    Path(base).parent.mkdir(parents=True, exist_ok=True)
+    if len(embeddings):
+        store = EmbeddingStore(
+            base + EMBEDDINGS_SUFFIX, len(embeddings), embeddings.shape[1], dtype
+        )
+        for start in range(0, len(embeddings), BLOCK_ROWS):
+            store.append(embeddings[start : start + BLOCK_ROWS])
+        store.close()
+    with gzip.open(base + CONVERSATIONS_SUFFIX, "wt", encoding="utf-8") as handle:
+        for conversation_id, cluster, text in zip(conversation_ids, clusters, texts):
+            record = {"conversation_id": conversation_id, "cluster": int(cluster), "text": text}
+            handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return sidecar_files(base)
+
+
+def open_sidecar(base: str | Path) -> Sidecar:
+    # Embeddings are memory-mapped; only the id/text manifest is read into memory.
+    base = sidecar_base(base)
+    ids: List[str] = []
+    clusters: List[int] = []
+    texts: List[str] = []
+    with gzip.open(base + CONVERSATIONS_SUFFIX, "rt", encoding="utf-8") as handle:
+        for line in handle:
+            record = json.loads(line)
+            ids.append(record["conversation_id"])
+            clusters.append(record["cluster"])
+            texts.append(record["text"])
+    return Sidecar(ids, clusters, texts, open_embeddings(base + EMBEDDINGS_SUFFIX))
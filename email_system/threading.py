@@ -1,14 +1,45 @@
 from __future__ import annotations
 
+import hashlib
+import re
 from collections import defaultdict
 from datetime import datetime
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Optional, Set
 
 from .models import Conversation, EmailRecord
-from .utils import sender_domain
+from .utils import normalize_text, sender_domain
 
+# Blank lines, including quoted blank lines such as ">", end a paragraph.
+PARAGRAPH_SPLIT = re.compile(r"\n(?:[ \t>]*\n)+")
+QUOTE_MARKER = re.compile(r"^(\s*>)+\s?", re.MULTILINE)
 
-def build_conversations(emails: Iterable[EmailRecord]) -> List[Conversation]:
+
+def _paragraph_digest(paragraph: str) -> bytes:
+    # Quote markers and whitespace are ignored so "> text" matches "text".
+    key = normalize_text(QUOTE_MARKER.sub("", paragraph))
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest() if key else b""
+
+
+def merge_bodies(bodies: Iterable[str], starts: Optional[List[int]] = None) -> str:
+    # starts, when given, receives the index of each body's first kept
+    # paragraph so callers can regroup paragraphs into messages.
+    seen: Set[bytes] = set()
+    kept: List[str] = []
+    for body in bodies:
+        if starts is not None:
+            starts.append(len(kept))
+        for paragraph in PARAGRAPH_SPLIT.split(body):
+            digest = _paragraph_digest(paragraph)
+            if not digest or digest in seen:
+                continue
+            seen.add(digest)
+            kept.append(paragraph.strip())
+    return "\n\n".join(kept)
+
+
+def build_conversations(
+    emails: Iterable[EmailRecord], release_bodies: bool = False
+) -> List[Conversation]:
     buckets: Dict[str, List[EmailRecord]] = defaultdict(list)
     for email in emails:
         key = email.conversation_id or email.normalized_subject()
@@ -18,10 +49,15 @@ def build_conversations(emails: Iterable[EmailRecord]) -> List[Conversation]:
     for convo_id, items in buckets.items():
         items_sorted = sorted(items, key=lambda e: e.date or datetime.min)
         merged_subject = items_sorted[0].normalized_subject() if items_sorted else ""
-        merged_body = "\n\n".join(email.body for email in items_sorted if email.body)
+        message_starts: List[int] = []
+        merged_body = merge_bodies(
+            (email.body for email in items_sorted if email.body), message_starts
+        )
         attachment_names = []
         for email in items_sorted:
             attachment_names.extend(email.attachments)
+            if release_bodies:
+                email.body = ""
         metadata = {
             "sender_domain": sender_domain(items_sorted[0].sender if items_sorted else ""),
             "thread_length": len(items_sorted),
@@ -35,6 +71,7 @@ def build_conversations(emails: Iterable[EmailRecord]) -> List[Conversation]:
                 merged_body=merged_body,
                 attachment_names=sorted(set(attachment_names)),
                 metadata=metadata,
+                message_starts=message_starts,
             )
         )
     return conversations
@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import re
+from typing import Iterator, List, Tuple
+
+# Approximates BPE tokenizers (cl100k-style) without shipping one: every word
+# or punctuation mark is at least one token, and long words cost ~4 chars each.
+# CJK characters count one each and digits go in runs of up to three, since
+# those are where a per-word estimate undercounts the most.
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_RE = re.compile(rf"[{_CJK}]|\d{{1,3}}|[^\W\d{_CJK}]+|[^\w\s]", re.UNICODE)
+CHARS_PER_TOKEN = 4
+
+
+def _spans(text: str) -> Iterator[Tuple[int, int]]:
+    for match in _TOKEN_RE.finditer(text):
+        length = match.end() - match.start()
+        yield match.end(), max(1, -(-length // CHARS_PER_TOKEN))
+
+
+def estimate_tokens(text: str) -> int:
+    return sum(cost for _, cost in _spans(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    used = 0
+    cut = 0
+    for end, cost in _spans(text):
+        if used + cost > max_tokens:
+            return text[:cut].rstrip()
+        used += cost
+        cut = end
+    return text
+
+
+def token_windows(text: str, window_tokens: int) -> List[str]:
+    windows: List[str] = []
+    start = 0
+    used = 0
+    prev_end = 0
+    for end, cost in _spans(text):
+        if used and used + cost > window_tokens:
+            windows.append(text[start:prev_end].strip())
+            start = prev_end
+            used = 0
+        used += cost
+        prev_end = end
+    tail = text[start:].strip()
+    if tail or not windows:
+        windows.append(tail)
+    return windows
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import re
+import sys
 
 
 def normalize_text(text: str) -> str:
@@ -10,7 +11,8 @@ def normalize_text(text: str) -> str:
 
 
 def sender_domain(sender: str) -> str:
+    # Interned so the many conversations from one domain share a single string.
     if "@" in sender:
-        return sender.split("@")[-1].lower()
+        return sys.intern(sender.split("@")[-1].lower())
     return "unknown"
 
@@ -1,24 +1,147 @@
 from __future__ import annotations
 
+import json
 import os
 import threading
+import time
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
 
-from .worker import main as worker_main
+from .batching import MicroBatcher
+from .cluster import ClusterResult, load_cluster_model
+from .io import read_emails
+from .metrics import REGISTRY, WORKER_HEARTBEAT
+from .models import EmailRecord
+from .pipeline import PipelineSession
+
+
+class ClassifyService:
+    def __init__(
+        self,
+        session: PipelineSession,
+        cluster_model: Optional[ClusterResult] = None,
+        max_pending: int = 64,
+        max_batch: int = 16,
+        max_wait: float = 0.005,
+        concurrency: int = 2,
+    ) -> None:
+        self.session = session
+        self.cluster_model = cluster_model
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._batcher: MicroBatcher[List[EmailRecord], Dict[str, Any]] = MicroBatcher(
+            lambda threads: self.session.classify_threads(threads, self.cluster_model),
+            max_items=max_batch,
+            max_wait=max_wait,
+            dispatchers=concurrency,
+        )
+
+    def classify(self, emails: List[EmailRecord]) -> Optional[Dict[str, Any]]:
+        # Returns None when the pending queue is full so the caller can shed load.
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            return self._batcher.submit([emails])[0]
+        finally:
+            self._slots.release()
+
+
+def _build_classify_service() -> ClassifyService:
+    model_path = os.getenv("CLASSIFY_CLUSTER_MODEL", "").strip()
+    cluster_model = load_cluster_model(model_path) if model_path else None
+    return ClassifyService(
+        PipelineSession.create().warm(),
+        cluster_model=cluster_model,
+        max_pending=int(os.getenv("CLASSIFY_MAX_PENDING", "64")),
+        max_batch=int(os.getenv("CLASSIFY_BATCH_SIZE", "16")),
+        max_wait=float(os.getenv("CLASSIFY_BATCH_WAIT_MS", "5")) / 1000,
+        concurrency=int(os.getenv("CLASSIFY_CONCURRENCY", "2")),
+    )
+
+
+def _worker_status(thread: Optional[threading.Thread]) -> Optional[str]:
+    # Returns a reason string when the worker is unhealthy, else None.
+    if thread is None:
+        return None
+    if not thread.is_alive():
+        return "worker thread is not running"
+    last_beat = WORKER_HEARTBEAT.value()
+    timeout = float(os.getenv("WORKER_HEARTBEAT_TIMEOUT", "120"))
+    if last_beat and time.time() - last_beat > timeout:
+        return f"worker heartbeat is older than {timeout:.0f}s"
+    return None
 
 
 class HealthHandler(BaseHTTPRequestHandler):
+    classify_service: Optional[ClassifyService] = None
+    worker_thread: Optional[threading.Thread] = None
+
+    def _send(self, status: int, body: bytes, content_type: str = "text/plain; charset=utf-8") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self._send(status, body, "application/json")
+
     def do_GET(self) -> None:  # noqa: N802 - required by BaseHTTPRequestHandler
         if self.path in ("/", "/health", "/healthz"):
-            self.send_response(200)
-            self.send_header("Content-Type", "text/plain; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(b"ok")
+            problem = _worker_status(self.worker_thread)
+            if problem:
+                self._send(503, problem.encode("utf-8"))
+                return
+            self._send(200, b"ok")
             return
-        self.send_response(404)
-        self.send_header("Content-Type", "text/plain; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(b"not found")
+        if self.path == "/metrics":
+            self._send(200, REGISTRY.render().encode("utf-8"), "text/plain; version=0.0.4")
+            return
+        self._send(404, b"not found")
+
+    def do_POST(self) -> None:  # noqa: N802 - required by BaseHTTPRequestHandler
+        if self.path != "/classify":
+            self._send(404, b"not found")
+            return
+        service = self.classify_service
+        if service is None:
+            self._send_json(503, {"error": "classifier not ready"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        # The body is not read on these errors, so the connection is closed
+        # rather than parsing leftover bytes as the next request.
+        if length < 0:
+            self.close_connection = True
+            self._send_json(400, {"error": "invalid Content-Length"})
+            return
+        if length > int(os.getenv("CLASSIFY_MAX_BODY_BYTES", str(10 * 1024 * 1024))):
+            self.close_connection = True
+            self._send_json(413, {"error": "request body too large"})
+            return
+        try:
+            data = json.loads(self.rfile.read(length) or b"null")
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            self._send_json(400, {"error": "invalid JSON"})
+            return
+        if isinstance(data, dict) and isinstance(data.get("emails"), list):
+            data = data["emails"]
+        emails = read_emails(data) if isinstance(data, (dict, list)) else []
+        if not emails:
+            self._send_json(400, {"error": "expected an email object or a list of emails"})
+            return
+        try:
+            result = service.classify(emails)
+        except Exception as exc:
+            print(f"Classify error: {exc}")
+            self._send_json(500, {"error": "classification failed"})
+            return
+        if result is None:
+            self._send_json(503, {"error": "classifier overloaded; retry later"})
+            return
+        self._send_json(200, result)
 
     def log_message(self, format: str, *args) -> None:  # noqa: A003 - match base signature
         return
@@ -26,19 +149,34 @@ class HealthHandler(BaseHTTPRequestHandler):
 
 def _start_worker() -> None:
     try:
+        # Imported here so the health server is already listening while the
+        # Azure SDKs load.
+        from .worker import main as worker_main
+
         worker_main()
     except Exception as exc:
         print(f"Worker crashed: {exc}")
 
 
+def _start_classify_service() -> None:
+    # /classify answers 503 until the warm session is ready.
+    try:
+        HealthHandler.classify_service = _build_classify_service()
+    except Exception as exc:
+        print(f"Classifier failed to start: {exc}")
+
+
 def main() -> None:
     port = int(os.getenv("PORT", "8000"))
 
+    server = ThreadingHTTPServer(("", port), HealthHandler)
+    print(f"Health server listening on :{port}")
+
     thread = threading.Thread(target=_start_worker, daemon=True)
     thread.start()
+    HealthHandler.worker_thread = thread
+    threading.Thread(target=_start_classify_service, daemon=True).start()
 
-    server = ThreadingHTTPServer(("", port), HealthHandler)
-    print(f"Health server listening on :{port}")
     server.serve_forever()
 
 
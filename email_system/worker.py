@@ -1,18 +1,38 @@
 from __future__ import annotations
 
 import base64
+import gzip
+import io
 import json
 import os
+import shutil
 import tempfile
 import time
-from typing import Any, Dict, Optional
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
 
-from azure.core.exceptions import ResourceNotFoundError
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobClient, BlobServiceClient, ContentSettings
-from azure.storage.queue import QueueClient
+from .checkpoint import BlobCheckpointStore, CheckpointStore, LocalCheckpointStore, content_key
+from .io import OUTPUT_CONTENT_TYPES, OUTPUT_FORMATS, output_suffix, write_output
+from .metrics import (
+    FIRST_LABEL_SECONDS,
+    MESSAGE_SECONDS,
+    MESSAGES_FAILED,
+    MESSAGES_PROCESSED,
+    WORKER_UP,
+    heartbeat,
+)
+from .pipeline import PipelineSession, release_checkpoint, run_pipeline
+from .sidecar import sidecar_base, sidecar_files
 
-from .pipeline import run_pipeline
+if TYPE_CHECKING:
+    from azure.storage.blob import (
+        BlobClient,
+        BlobServiceClient,
+        ContentSettings,
+        StorageStreamDownloader,
+    )
+    from azure.storage.queue import QueueClient
 
 
 def _env(name: str, default: str = "") -> str:
@@ -20,6 +40,13 @@ def _env(name: str, default: str = "") -> str:
     return value.strip()
 
 
+def _env_flag(name: str, default: bool = False) -> bool:
+    value = _env(name)
+    if not value:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
 def _parse_message(content: str) -> Optional[Dict[str, Any]]:
     try:
         return json.loads(content)
@@ -47,16 +74,30 @@ def _extract_blob_name(event: Dict[str, Any], input_container: str) -> Optional[
     return None
 
 
-def _download_blob_text(blob_service: BlobServiceClient, container: str, blob_name: str) -> str:
+def _message_blob_name(content: str, input_container: str) -> Optional[str]:
+    parsed = _parse_message(content)
+    if parsed is None:
+        return None
+    events = parsed if isinstance(parsed, list) else [parsed]
+    for event in events:
+        if isinstance(event, dict):
+            blob_name = _extract_blob_name(event, input_container)
+            if blob_name:
+                return blob_name
+    return None
+
+
+def _open_blob_stream(
+    blob_service: BlobServiceClient, container: str, blob_name: str
+) -> StorageStreamDownloader:
+    from azure.core.exceptions import ResourceNotFoundError
+
     blob = blob_service.get_blob_client(container=container, blob=blob_name)
+    concurrency = int(_env("BLOB_DOWNLOAD_CONCURRENCY", "4"))
     last_error: Exception | None = None
     for _ in range(3):
         try:
-            data = blob.download_blob().readall()
-            try:
-                return data.decode("utf-8-sig")
-            except UnicodeDecodeError:
-                return data.decode("utf-8", errors="replace")
+            return blob.download_blob(max_concurrency=concurrency)
         except ResourceNotFoundError as exc:
             last_error = exc
             time.sleep(2)
@@ -65,48 +106,262 @@ def _download_blob_text(blob_service: BlobServiceClient, container: str, blob_na
     raise ResourceNotFoundError("Blob not found.")
 
 
+class _BlockBlobWriter(io.RawIOBase):
+    # Stages the output as fixed-size blocks so the serialized payload is
+    # never held in memory as a whole.
+    def __init__(self, blob: BlobClient, block_size: int) -> None:
+        self.blob = blob
+        self.block_size = block_size
+        self.block_ids: List[str] = []
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_size:
+            self._stage(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def _stage(self, chunk: bytes) -> None:
+        block_id = base64.b64encode(uuid.uuid4().hex.encode("ascii")).decode("ascii")
+        self.blob.stage_block(block_id=block_id, data=chunk)
+        self.block_ids.append(block_id)
+
+    def commit(self, content_settings: ContentSettings) -> None:
+        if self._buffer or not self.block_ids:
+            self._stage(bytes(self._buffer))
+            self._buffer.clear()
+        from azure.storage.blob import BlobBlock
+
+        self.blob.commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in self.block_ids],
+            content_settings=content_settings,
+        )
+
+
+def _output_settings() -> tuple[str, bool]:
+    fmt = _env("OUTPUT_FORMAT", "json").lower()
+    return fmt, _env_flag("OUTPUT_GZIP")
+
+
+def _output_name(blob_name: str) -> str:
+    fmt, compress = _output_settings()
+    return f"{os.path.splitext(blob_name)[0]}.classified{output_suffix(fmt, compress)}"
+
+
 def _upload_output(
     blob_service: BlobServiceClient, container: str, blob_name: str, payload: Dict[str, Any]
 ) -> None:
+    from azure.storage.blob import ContentSettings
+
+    fmt, compress = _output_settings()
     blob = blob_service.get_blob_client(container=container, blob=blob_name)
-    body = json.dumps(payload, indent=2, ensure_ascii=False).encode("utf-8")
-    blob.upload_blob(
-        body,
-        overwrite=True,
-        content_settings=ContentSettings(content_type="application/json"),
+    writer = _BlockBlobWriter(blob, int(_env("OUTPUT_BLOCK_SIZE", str(4 * 1024 * 1024))))
+    if compress:
+        with gzip.GzipFile(fileobj=writer, mode="wb") as handle:
+            write_output(handle, payload, fmt)
+    else:
+        write_output(writer, payload, fmt)
+    writer.commit(
+        ContentSettings(
+            content_type=OUTPUT_CONTENT_TYPES[fmt],
+            content_encoding="gzip" if compress else None,
+        )
     )
 
 
+def _upload_sidecar(
+    blob_service: BlobServiceClient, container: str, local_base: str, blob_base: str
+) -> None:
+    concurrency = int(_env("BLOB_DOWNLOAD_CONCURRENCY", "4"))
+    for path in sidecar_files(local_base):
+        name = blob_base + str(path)[len(local_base) :]
+        blob = blob_service.get_blob_client(container=container, blob=name)
+        with open(path, "rb") as handle:
+            blob.upload_blob(handle, overwrite=True, max_concurrency=concurrency)
+
+
 def _process_message(
     blob_service: BlobServiceClient,
     input_container: str,
     output_container: str,
     message_content: str,
+    session: Optional[PipelineSession] = None,
+    checkpoint: Optional[CheckpointStore] = None,
+    fast_lane: bool = False,
+    received_at: Optional[float] = None,
 ) -> Optional[str]:
-    parsed = _parse_message(message_content)
-    if parsed is None:
-        return None
-    events = parsed if isinstance(parsed, list) else [parsed]
-    blob_name = None
-    for event in events:
-        if isinstance(event, dict):
-            blob_name = _extract_blob_name(event, input_container)
-            if blob_name:
-                break
+    blob_name = _message_blob_name(message_content, input_container)
     if not blob_name:
         return None
+    output_name = _output_name(blob_name)
 
-    content = _download_blob_text(blob_service, input_container, blob_name)
-    with tempfile.NamedTemporaryFile(mode="w+", suffix=".json", delete=False) as tmp:
-        tmp.write(content)
-        tmp.flush()
-        payload = run_pipeline(tmp.name)
+    on_provisional = None
+    if fast_lane:
+        # Urgent and complaint threads get rule-based labels under the final
+        # output name right after threading; the full result overwrites them.
+        def on_provisional(provisional: Dict[str, Any]) -> None:
+            # Best effort: a failed preview must not fail the full run.
+            try:
+                _upload_output(blob_service, output_container, output_name, provisional)
+            except Exception as exc:
+                print(f"Provisional upload failed for {output_name}: {exc}")
+                return
+            if received_at is not None:
+                FIRST_LABEL_SECONDS.observe(time.monotonic() - received_at)
 
-    output_name = f"{os.path.splitext(blob_name)[0]}.classified.json"
-    _upload_output(blob_service, output_container, output_name, payload)
+    sidecar_dir = tempfile.mkdtemp(prefix="email-sidecar-") if _env_flag("OUTPUT_EMBEDDINGS") else None
+    local_base = os.path.join(sidecar_dir, "output") if sidecar_dir else None
+    try:
+        source: Any = _open_blob_stream(blob_service, input_container, blob_name)
+        key = ""
+        if checkpoint is not None:
+            key, source = content_key(source)
+        payload = run_pipeline(
+            source,
+            session=session,
+            checkpoint=checkpoint,
+            on_provisional=on_provisional,
+            sidecar=local_base,
+            clear_checkpoint=False,
+            checkpoint_key=key,
+        )
+        _upload_output(blob_service, output_container, output_name, payload)
+        if local_base:
+            _upload_sidecar(blob_service, output_container, local_base, sidecar_base(output_name))
+        # Checkpoints outlive a failed upload so the redelivered message resumes.
+        if checkpoint is not None:
+            release_checkpoint(checkpoint, key, session)
+    finally:
+        if sidecar_dir:
+            shutil.rmtree(sidecar_dir, ignore_errors=True)
     return output_name
 
 
+def _handle_message(
+    queue_client: QueueClient,
+    blob_service: BlobServiceClient,
+    input_container: str,
+    output_container: str,
+    msg: Any,
+    session: PipelineSession,
+    received_at: float,
+    checkpoint: Optional[CheckpointStore] = None,
+    fast_lane: bool = False,
+) -> None:
+    from azure.core.exceptions import ResourceNotFoundError
+
+    try:
+        output_name = _process_message(
+            blob_service,
+            input_container,
+            output_container,
+            msg.content,
+            session,
+            checkpoint,
+            fast_lane=fast_lane,
+            received_at=received_at,
+        )
+        queue_client.delete_message(msg)
+        MESSAGES_PROCESSED.inc()
+        if output_name:
+            print(f"Processed -> {output_name}")
+        else:
+            print("Processed message with no blob.")
+    except ResourceNotFoundError:
+        queue_client.delete_message(msg)
+        MESSAGES_PROCESSED.inc()
+        print("Blob not found; skipping message.")
+    except Exception as exc:
+        MESSAGES_FAILED.inc()
+        print(f"Worker error: {exc}")
+    finally:
+        MESSAGE_SECONDS.observe(time.monotonic() - received_at)
+
+
+def _run_loop(
+    queue_client: QueueClient,
+    blob_service: BlobServiceClient,
+    input_container: str,
+    output_container: str,
+    session: PipelineSession,
+    concurrency: int,
+    checkpoint: Optional[CheckpointStore] = None,
+    fast_lane: bool = False,
+) -> None:
+    in_flight: Set[Future] = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            heartbeat()
+            free = concurrency - len(in_flight)
+            if free > 0:
+                messages = list(
+                    queue_client.receive_messages(
+                        messages_per_page=free, max_messages=free, visibility_timeout=60
+                    )
+                )
+                received_at = time.monotonic()
+                for msg in messages:
+                    in_flight.add(
+                        pool.submit(
+                            _handle_message,
+                            queue_client,
+                            blob_service,
+                            input_container,
+                            output_container,
+                            msg,
+                            session,
+                            received_at,
+                            checkpoint,
+                            fast_lane,
+                        )
+                    )
+                if not messages and not in_flight:
+                    time.sleep(2)
+                    continue
+            _, in_flight = wait(in_flight, timeout=2, return_when=FIRST_COMPLETED)
+
+
+def _run_pipelined(
+    account_name: str,
+    queue_name: str,
+    input_container: str,
+    output_container: str,
+    session: PipelineSession,
+    chunk_size: int,
+    checkpoint: Optional[CheckpointStore] = None,
+    fast_lane: bool = False,
+) -> None:
+    import asyncio
+
+    from .async_worker import AzureStorageBackend, run_pipelined
+
+    async def _serve() -> None:
+        backend = AzureStorageBackend(
+            account_name,
+            queue_name,
+            chunk_size,
+            int(_env("BLOB_DOWNLOAD_CONCURRENCY", "4")),
+            visibility_timeout=int(_env("WORKER_VISIBILITY_TIMEOUT", "300")),
+        )
+        try:
+            await run_pipelined(
+                backend,
+                session,
+                input_container,
+                output_container,
+                checkpoint=checkpoint,
+                fast_lane=fast_lane,
+            )
+        finally:
+            await backend.close()
+
+    asyncio.run(_serve())
+
+
 def main() -> None:
     account_name = _env("STORAGE_ACCOUNT_NAME")
     input_container = _env("INPUT_CONTAINER", "input-email")
@@ -118,6 +373,13 @@ def main() -> None:
 
     if not account_name:
         raise RuntimeError("STORAGE_ACCOUNT_NAME is required.")
+    # Caught here rather than at upload time, where every message would
+    # fail after a full pipeline run and be retried forever.
+    output_format, _ = _output_settings()
+    if output_format not in OUTPUT_FORMATS:
+        raise RuntimeError(f"OUTPUT_FORMAT must be one of {', '.join(OUTPUT_FORMATS)}.")
+    if _env("CHECKPOINT_PREFIX") and not _env("CHECKPOINT_DIR") and not _env("CHECKPOINT_SECRET"):
+        raise RuntimeError("CHECKPOINT_SECRET is required with CHECKPOINT_PREFIX.")
     if endpoint:
         print(f"OpenAI endpoint: {endpoint}")
     if deployment:
@@ -127,38 +389,67 @@ def main() -> None:
     else:
         print("OpenAI key not set.")
 
+    from azure.identity import DefaultAzureCredential
+    from azure.storage.blob import BlobServiceClient
+    from azure.storage.queue import QueueClient
+
     credential = DefaultAzureCredential()
     queue_client = QueueClient(
         account_url=f"https://{account_name}.queue.core.windows.net",
         queue_name=queue_name,
         credential=credential,
     )
+    chunk_size = int(_env("BLOB_CHUNK_SIZE", str(4 * 1024 * 1024)))
     blob_service = BlobServiceClient(
         account_url=f"https://{account_name}.blob.core.windows.net",
         credential=credential,
+        max_single_get_size=chunk_size,
+        max_chunk_get_size=chunk_size,
     )
+    concurrency = max(1, int(_env("WORKER_CONCURRENCY", "4")))
+    # Concurrent messages share one session so their embedding and intent
+    # calls are coalesced by the batching layer.
+    session = PipelineSession.create(batching=concurrency > 1).warm()
+    print(f"Pipeline session warmed (concurrency={concurrency}).")
 
-    while True:
-        messages = queue_client.receive_messages(messages_per_page=1, visibility_timeout=60)
-        found = False
-        for msg in messages:
-            found = True
-            try:
-                output_name = _process_message(
-                    blob_service, input_container, output_container, msg.content
-                )
-                queue_client.delete_message(msg)
-                if output_name:
-                    print(f"Processed -> {output_name}")
-                else:
-                    print("Processed message with no blob.")
-            except ResourceNotFoundError:
-                queue_client.delete_message(msg)
-                print("Blob not found; skipping message.")
-            except Exception as exc:
-                print(f"Worker error: {exc}")
-        if not found:
-            time.sleep(2)
+    checkpoint: Optional[CheckpointStore] = None
+    secret = _env("CHECKPOINT_SECRET").encode("utf-8") or None
+    if _env("CHECKPOINT_DIR"):
+        checkpoint = LocalCheckpointStore(_env("CHECKPOINT_DIR"), secret)
+    elif _env("CHECKPOINT_PREFIX"):
+        checkpoint = BlobCheckpointStore(
+            blob_service.get_container_client(output_container),
+            secret or b"",
+            _env("CHECKPOINT_PREFIX"),
+        )
+
+    WORKER_UP.set(1)
+    try:
+        if _env("WORKER_MODE", "threaded").lower() == "pipelined":
+            _run_pipelined(
+                account_name,
+                queue_name,
+                input_container,
+                output_container,
+                session,
+                chunk_size,
+                checkpoint,
+                fast_lane=_env_flag("WORKER_FAST_LANE"),
+            )
+            return
+        _run_loop(
+            queue_client,
+            blob_service,
+            input_container,
+            output_container,
+            session,
+            concurrency,
+            checkpoint,
+            fast_lane=_env_flag("WORKER_FAST_LANE"),
+        )
+    finally:
+        WORKER_UP.set(0)
+        session.close()
 
 
 if __name__ == "__main__":
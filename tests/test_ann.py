@@ -0,0 +1,81 @@
+import numpy as np
+
+from email_system.ann import LabelIndex
+
+
+def _clustered(rows=600, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(20, dim))
+    return (centers[rng.integers(0, 20, rows)] + rng.normal(scale=0.2, size=(rows, dim))).astype(
+        np.float32
+    )
+
+
+def test_ivf_search_matches_brute_force():
+    vectors = _clustered()
+    index = LabelIndex(min_train_size=200, nprobe=4)
+    for start in range(0, len(vectors), 150):
+        block = vectors[start : start + 150]
+        ids = [f"c{start + i}" for i in range(len(block))]
+        index.add(ids, block, [{"level3": "status_inquiry", "confidence": 0.7}] * len(block))
+    assert index.centroids is not None
+
+    queries = vectors[:50] + 0.01
+    found = index.search(queries, k=1)
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    exact = np.argmax((queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ unit.T, axis=1)
+    recall = np.mean([hits[0].conversation_id == f"c{row}" for hits, row in zip(found, exact)])
+    assert recall >= 0.9
+
+
+def test_updates_in_place_and_round_trips(tmp_path):
+    vectors = _clustered(rows=300)
+    index = LabelIndex(tmp_path / "index.npz", min_train_size=100)
+    index.add([f"c{i}" for i in range(300)], vectors, [{"level3": "complaint"}] * 300)
+    index.add(["c7"], vectors[7], [{"level3": "urgent_escalation"}])
+    assert len(index) == 300
+    index.save()
+
+    loaded = LabelIndex.load(tmp_path / "index.npz")
+    [[best]] = loaded.search(vectors[7], k=1)
+    assert best.conversation_id == "c7"
+    assert best.labels["level3"] == "urgent_escalation"
+    assert best.score > 0.99
+
+
+def test_saves_are_throttled_and_merge_other_writers(tmp_path):
+    path = tmp_path / "index.npz"
+    vectors = np.eye(4, dtype=np.float32)
+    first = LabelIndex(path)
+    second = LabelIndex(path)
+
+    first.add(["a"], vectors[:1], [{"level3": "complaint"}])
+    assert first.maybe_save(interval=3600)
+    first.add(["b"], vectors[1:2], [{"level3": "complaint"}])
+    assert not first.maybe_save(interval=3600)
+
+    second.add(["c", "a"], vectors[2:4], [{"level3": "status_inquiry"}] * 2)
+    second.flush()
+    first.flush()
+
+    merged = LabelIndex.load(path)
+    assert sorted(merged.ids) == ["a", "b", "c"]
+    # "a" was last written by the second process, which first had not touched since.
+    assert merged.labels[merged.ids.index("a")]["level3"] == "status_inquiry"
+
+
+def test_incremental_lists_match_rebuild_and_cap_holds():
+    vectors = _clustered(rows=400)
+    index = LabelIndex(min_train_size=200)
+    index.add([f"c{i}" for i in range(250)], vectors[:250], [{}] * 250)
+    index.add([f"c{i}" for i in range(240, 300)], vectors[::-1][:60], [{}] * 60)
+    incremental = [np.sort(members) for members in index._lists]
+    index._rebuild_lists()
+    assert all((a == b).all() for a, b in zip(incremental, index._lists))
+    assert sum(len(members) for members in incremental) == len(index) == 300
+
+    capped = LabelIndex(max_entries=2)
+    capped.add(["a", "b", "c"], vectors[:3], [{"level3": "complaint"}] * 3)
+    capped.add(["a"], vectors[:1], [{"level3": "status_inquiry"}])
+    assert capped.ids == ["a", "b"]
+    assert capped.labels[0]["level3"] == "status_inquiry"
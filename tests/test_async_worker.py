@@ -0,0 +1,199 @@
+import asyncio
+import gzip
+import json
+import time
+
+from email_system import async_worker
+from email_system.async_worker import LocalStorageBackend, PipelinedSettings, run_pipelined
+from email_system.pipeline import PipelineSession
+
+
+def _blob(index):
+    return [
+        {
+            "id": f"{index}-1",
+            "conversationId": f"c{index}",
+            "subject": "Request for quote",
+            "body": "Hello, I need a quote for cleaning services.",
+            "from": "client@example.com",
+            "sentDateTime": "2024-01-01T10:00:00",
+        }
+    ]
+
+
+def _event(name):
+    return json.dumps({"subject": f"/blobServices/default/containers/input/blobs/{name}"})
+
+
+def _run(backend, session, settings):
+    asyncio.run(
+        run_pipelined(
+            backend, session, "input", "output", settings=settings, stop_when_idle=True, poll_interval=0.05
+        )
+    )
+
+
+def test_pipelined_worker_processes_queue(tmp_path, monkeypatch):
+    monkeypatch.delenv("OUTPUT_GZIP", raising=False)
+    monkeypatch.delenv("OUTPUT_EMBEDDINGS", raising=False)
+    backend = LocalStorageBackend(tmp_path)
+    for index in range(3):
+        backend.put_blob("input", f"batch/{index}.json", json.dumps(_blob(index)).encode("utf-8"))
+        backend.send(_event(f"batch/{index}.json"))
+    backend.send(_event("batch/missing.json"))
+    backend.send("not a blob event")
+
+    _run(backend, PipelineSession.create().warm(), PipelinedSettings(prefetch=2, compute=2, uploads=2))
+
+    assert len(backend.deleted) == 5
+    for index in range(3):
+        output = json.loads((tmp_path / "output" / "batch" / f"{index}.classified.json").read_text())
+        assert output["summary"]["conversations"] == 1
+    assert not (tmp_path / "output" / "batch" / "missing.classified.json").exists()
+
+
+def test_pipelined_worker_overlaps_network_and_compute(tmp_path, monkeypatch):
+    monkeypatch.delenv("OUTPUT_EMBEDDINGS", raising=False)
+    latency = 0.2
+    backend = LocalStorageBackend(tmp_path, latency=latency)
+    blobs = 6
+    for index in range(blobs):
+        backend.put_blob("input", f"{index}.json", json.dumps(_blob(index)).encode("utf-8"))
+        backend.send(_event(f"{index}.json"))
+    session = PipelineSession.create().warm()
+
+    start = time.perf_counter()
+    _run(backend, session, PipelinedSettings(prefetch=blobs, compute=2, uploads=blobs))
+    elapsed = time.perf_counter() - start
+
+    # Processed one at a time, every blob pays a download, an upload and a
+    # delete round trip.
+    assert len(backend.deleted) == blobs
+    assert elapsed < blobs * 3 * latency / 2
+
+
+def test_failed_provisional_upload_does_not_fail_message(tmp_path, monkeypatch):
+    monkeypatch.delenv("OUTPUT_EMBEDDINGS", raising=False)
+
+    class FlakyBackend(LocalStorageBackend):
+        failures = 0
+
+        async def commit_blocks(self, container, name, block_ids, content_type=None, content_encoding=None):
+            if not self.failures:
+                self.failures += 1
+                raise ConnectionError("transient blob error")
+            await super().commit_blocks(container, name, block_ids, content_type, content_encoding)
+
+    backend = FlakyBackend(tmp_path)
+    urgent = _blob(0)
+    urgent[0]["body"] = "Our service is down, please fix this urgent issue asap."
+    backend.put_blob("input", "urgent.json", json.dumps(urgent).encode("utf-8"))
+    backend.send(_event("urgent.json"))
+
+    asyncio.run(
+        run_pipelined(
+            backend,
+            PipelineSession.create().warm(),
+            "input",
+            "output",
+            settings=PipelinedSettings(prefetch=1, compute=1, uploads=1),
+            fast_lane=True,
+            stop_when_idle=True,
+            poll_interval=0.05,
+        )
+    )
+
+    assert backend.failures == 1
+    assert len(backend.deleted) == 1
+    output = json.loads((tmp_path / "output" / "urgent.classified.json").read_text())
+    assert "provisional" not in output["summary"]
+
+
+def test_pipelined_worker_streams_output_in_blocks(tmp_path, monkeypatch):
+    monkeypatch.delenv("OUTPUT_EMBEDDINGS", raising=False)
+    monkeypatch.setenv("OUTPUT_GZIP", "1")
+    backend = LocalStorageBackend(tmp_path)
+    backend.put_blob("input", "big.json", json.dumps(_blob(0) * 50).encode("utf-8"))
+    backend.send(_event("big.json"))
+    staged = []
+    stage_block = backend.stage_block
+
+    async def _record(container, name, block_id, data):
+        staged.append(len(data))
+        await stage_block(container, name, block_id, data)
+
+    monkeypatch.setattr(backend, "stage_block", _record)
+
+    _run(backend, PipelineSession.create().warm(), PipelinedSettings(spool_size=64, block_size=256))
+
+    assert len(staged) > 1 and max(staged) <= 256
+    assert not backend.staged
+    output = json.loads(gzip.decompress((tmp_path / "output" / "big.classified.json.gz").read_bytes()))
+    assert output["summary"]["conversations"] == 1
+
+
+def test_pipelined_heartbeat_ticks_under_backpressure(tmp_path, monkeypatch):
+    monkeypatch.delenv("OUTPUT_EMBEDDINGS", raising=False)
+    ticks = []
+    monkeypatch.setattr(async_worker, "heartbeat", lambda: ticks.append(time.monotonic()))
+
+    class SlowCommitBackend(LocalStorageBackend):
+        async def commit_blocks(self, *args, **kwargs):
+            await asyncio.sleep(0.5)
+            await super().commit_blocks(*args, **kwargs)
+
+    backend = SlowCommitBackend(tmp_path)
+    for index in range(4):
+        backend.put_blob("input", f"{index}.json", json.dumps(_blob(index)).encode("utf-8"))
+        backend.send(_event(f"{index}.json"))
+
+    asyncio.run(
+        run_pipelined(
+            backend,
+            PipelineSession.create().warm(),
+            "input",
+            "output",
+            settings=PipelinedSettings(prefetch=1, compute=1, uploads=1),
+            stop_when_idle=True,
+            poll_interval=0.05,
+            heartbeat_interval=0.05,
+        )
+    )
+
+    # Receive is blocked behind the slow uploads for most of the run.
+    assert len(backend.deleted) == 4
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.3
+
+
+def test_pipelined_worker_renews_visibility_of_waiting_messages(tmp_path, monkeypatch):
+    monkeypatch.delenv("OUTPUT_EMBEDDINGS", raising=False)
+    run_pipeline = async_worker.run_pipeline
+    runs = []
+
+    def slow_pipeline(*args, **kwargs):
+        runs.append(1)
+        time.sleep(0.4)
+        return run_pipeline(*args, **kwargs)
+
+    monkeypatch.setattr(async_worker, "run_pipeline", slow_pipeline)
+    backend = LocalStorageBackend(tmp_path, visibility_timeout=0.3)
+    for index in range(3):
+        backend.put_blob("input", f"{index}.json", json.dumps(_blob(index)).encode("utf-8"))
+        backend.send(_event(f"{index}.json"))
+
+    # Each message waits or computes for longer than the visibility timeout,
+    # so without renewals they would be delivered and processed again.
+    pipelined = run_pipelined(
+        backend,
+        PipelineSession.create().warm(),
+        "input",
+        "output",
+        settings=PipelinedSettings(prefetch=1, compute=1, uploads=1),
+        stop_when_idle=True,
+        poll_interval=0.05,
+    )
+    asyncio.run(asyncio.wait_for(pipelined, timeout=15))
+
+    assert backend.renewed > 0
+    assert len(runs) == 3
+    assert len(backend.deleted) == 3
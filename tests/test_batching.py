@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+from email_system.batching import BatchingEmbedder, BatchingIntentClassifier, MicroBatcher
+from email_system.embedding import MockEmbedder
+from email_system.intent import IntentClassifier
+
+
+def test_micro_batcher_coalesces_concurrent_calls():
+    calls = []
+    release = threading.Event()
+
+    def fn(items):
+        calls.append(list(items))
+        release.wait(timeout=5)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(fn, max_items=64, max_wait=0.05, dispatchers=1)
+    results = {}
+
+    def submit(key, items):
+        results[key] = batcher.submit(items)
+
+    threads = [threading.Thread(target=submit, args=(i, [i, i + 10])) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    # Hold the first call open until every other request is queued behind it.
+    deadline = time.monotonic() + 5
+    while sum(len(call) for call in calls) // 2 + batcher._queue.qsize() < 5:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+
+    assert results == {i: [i * 2, (i + 10) * 2] for i in range(5)}
+    assert len(calls) <= 2
+
+
+def test_batching_embedder_matches_inner():
+    inner = MockEmbedder()
+    batching = BatchingEmbedder(inner, max_items=8, max_wait=0.01)
+    texts = ["alpha", "beta", "gamma"]
+    assert (batching.embed(texts) == inner.embed(texts)).all()
+
+
+class _FakeChat:
+    def __init__(self):
+        self.prompts = []
+        self.completions = self
+
+    def create(self, messages, **kwargs):
+        user = messages[-1]["content"]
+        self.prompts.append(user)
+        if user.startswith("### "):
+            count = user.count("### ")
+            data = {"results": [{"index": str(i), "level3": "complaint", "confidence": 0.9} for i in range(count)]}
+        else:
+            data = {"level3": "complaint", "confidence": 0.9}
+        message = SimpleNamespace(content=json.dumps(data))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def _with_fake_llm(classifier, monkeypatch):
+    fake = _FakeChat()
+    monkeypatch.setattr(classifier, "_llm_enabled", lambda: True)
+    monkeypatch.setattr(classifier, "_client", lambda: SimpleNamespace(chat=fake))
+    return fake
+
+
+def test_intent_packing_is_limited_to_batching_classifier(monkeypatch):
+    monkeypatch.setenv("INTENT_MAX_TOKENS", "1500")
+    monkeypatch.setenv("AZURE_OPENAI_INTENT_BATCH_SIZE", "8")
+    texts = [f"thread {i} " + "word " * 400 for i in range(4)]
+
+    plain = IntentClassifier(embedder=MockEmbedder())
+    fake = _with_fake_llm(plain, monkeypatch)
+    assert [r.level3 for r in plain.classify_many(texts)] == ["complaint"] * 4
+    assert len(fake.prompts) == 4
+
+    batching = BatchingIntentClassifier(embedder=MockEmbedder(), max_wait=0.0)
+    fake = _with_fake_llm(batching, monkeypatch)
+    assert [r.level3 for r in batching.classify_many(texts)] == ["complaint"] * 4
+    # String indexes are accepted, and no thread is cut below its own budget.
+    assert len(fake.prompts) == 1
+    assert all(text.strip() in fake.prompts[0] for text in texts)
@@ -0,0 +1,73 @@
+import numpy as np
+
+from email_system.cluster import (
+    assign_clusters,
+    cluster_embeddings,
+    cluster_out_of_core,
+    cluster_sharded,
+    load_cluster_model,
+    save_cluster_model,
+)
+from email_system.embedding_store import EmbeddingStore, open_embeddings
+
+
+def test_cluster_model_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    centers = np.eye(3, 8, dtype=np.float32) * 5
+    embeddings = np.vstack([center + rng.normal(scale=0.05, size=(10, 8)) for center in centers])
+    texts = [f"topic{i // 10} shipment invoice" for i in range(len(embeddings))]
+
+    fitted = cluster_embeddings(texts, embeddings.astype(np.float32))
+    path = tmp_path / "model.pkl"
+    save_cluster_model(path, fitted)
+
+    assigned = assign_clusters(load_cluster_model(path), embeddings[[0, 15, 25]].astype(np.float32))
+    assert assigned.labels == [fitted.labels[0], fitted.labels[15], fitted.labels[25]]
+    assert assigned.level2_map == fitted.level2_map
+
+
+def test_cluster_out_of_core_from_memmap(tmp_path):
+    rng = np.random.default_rng(1)
+    centers = np.eye(3, 8, dtype=np.float32) * 5
+    store = EmbeddingStore(tmp_path / "emb.npy", rows=90, dim=8)
+    for center in centers:
+        store.append((center + rng.normal(scale=0.05, size=(30, 8))).astype(np.float32))
+    store.close()
+    texts = [f"topic{i // 30} shipment invoice" for i in range(90)]
+
+    result = cluster_out_of_core(
+        texts,
+        open_embeddings(tmp_path / "emb.npy"),
+        sample_size=45,
+        chunk_size=20,
+        labels_path=tmp_path / "labels.npy",
+    )
+
+    labels = np.load(tmp_path / "labels.npy")
+    assert list(labels) == list(result.labels)
+    for group in range(3):
+        members = set(labels[group * 30 : (group + 1) * 30].tolist()) - {-1}
+        assert len(members) == 1
+
+
+def test_cluster_sharded_merges_shard_clusters(tmp_path):
+    rng = np.random.default_rng(2)
+    centers = np.eye(4, 8, dtype=np.float32) * 5
+    embeddings = np.vstack(
+        [center + rng.normal(scale=0.05, size=(15, 8)) for center in centers]
+    ).astype(np.float32)
+    texts = [f"topic{i // 15} shipment invoice" for i in range(60)]
+    shard_keys = ["en" if i < 30 else "es" for i in range(60)]
+
+    result = cluster_sharded(texts, embeddings, shard_keys, min_shard_size=10, workers=2)
+
+    groups = [set(result.labels[i * 15 : (i + 1) * 15]) - {-1} for i in range(4)]
+    assert all(len(group) == 1 for group in groups)
+    assert len(set.union(*groups)) == 4
+    assert set(result.level1_map) == set(result.level2_map)
+
+    path = tmp_path / "model.pkl"
+    save_cluster_model(path, result)
+    outlier = np.ones((1, 8), dtype=np.float32)
+    assigned = assign_clusters(load_cluster_model(path), np.vstack([embeddings[[0, 50]], outlier]))
+    assert assigned.labels == [result.labels[0], result.labels[50], -1]
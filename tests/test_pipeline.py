@@ -1,10 +1,19 @@
+import io
 import json
+import pickle
+import tempfile
 
-from email_system.pipeline import run_pipeline
+import pytest
 
+from email_system import pipeline
+from email_system.ann import LabelIndex
+from email_system.checkpoint import LocalCheckpointStore, content_key
+from email_system.cluster import OutOfCoreSettings
+from email_system.pipeline import PipelineSession, release_checkpoint, run_pipeline
 
-def test_pipeline_runs(tmp_path):
-    payload = [
+
+def _sample_payload():
+    return [
         {
             "id": "1",
             "conversationId": "c1",
@@ -23,9 +32,196 @@ def test_pipeline_runs(tmp_path):
             "sentDateTime": "2024-01-01T11:00:00",
         },
     ]
+
+
+def test_pipeline_runs(tmp_path):
+    payload = _sample_payload()
     path = tmp_path / "emails.json"
     path.write_text(json.dumps(payload), encoding="utf-8")
 
     output = run_pipeline(str(path))
     assert output["summary"]["conversations"] == 1
     assert output["conversations"][0]["labels"]["level3"]
+
+
+def test_pipeline_accepts_in_memory_sources():
+    payload = _sample_payload()
+    raw = b"\xef\xbb\xbf" + json.dumps(payload).encode("utf-8")
+
+    from_bytes = run_pipeline(raw)
+    from_stream = run_pipeline(io.BytesIO(raw))
+    from_records = run_pipeline(payload)
+
+    for output in (from_bytes, from_stream, from_records):
+        assert output["summary"]["input_emails"] == 2
+        assert output["summary"]["conversations"] == 1
+
+
+def test_session_reused_across_runs():
+    session = PipelineSession.create().warm()
+    first = run_pipeline(_sample_payload(), session=session)
+    misses = session.embedder.misses
+    second = run_pipeline(_sample_payload(), session=session)
+
+    assert session.embedder.misses == misses
+    assert second["conversations"] == first["conversations"]
+
+
+def test_pipeline_resumes_from_checkpoint(tmp_path):
+    store = LocalCheckpointStore(tmp_path / "checkpoints")
+    raw = json.dumps(_sample_payload()).encode("utf-8")
+    key, _ = content_key(raw)
+
+    class Interrupted(Exception):
+        pass
+
+    class FailingClassifier:
+        def classify_many(self, texts, embeddings=None):
+            raise Interrupted()
+
+    session = PipelineSession.create().warm()
+    warm_classifier = session.intent_classifier
+    session.intent_classifier = FailingClassifier()
+    try:
+        run_pipeline(raw, session=session, checkpoint=store)
+    except Interrupted:
+        pass
+    assert store.load(key, "clusters") is not None
+    assert store.load(key, "intents") is None
+
+    session.intent_classifier = warm_classifier
+    misses = session.embedder.misses
+    output = run_pipeline(io.BytesIO(raw), session=session, checkpoint=store)
+    assert session.embedder.misses == misses
+    assert output["summary"]["conversations"] == 1
+    assert not (tmp_path / "checkpoints" / key).exists()
+
+
+def test_checkpoints_kept_until_caller_clears(tmp_path, monkeypatch):
+    store = LocalCheckpointStore(tmp_path / "checkpoints")
+    raw = json.dumps(_sample_payload()).encode("utf-8")
+    key, _ = content_key(raw)
+
+    # A precomputed key is used as is; the input is not hashed again.
+    monkeypatch.setattr(pipeline, "content_key", None)
+    run_pipeline(raw, checkpoint=store, clear_checkpoint=False, checkpoint_key=key)
+    assert store.load(key, "intents") is not None
+    store.clear(key)
+    assert store.load(key, "intents") is None
+
+
+def test_signed_checkpoints_reject_tampering(tmp_path):
+    store = LocalCheckpointStore(tmp_path, secret=b"secret")
+    store.save("k", "intents", [("complaint", 0.8)])
+    assert store.load("k", "intents") == [("complaint", 0.8)]
+
+    path = tmp_path / "k" / "intents.pkl"
+    forged = pickle.dumps([("urgent_escalation", 1.0)])
+    path.write_bytes(path.read_bytes()[:32] + forged)
+    assert store.load("k", "intents") is None
+    assert LocalCheckpointStore(tmp_path, secret=b"other").load("k", "intents") is None
+
+
+def _order_payload(count):
+    return [
+        {
+            "id": str(i),
+            "conversationId": f"c{i}",
+            "subject": f"Order {i} status",
+            "body": f"Hello, what is the status of order number {i}?",
+            "from": "client@example.com",
+        }
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("assign_method", ["approximate", "centroid"])
+def test_pipeline_out_of_core_mode(assign_method):
+    session = PipelineSession.create()
+    session.out_of_core = OutOfCoreSettings(
+        mode="out_of_core", sample_size=12, chunk_size=7, assign_method=assign_method
+    )
+
+    output = run_pipeline(_order_payload(30), session=session)
+    assert output["summary"]["cluster_mode"] == "out_of_core"
+    assert output["summary"]["conversations"] == 30
+    assert len(output["conversations"]) == 30
+
+
+def test_out_of_core_store_removed_when_a_stage_fails(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    session = PipelineSession.create()
+    session.out_of_core = OutOfCoreSettings(mode="out_of_core", sample_size=12, chunk_size=7)
+
+    class FailingClassifier:
+        def classify_many(self, texts, embeddings=None):
+            raise RuntimeError("intent service down")
+
+    session.intent_classifier = FailingClassifier()
+    with pytest.raises(RuntimeError):
+        run_pipeline(_order_payload(30), session=session)
+    assert not list(tmp_path.glob("email-embeddings-*"))
+
+
+
+def test_out_of_core_store_dir_keeps_files_only_for_checkpoints(tmp_path):
+    store_dir = tmp_path / "store"
+    store_dir.mkdir()
+    session = PipelineSession.create()
+    session.out_of_core = OutOfCoreSettings(
+        mode="out_of_core", sample_size=12, chunk_size=7, store_dir=str(store_dir)
+    )
+    for _ in range(3):
+        run_pipeline(_order_payload(30), session=session)
+    assert not list(store_dir.iterdir())
+
+    checkpoint = LocalCheckpointStore(tmp_path / "checkpoints")
+    raw = json.dumps(_order_payload(30)).encode("utf-8")
+    key, _ = content_key(raw)
+    run_pipeline(raw, session=session, checkpoint=checkpoint, clear_checkpoint=False)
+    assert (store_dir / f"{key}-embeddings.npy").exists()
+    release_checkpoint(checkpoint, key, session)
+    assert not list(store_dir.iterdir())
+    assert checkpoint.load(key, "intents") is None
+
+
+def test_fast_lane_emits_provisional_urgent_labels():
+    payload = _sample_payload() + [
+        {
+            "id": "3",
+            "conversationId": "c2",
+            "subject": "Service outage",
+            "body": "Our service is down, please fix this urgent issue asap.",
+            "from": "client@example.com",
+        }
+    ]
+    provisional = []
+
+    output = run_pipeline(payload, on_provisional=provisional.append)
+
+    assert len(provisional) == 1
+    assert provisional[0]["summary"]["provisional"] is True
+    [urgent] = provisional[0]["conversations"]
+    assert urgent["conversation_id"] == "c2"
+    assert urgent["labels"]["level3"] == "urgent_escalation"
+    assert "provisional" not in output["summary"]
+    assert len(output["conversations"]) == 2
+
+
+def test_label_index_reuses_intents_for_known_threads():
+    session = PipelineSession.create()
+    session.label_index = LabelIndex()
+    run_pipeline(_sample_payload(), session=session)
+    assert len(session.label_index) == 1
+
+    classified = []
+    classify_many = session.intent_classifier.classify_many
+
+    def counting(texts, embeddings=None):
+        classified.extend(texts)
+        return classify_many(texts, embeddings)
+
+    session.intent_classifier.classify_many = counting
+    output = run_pipeline(_sample_payload(), session=session)
+    assert classified == []
+    assert output["conversations"][0]["labels"]["level3"]
@@ -0,0 +1,84 @@
+import math
+
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+
+from email_system.embedding import CachedEmbedder, DiskEmbeddingCache, MockEmbedder
+from email_system.embedding_store import EmbeddingStore, open_embeddings
+from email_system.eval import average_intra_cluster_similarity, dunn_index
+from email_system.quantize import quantize
+
+
+def _vectors(rows=200, dim=64):
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(rows, dim)).astype(np.float32)
+
+
+def test_quantized_rows_close_to_float32():
+    vectors = _vectors()
+    for dtype, tolerance in (("float16", 1e-2), ("int8", 5e-2)):
+        quantized = quantize(vectors, dtype)
+        assert quantized.nbytes < vectors.nbytes
+        assert np.allclose(quantized[:], vectors, atol=tolerance)
+        assert np.allclose(quantized[[3, 7]], vectors[[3, 7]], atol=tolerance)
+
+
+def test_int8_store_round_trip(tmp_path):
+    vectors = _vectors()
+    store = EmbeddingStore(tmp_path / "emb.npy", rows=len(vectors), dim=vectors.shape[1], dtype="int8")
+    store.append(vectors[:120])
+    store.append(vectors[120:])
+    store.close()
+
+    loaded = open_embeddings(tmp_path / "emb.npy")
+    assert loaded.dtype == "int8"
+    assert np.allclose(loaded[50:60], vectors[50:60], atol=5e-2)
+
+
+def test_quantized_caches_return_float32(tmp_path):
+    vectors = MockEmbedder().embed(["alpha", "beta"])
+    first = CachedEmbedder(MockEmbedder(), disk=DiskEmbeddingCache(tmp_path, "mock", "int8"), dtype="int8")
+    first.embed(["alpha", "beta"])
+    cached = first.embed(["beta"])
+    assert cached.dtype == np.float32
+    assert np.allclose(cached[0], vectors[1], atol=1e-2)
+
+    second = CachedEmbedder(MockEmbedder(dim=4), disk=DiskEmbeddingCache(tmp_path, "mock", "int8"))
+    assert np.allclose(second.embed(["alpha"])[0], vectors[0], atol=1e-2)
+
+
+def _reference_metrics(embeddings, labels):
+    # The original full-matrix formulation the block-wise metrics replaced.
+    labels = np.asarray(labels)
+    clusters = [label for label in sorted(set(labels.tolist())) if label != -1]
+    sims = cosine_similarity(embeddings)
+    intra = []
+    for label in clusters:
+        idx = np.flatnonzero(labels == label)
+        if len(idx) > 1:
+            intra.append((sims[np.ix_(idx, idx)].sum() - len(idx)) / (len(idx) * (len(idx) - 1)))
+    dist = 1 - sims
+    intra_max = max(
+        dist[np.ix_(np.flatnonzero(labels == label), np.flatnonzero(labels == label))].max()
+        for label in clusters
+    )
+    inter_min = math.inf
+    for i, label_a in enumerate(clusters):
+        for label_b in clusters[i + 1 :]:
+            pair = dist[np.ix_(np.flatnonzero(labels == label_a), np.flatnonzero(labels == label_b))]
+            inter_min = min(inter_min, pair.min())
+    return sum(intra) / len(intra), inter_min / intra_max
+
+
+def test_blockwise_metrics_match_on_quantized_input():
+    vectors = _vectors()
+    labels = [i % 4 for i in range(len(vectors))]
+    labels[0] = -1
+    exact_sim, exact_dunn = _reference_metrics(vectors, labels)
+    for block_rows in (32, 4096):
+        assert abs(average_intra_cluster_similarity(vectors, labels, block_rows) - exact_sim) < 1e-5
+        assert abs(dunn_index(vectors, labels, block_rows) - exact_dunn) < 1e-5
+
+    quantized = quantize(vectors, "int8")
+    assert abs(average_intra_cluster_similarity(quantized, labels) - exact_sim) < 1e-2
+    assert abs(dunn_index(quantized, labels, block_rows=32) - exact_dunn) < 1e-2
@@ -0,0 +1,57 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from email_system.embedding import CachedEmbedder, DiskEmbeddingCache, MockEmbedder
+from email_system.runner import Job, expand_inputs, load_manifest, run_jobs
+
+
+EMAILS = [
+    {
+        "id": "1",
+        "conversationId": "c1",
+        "subject": "Request for quote",
+        "body": "Hello, I need a quote for cleaning services.",
+        "from": "client@example.com",
+    }
+]
+
+
+def test_disk_cache_shared_between_embedders(tmp_path):
+    first = CachedEmbedder(MockEmbedder(), disk=DiskEmbeddingCache(tmp_path, "mock"))
+    vectors = first.embed(["alpha", "beta"])
+
+    second = CachedEmbedder(MockEmbedder(dim=4), disk=DiskEmbeddingCache(tmp_path, "mock"))
+    assert np.array_equal(second.embed(["beta", "alpha"]), vectors[::-1])
+
+
+def test_run_jobs_from_manifest(tmp_path):
+    for name in ("a", "b"):
+        (tmp_path / f"{name}.json").write_text(json.dumps(EMAILS), encoding="utf-8")
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text(f"{tmp_path / 'a.json'}\n# skipped\n{tmp_path / 'b.json'}\n", encoding="utf-8")
+
+    jobs = load_manifest(manifest, tmp_path / "out", ".json")
+    report = run_jobs(jobs, workers=2, cache_dir=str(tmp_path / "cache"))
+
+    assert report.summary()["succeeded"] == 2
+    assert (tmp_path / "out" / "a.classified.json").exists()
+    assert (tmp_path / "out" / "b.classified.json").exists()
+
+
+def test_outputs_keep_input_directories(tmp_path):
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "x.json").write_text(json.dumps(EMAILS), encoding="utf-8")
+
+    jobs = expand_inputs([str(tmp_path / "*" / "x.json")], tmp_path / "out", ".json")
+    assert [job.output_path for job in jobs] == [
+        os.path.join(tmp_path, "out", "a", "x.classified.json"),
+        os.path.join(tmp_path, "out", "b", "x.classified.json"),
+    ]
+
+    clash = [Job("a.json", "out.json"), Job("b.json", "out.json")]
+    with pytest.raises(ValueError, match="both write"):
+        run_jobs(clash, workers=1)
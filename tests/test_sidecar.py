@@ -0,0 +1,48 @@
+import json
+
+from typer.testing import CliRunner
+
+from email_system.cli import app
+from email_system.pipeline import run_pipeline
+from email_system.sidecar import open_sidecar, sidecar_base
+
+
+def _payload():
+    return [
+        {
+            "id": str(i),
+            "conversationId": f"c{i}",
+            "subject": f"Order {i} status" if i % 2 else f"Quote request {i}",
+            "body": f"Hello, what is the status of order number {i}?"
+            if i % 2
+            else f"Hello, I need a quote for cleaning services at site {i}.",
+            "from": "client@example.com",
+        }
+        for i in range(20)
+    ]
+
+
+def test_sidecar_round_trip_and_recluster(tmp_path):
+    output_path = tmp_path / "run.classified.json"
+    base = sidecar_base(output_path)
+    output = run_pipeline(_payload(), sidecar=base)
+
+    sidecar = open_sidecar(output_path)
+    assert sidecar.conversation_ids == [row["conversation_id"] for row in output["conversations"]]
+    assert sidecar.embeddings.shape[0] == 20
+
+    runner = CliRunner()
+    recluster_path = tmp_path / "recluster.json"
+    result = runner.invoke(
+        app, ["recluster", base, str(recluster_path), "--min-cluster-size", "3"]
+    )
+    assert result.exit_code == 0, result.output
+    reclustered = json.loads(recluster_path.read_text(encoding="utf-8"))
+    assert reclustered["summary"]["min_cluster_size"] == 3
+    assert len(reclustered["conversations"]) == 20
+
+    result = runner.invoke(app, ["evaluate", base, "--labels", str(recluster_path)])
+    assert result.exit_code == 0, result.output
+    metrics = json.loads(result.output)
+    assert metrics["conversations"] == 20
+    assert metrics["avg_intra_cluster_similarity"] == reclustered["summary"]["avg_intra_cluster_similarity"]
@@ -26,3 +26,42 @@ def test_build_conversations():
     conversations = build_conversations(emails)
     assert len(conversations) == 1
     assert conversations[0].metadata["thread_length"] == 2
+
+
+def test_build_conversations_drops_repeated_paragraphs():
+    original = "We need a quote for 10 licenses.\n\nPlease include support."
+    emails = [
+        EmailRecord(
+            message_id="1",
+            conversation_id="thread-b",
+            subject="Quote",
+            body=original,
+            sender="client@example.com",
+            date=datetime(2024, 1, 1, 10, 0, 0),
+        ),
+        EmailRecord(
+            message_id="2",
+            conversation_id="thread-b",
+            subject="Re: Quote",
+            body="Sure, sending it today.\n\n> We need a quote for 10 licenses.\n>\n> Please include  support.",
+            sender="agent@example.com",
+            date=datetime(2024, 1, 1, 11, 0, 0),
+        ),
+    ]
+    conversations = build_conversations(emails)
+    assert conversations[0].merged_body == (
+        "We need a quote for 10 licenses.\n\nPlease include support.\n\nSure, sending it today."
+    )
+
+
+def test_build_conversations_can_release_bodies():
+    email = EmailRecord(
+        message_id="1",
+        conversation_id="thread-c",
+        subject="Status",
+        body="Any update on my order?",
+        sender="client@example.com",
+    )
+    conversations = build_conversations([email], release_bodies=True)
+    assert conversations[0].merged_body == "Any update on my order?"
+    assert email.body == ""
@@ -0,0 +1,71 @@
+from email_system.embedding import MockEmbedder, embed_pooled
+from email_system.models import Conversation
+from email_system.tokens import estimate_tokens, token_windows, truncate_to_tokens
+
+
+def _conversation(paragraphs):
+    return Conversation(
+        conversation_id="c1",
+        emails=[],
+        merged_subject="service request",
+        merged_body="\n\n".join(paragraphs),
+        attachment_names=[],
+        metadata={"thread_length": len(paragraphs)},
+    )
+
+
+def test_truncate_and_windows():
+    text = "one two six four five, seventeen"
+    assert estimate_tokens(text) == 9
+    assert truncate_to_tokens(text, 3) == "one two six"
+    assert token_windows(text, 4) == ["one two six four", "five,", "seventeen"]
+
+
+def test_estimate_counts_cjk_and_digits_conservatively():
+    assert estimate_tokens("请尽快处理这个问题") == 9
+    assert estimate_tokens("order 1234567890") == 6
+    assert token_windows("", 4) == [""]
+
+
+def test_budgeted_text_keeps_oldest_and_newest():
+    paragraphs = ["first message asks for a quote"]
+    paragraphs += [f"middle reply number {i} " * 20 for i in range(10)]
+    paragraphs += ["latest message is urgent"]
+    convo = _conversation(paragraphs)
+
+    text = convo.embedding_text(max_tokens=60)
+    assert estimate_tokens(text) <= 65
+    assert "first message" in text
+    assert "latest message is urgent" in text
+    assert "Metadata: thread_length:12" in text
+    assert convo.embedding_text() == convo.embedding_text(max_tokens=100000)
+
+
+
+def test_budgeted_text_keeps_newest_after_huge_first_message():
+    convo = _conversation(["opening " * 5000, "newest reply urgent"])
+    text = convo.embedding_text(max_tokens=300)
+    assert "newest reply urgent" in text
+    assert text.startswith("service request\nopening opening")
+    assert estimate_tokens(text) <= 305
+
+
+def test_budgeted_text_groups_paragraphs_by_message():
+    from email_system.models import EmailRecord
+    from email_system.threading import build_conversations
+
+    bodies = ["Please quote.\n\nWe need cleaning.", "big " * 200 + "\n\nmore " * 200, "Still waiting.\n\nAny update?"]
+    emails = [
+        EmailRecord(message_id=str(i), conversation_id="c", subject="quote", body=body, sender="a@example.com")
+        for i, body in enumerate(bodies)
+    ]
+    text = build_conversations(emails)[0].embedding_text(max_tokens=70)
+    # Whole first and last messages survive; the oversized middle one is skipped.
+    assert "Please quote.\n\nWe need cleaning.\n\n[...]\n\nStill waiting.\n\nAny update?" in text
+
+
+def test_pooled_embeddings_are_normalized():
+    texts = ["short text", "word " * 50]
+    vectors = embed_pooled(MockEmbedder(), texts, window_tokens=10)
+    assert vectors.shape == (2, 32)
+    assert abs(float((vectors[1] ** 2).sum()) - 1.0) < 1e-4
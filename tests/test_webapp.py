@@ -0,0 +1,123 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+
+from email_system.embedding import Embedder
+from email_system.pipeline import PipelineSession
+from email_system.webapp import ClassifyService, HealthHandler
+
+
+EMAIL = {
+    "id": "1",
+    "conversationId": "c1",
+    "subject": "Urgent problem",
+    "body": "Our service is down, please fix this urgent issue asap.",
+    "from": "client@example.com",
+}
+
+
+class _FlatEmbedder(Embedder):
+    # Zero vectors score 0 against every intent description, so intents come
+    # from the keyword rules regardless of hash seeds.
+    def embed(self, texts):
+        return np.zeros((len(list(texts)), 8), dtype=np.float32)
+
+
+class _FailingService:
+    def classify(self, emails):
+        raise RuntimeError("embeddings unavailable")
+
+
+def _post(port, payload, headers=None):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/classify",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json", **(headers or {})},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as exc:
+        return exc.code, json.loads(exc.read())
+
+
+def _serve(service):
+    HealthHandler.classify_service = service
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_classify_endpoint():
+    server = _serve(ClassifyService(PipelineSession.create(embedder=_FlatEmbedder()).warm()))
+    try:
+        status, body = _post(server.server_address[1], EMAIL)
+        assert status == 200
+        assert body["filtered_out"] == 0
+        assert body["conversations"][0]["conversation_id"] == "c1"
+        assert body["conversations"][0]["labels"]["level3"] == "urgent_escalation"
+
+        status, _ = _post(server.server_address[1], {"emails": []})
+        assert status == 400
+    finally:
+        server.shutdown()
+        HealthHandler.classify_service = None
+
+
+def test_classify_endpoint_reports_errors(monkeypatch):
+    server = _serve(_FailingService())
+    try:
+        status, body = _post(server.server_address[1], EMAIL)
+        assert status == 500
+        assert body["error"] == "classification failed"
+
+        status, body = _post(server.server_address[1], EMAIL, {"Content-Length": "abc"})
+        assert status == 400
+        status, body = _post(server.server_address[1], EMAIL, {"Content-Length": "-1"})
+        assert status == 400
+
+        monkeypatch.setenv("CLASSIFY_MAX_BODY_BYTES", "16")
+        status, body = _post(server.server_address[1], EMAIL)
+        assert status == 413
+    finally:
+        server.shutdown()
+        HealthHandler.classify_service = None
+
+
+def test_classify_endpoint_sheds_load():
+    server = _serve(ClassifyService(PipelineSession.create(), max_pending=1))
+    HealthHandler.classify_service._slots.acquire()
+    try:
+        status, _ = _post(server.server_address[1], EMAIL)
+        assert status == 503
+    finally:
+        server.shutdown()
+        HealthHandler.classify_service = None
+
+
+def test_health_reflects_worker_and_metrics_exposed():
+    server = _serve(None)
+    HealthHandler.worker_thread = threading.Thread(target=lambda: None)
+    HealthHandler.worker_thread.start()
+    HealthHandler.worker_thread.join()
+    port = server.server_address[1]
+    try:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=5)
+            status = 200
+        except urllib.error.HTTPError as exc:
+            status = exc.code
+        assert status == 503
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            body = response.read().decode("utf-8")
+        assert "# TYPE email_pipeline_stage_seconds histogram" in body
+        assert "email_worker_messages_processed_total" in body
+    finally:
+        server.shutdown()
+        HealthHandler.worker_thread = None
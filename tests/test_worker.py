@@ -0,0 +1,10 @@
+import pytest
+
+from email_system import worker
+
+
+def test_worker_rejects_unknown_output_format(monkeypatch):
+    monkeypatch.setenv("STORAGE_ACCOUNT_NAME", "account")
+    monkeypatch.setenv("OUTPUT_FORMAT", "xml")
+    with pytest.raises(RuntimeError, match="OUTPUT_FORMAT"):
+        worker.main()